@@ -0,0 +1,156 @@
+# back/agendador_relatorios.py
+
+import asyncio
+import os
+from datetime import date, datetime, time, timedelta
+
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
+
+import consultas_relatorios
+import estatisticas
+import reports
+from relatorios_jobs import gestor_relatorios
+from telegram_sender import registar_mensagem_grupo, entregador_telegram
+
+# Hora (local, HH:MM) a que os relatórios do dia anterior e da semana até ontem são gerados; vazio desliga
+RELATORIOS_PREGERAR_HORA = os.getenv("RELATORIOS_PREGERAR_HORA", "04:00")
+# Se "1", manda para o grupo do Telegram o resumo de cada relatório pré-gerado
+RELATORIOS_PREGERAR_TELEGRAM = os.getenv("RELATORIOS_PREGERAR_TELEGRAM", "0") == "1"
+
+TEMPO_MAXIMO_GERACAO_SEGUNDOS = 600
+# Os pré-gerados ficam disponíveis até à pré-geração seguinte (com margem), não só RELATORIOS_JOBS_VALIDADE_SEGUNDOS
+VALIDADE_PREGERADOS_SEGUNDOS = 26 * 3600
+# Chave do bloqueio consultivo do PostgreSQL que escolhe o worker que pré-gera
+CHAVE_BLOQUEIO_PREGERACAO = 20250419
+
+
+def segundos_ate(hora: time, agora: datetime) -> float:
+    """Segundos até à próxima ocorrência da hora indicada (hoje, ou amanhã se já passou)."""
+    proxima = datetime.combine(agora.date(), hora)
+    if proxima <= agora:
+        proxima += timedelta(days=1)
+    return (proxima - agora).total_seconds()
+
+
+class AgendadorRelatorios:
+    """
+    Pré-gera, fora de horas, o relatório diário de ontem e o semanal até ontem, deixando-os
+    no cache de relatórios e nos trabalhos de relatório: quem os abrir de manhã recebe o PDF
+    sem esperar pela geração. Também os gera no arranque, porque o cache vive só na memória.
+    Com vários workers só um deles pré-gera (bloqueio consultivo no PostgreSQL); os outros
+    servem os PDFs a partir dos trabalhos, se RELATORIOS_JOBS_BACKEND=banco.
+    """
+
+    def __init__(self, hora: str = RELATORIOS_PREGERAR_HORA, enviar_telegram: bool = RELATORIOS_PREGERAR_TELEGRAM,
+                 session_factory=None):
+        self.hora = time.fromisoformat(hora) if hora else None
+        self.enviar_telegram = enviar_telegram
+        self.session_factory = session_factory
+        self._tarefa = None
+        self._ligacao_bloqueio = None
+        self.ultima_execucao = None
+
+    def _sessao(self):
+        if self.session_factory is None:
+            from database_config import SessionLocal
+            self.session_factory = SessionLocal
+        return self.session_factory()
+
+    # --- Ciclo de vida ---
+
+    def iniciar(self):
+        """Arranca a tarefa de agendamento no loop atual (chamado no arranque da aplicação)."""
+        if self.hora is None:
+            print("AVISO: RELATORIOS_PREGERAR_HORA vazio. Pré-geração de relatórios desligada.")
+            return
+        if self._tarefa is None:
+            self._tarefa = asyncio.create_task(self._executar())
+
+    async def parar(self):
+        if self._tarefa is not None:
+            self._tarefa.cancel()
+            try:
+                await self._tarefa
+            except asyncio.CancelledError:
+                pass
+            self._tarefa = None
+        await run_in_threadpool(self._largar_pregeracao)
+
+    def _assumir_pregeracao(self) -> bool:
+        """
+        No PostgreSQL, só pré-gera o worker que obtiver o bloqueio consultivo; fica com ele
+        numa ligação própria enquanto viver (se morrer, outro worker assume-o na execução
+        seguinte). Nos outros bancos, que servem um só processo, pré-gera sempre.
+        """
+        if self._ligacao_bloqueio is not None:
+            return True
+        with self._sessao() as db:
+            engine = db.get_bind()
+        if engine.dialect.name != "postgresql":
+            return True
+        ligacao = engine.connect()
+        obtido = ligacao.execute(text("SELECT pg_try_advisory_lock(:chave)"), {"chave": CHAVE_BLOQUEIO_PREGERACAO}).scalar()
+        # O bloqueio é da sessão: sobrevive ao commit, que evita deixar a transação aberta
+        ligacao.commit()
+        if not obtido:
+            ligacao.close()
+            return False
+        self._ligacao_bloqueio = ligacao
+        return True
+
+    def _largar_pregeracao(self):
+        ligacao, self._ligacao_bloqueio = self._ligacao_bloqueio, None
+        if ligacao is None:
+            return
+        try:
+            ligacao.execute(text("SELECT pg_advisory_unlock(:chave)"), {"chave": CHAVE_BLOQUEIO_PREGERACAO})
+            ligacao.commit()
+        finally:
+            ligacao.close()
+
+    async def _executar(self):
+        while True:
+            try:
+                if await run_in_threadpool(self._assumir_pregeracao):
+                    await run_in_threadpool(self.pregerar)
+            except Exception as e:
+                print(f"Erro ao pré-gerar relatórios: {e}")
+            await asyncio.sleep(segundos_ate(self.hora, datetime.now()))
+
+    # --- Pré-geração ---
+
+    def pregerar(self, hoje: date = None) -> list:
+        """Gera (se ainda não estiverem em cache) os relatórios de ontem; devolve os trabalhos usados."""
+        ontem = (hoje or estatisticas.hoje()) - timedelta(days=1)
+        trabalhos = [
+            gestor_relatorios.submeter(tipo, *reports.periodo_relatorio(tipo, hoje=ontem),
+                                       validade_segundos=VALIDADE_PREGERADOS_SEGUNDOS)
+            for tipo in ("diario", "semanal")
+        ]
+        trabalhos = [gestor_relatorios.esperar(t.id, timeout=TEMPO_MAXIMO_GERACAO_SEGUNDOS) for t in trabalhos]
+        self.ultima_execucao = datetime.now()
+        if self.enviar_telegram:
+            self._anunciar(trabalhos)
+        return trabalhos
+
+    def _anunciar(self, trabalhos: list):
+        """Manda o resumo de cada relatório para o grupo, uma só vez por relatório (chave no outbox)."""
+        with self._sessao() as db:
+            registadas = False
+            for trabalho in trabalhos:
+                if trabalho is None or trabalho.estado != "concluido":
+                    continue
+                resumo = consultas_relatorios.resumo_periodo(db, trabalho.data_inicio, trabalho.data_fim)
+                titulo = "Relatório diário" if trabalho.tipo == "diario" else "Relatório semanal"
+                periodo = trabalho.data_fim.strftime('%d/%m/%Y') if trabalho.tipo == "diario" else \
+                    f"{trabalho.data_inicio.strftime('%d/%m')} a {trabalho.data_fim.strftime('%d/%m/%Y')}"
+                texto = (f"{titulo} ({periodo}): {resumo['chegadas']} clientes, {resumo['atendidos']} atendidos, "
+                         f"{resumo['cancelados']} desistências, espera média de {resumo['tempo_medio_espera']} min.")
+                chave = f"relatorio:{trabalho.tipo}:{trabalho.data_fim.isoformat()}"
+                registadas = registar_mensagem_grupo(db, texto, chave=chave) or registadas
+            db.commit()
+        if registadas:
+            entregador_telegram.acordar()
+
+agendador_relatorios = AgendadorRelatorios()
@@ -0,0 +1,214 @@
+# back/alocacao_mesas.py
+
+import os
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import Counter
+from itertools import combinations_with_replacement
+
+from sqlalchemy.orm import Session
+
+import models
+from notification_manager import observar_eventos
+
+# Número máximo de mesas que podem ser juntadas para um único grupo
+MAXIMO_MESAS_COMBINADAS = int(os.getenv("ALOCACAO_MAX_MESAS", "3"))
+
+# Grupos menores do que isto nunca juntam mesas (aguardam uma mesa que os comporte)
+TAMANHO_MINIMO_PARA_JUNTAR = 5
+
+# De quanto em quanto tempo o índice é reconstruído a partir do banco, para apanhar
+# mesas alteradas fora do crud deste processo
+ALOCACAO_RECONCILIACAO_SEGUNDOS = float(os.getenv("ALOCACAO_RECONCILIACAO_SEGUNDOS", "30"))
+
+# Um pedido sem mesas só recarrega o índice se ele não acabou de ser carregado
+INTERVALO_MINIMO_RECARGA_SEGUNDOS = 1.0
+
+
+class MotorAlocacao:
+    """
+    Índice em memória das mesas disponíveis, agrupadas em baldes por capacidade.
+    O banco de dados continua a ser a fonte da verdade: o índice é carregado uma vez,
+    mantido em dia pelas funções do crud que alteram o status das mesas e reconstruído
+    periodicamente; as mesas alteradas por outros processos (vistas pelos eventos) são
+    relidas do banco antes da procura seguinte.
+    """
+
+    def __init__(self, max_mesas: int = MAXIMO_MESAS_COMBINADAS, reconciliacao_segundos: float = ALOCACAO_RECONCILIACAO_SEGUNDOS):
+        self.max_mesas = max_mesas
+        self.reconciliacao_segundos = reconciliacao_segundos
+        self.carregado = False
+        self._carregado_em = 0.0
+        self._alteracoes = 0          # conta alterações aplicadas, para detetar as que chegam durante um carregamento
+        self._desatualizados = set()  # ids a reler do banco antes da próxima procura
+        self._lock = threading.RLock()
+        self._capacidades = []  # capacidades distintas com mesas livres, em ordem crescente
+        self._baldes = {}       # capacidade -> lista ordenada de (numero, id)
+        self._mesas = {}        # id -> (capacidade, numero)
+
+    def carregar(self, db: Session):
+        """(Re)constrói o índice a partir das mesas com status 'disponivel'."""
+        with self._lock:
+            alteracoes_antes = self._alteracoes
+        mesas = db.query(models.Mesa.id, models.Mesa.numero, models.Mesa.capacidade).filter(
+            models.Mesa.status == 'disponivel'
+        ).all()
+        with self._lock:
+            self._limpar()
+            for mesa_id, numero, capacidade in mesas:
+                self._inserir(mesa_id, numero, capacidade)
+            self.carregado = True
+            # Alterações durante a leitura podem ter ficado de fora: volta a carregar na próxima utilização
+            self._carregado_em = time.monotonic() if self._alteracoes == alteracoes_antes else 0.0
+
+    def garantir_carregado(self, db: Session):
+        """Carrega o índice na primeira utilização e na reconciliação, e relê as mesas desatualizadas."""
+        with self._lock:
+            expirado = not self.carregado or time.monotonic() - self._carregado_em >= self.reconciliacao_segundos
+            ids = set() if expirado else set(self._desatualizados)
+            self._desatualizados.clear()
+        if expirado:
+            self.carregar(db)
+            return
+        if not ids:
+            return
+        mesas = db.query(models.Mesa.id, models.Mesa.numero, models.Mesa.capacidade, models.Mesa.status).filter(
+            models.Mesa.id.in_(ids)
+        ).all()
+        with self._lock:
+            for mesa_id in ids:
+                self._remover(mesa_id)
+            for mesa_id, numero, capacidade, status in mesas:
+                if status == 'disponivel':
+                    self._inserir(mesa_id, numero, capacidade)
+
+    def recarregar_se_antigo(self, db: Session) -> bool:
+        """Recarrega o índice, a não ser que tenha sido carregado há instantes; devolve se recarregou."""
+        with self._lock:
+            recente = self.carregado and time.monotonic() - self._carregado_em < INTERVALO_MINIMO_RECARGA_SEGUNDOS
+        if recente:
+            return False
+        self.carregar(db)
+        return True
+
+    def observar(self, evento: dict):
+        """
+        Eventos de 'mesa' que não batem com o índice vêm de outro processo (os deste processo
+        já foram aplicados antes de serem publicados): essas mesas são relidas.
+        """
+        if evento["tipo"] != "mesa":
+            return
+        dados = evento["dados"]
+        with self._lock:
+            if not self.carregado:
+                return
+            for mesa_id in dados.get("ids", []):
+                livre = mesa_id in self._mesas
+                if dados.get("acao") == "deletada" and not livre:
+                    continue
+                if "status" in dados and (dados["status"] == 'disponivel') == livre:
+                    continue
+                self._desatualizados.add(mesa_id)
+
+    def invalidar(self):
+        """Descarta o índice; será recarregado do banco na próxima utilização."""
+        with self._lock:
+            self._limpar()
+            self.carregado = False
+
+    def sincronizar_mesa(self, mesa_id: int, numero: int, capacidade: int, status: str):
+        """Reflete no índice o status atual de uma mesa."""
+        with self._lock:
+            self._alteracoes += 1
+            if not self.carregado:
+                return
+            self._remover(mesa_id)
+            if status == 'disponivel':
+                self._inserir(mesa_id, numero, capacidade)
+
+    def remover_mesa(self, mesa_id: int):
+        """Retira uma mesa do índice (ocupada, suja ou deletada)."""
+        with self._lock:
+            self._alteracoes += 1
+            self._remover(mesa_id)
+
+    def encontrar_mesas(self, tamanho_grupo: int):
+        """
+        Devolve os IDs das mesas que melhor comportam o grupo, ou None.
+        Primeiro procura a menor mesa única que sirva (O(log n)); depois a combinação
+        de até `max_mesas` mesas com o menor desperdício de lugares.
+        """
+        with self._lock:
+            posicao = bisect_left(self._capacidades, tamanho_grupo)
+            if posicao < len(self._capacidades):
+                capacidade = self._capacidades[posicao]
+                return [self._baldes[capacidade][0][1]]
+
+            if tamanho_grupo < TAMANHO_MINIMO_PARA_JUNTAR:
+                return None
+
+            combinacao = self._melhor_combinacao(tamanho_grupo)
+            if not combinacao:
+                return None
+
+            mesas_ids = []
+            for capacidade, quantidade in Counter(combinacao).items():
+                mesas_ids.extend(mesa_id for _, mesa_id in self._baldes[capacidade][:quantidade])
+            return mesas_ids
+
+    def _melhor_combinacao(self, tamanho_grupo: int):
+        """
+        Subset-sum limitado sobre as classes de capacidade: como há poucas capacidades
+        distintas, o custo depende delas e de `max_mesas`, não do número de mesas.
+        """
+        melhor_chave = None
+        melhor_combinacao = None
+        for quantidade_mesas in range(2, self.max_mesas + 1):
+            for combinacao in combinations_with_replacement(self._capacidades, quantidade_mesas):
+                total = sum(combinacao)
+                if total < tamanho_grupo:
+                    continue
+                contagem = Counter(combinacao)
+                if any(len(self._baldes[c]) < n for c, n in contagem.items()):
+                    continue
+                chave = (total - tamanho_grupo, quantidade_mesas)
+                if melhor_chave is None or chave < melhor_chave:
+                    melhor_chave = chave
+                    melhor_combinacao = combinacao
+            # Uma combinação sem desperdício com menos mesas não pode ser batida
+            if melhor_chave is not None and melhor_chave[0] == 0:
+                break
+        return melhor_combinacao
+
+    def _limpar(self):
+        self._capacidades = []
+        self._baldes = {}
+        self._mesas = {}
+        self._desatualizados = set()
+
+    def _inserir(self, mesa_id: int, numero: int, capacidade: int):
+        if mesa_id in self._mesas:
+            self._remover(mesa_id)
+        balde = self._baldes.get(capacidade)
+        if balde is None:
+            balde = self._baldes[capacidade] = []
+            insort(self._capacidades, capacidade)
+        insort(balde, (numero, mesa_id))
+        self._mesas[mesa_id] = (capacidade, numero)
+
+    def _remover(self, mesa_id: int):
+        dados = self._mesas.pop(mesa_id, None)
+        if dados is None:
+            return
+        capacidade, numero = dados
+        balde = self._baldes[capacidade]
+        balde.remove((numero, mesa_id))
+        if not balde:
+            del self._baldes[capacidade]
+            self._capacidades.remove(capacidade)
+
+
+# Instância única partilhada pelo processo
+motor_alocacao = MotorAlocacao()
+observar_eventos(motor_alocacao.observar)
@@ -1,15 +1,14 @@
 # back/bot_listener.py
 
-import nest_asyncio
-nest_asyncio.apply()
-
-import os
 import asyncio
-import requests
+import os
+import httpx
 from dotenv import load_dotenv
+from cache_ttl import CacheTTL, AUSENTE
 from telegram import Update
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     MessageHandler,
     CommandHandler,
     ConversationHandler,
@@ -20,7 +19,85 @@ from telegram.ext import (
 # Carrega as variáveis de ambiente
 load_dotenv()
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-API_BASE_URL = "http://127.0.0.1:8000"
+API_BASE_URL = os.getenv("MESAJA_API_URL", "http://127.0.0.1:8000")
+
+# Um só cliente HTTP (com keep-alive) para todas as chamadas à API.
+# O limite de ligações é também o limite de pedidos simultâneos à API;
+# os restantes esperam por uma ligação livre até ao timeout de pool.
+API_TIMEOUT = httpx.Timeout(10.0, connect=3.0, pool=15.0)
+API_MAX_LIGACOES = int(os.getenv("BOT_API_MAX_LIGACOES", "20"))
+# Quantas atualizações do Telegram o bot processa em paralelo
+BOT_MAX_ATUALIZACOES_CONCORRENTES = int(os.getenv("BOT_MAX_ATUALIZACOES_CONCORRENTES", "64"))
+
+async def iniciar_cliente_api(application: Application) -> None:
+    """Cria o cliente HTTP partilhado no arranque do bot (já dentro do event loop)."""
+    application.bot_data["api"] = httpx.AsyncClient(
+        base_url=API_BASE_URL,
+        timeout=API_TIMEOUT,
+        limits=httpx.Limits(max_connections=API_MAX_LIGACOES, max_keepalive_connections=API_MAX_LIGACOES),
+    )
+
+async def fechar_cliente_api(application: Application) -> None:
+    """Fecha as ligações do cliente HTTP no encerramento do bot."""
+    cliente = application.bot_data.pop("api", None)
+    if cliente is not None:
+        await cliente.aclose()
+
+class ProcessadorPorChat(BaseUpdateProcessor):
+    """
+    Processa atualizações de chats diferentes em paralelo, mas as de um mesmo chat uma de
+    cada vez e pela ordem de chegada: o estado do ConversationHandler não é seguro quando
+    duas mensagens do mesmo utilizador são tratadas ao mesmo tempo.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._bloqueios = {}  # chat id -> [asyncio.Lock, atualizações à espera ou em curso]
+
+    async def do_process_update(self, update, coroutine) -> None:
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            await coroutine
+            return
+        entrada = self._bloqueios.setdefault(chat.id, [asyncio.Lock(), 0])
+        entrada[1] += 1
+        try:
+            async with entrada[0]:
+                await coroutine
+        finally:
+            entrada[1] -= 1
+            if not entrada[1]:
+                del self._bloqueios[chat.id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+def _api(context: ContextTypes.DEFAULT_TYPE) -> httpx.AsyncClient:
+    return context.application.bot_data["api"]
+
+# Quem é garçom (dados) e quem não é (None). O bot não recebe as invalidações da API,
+# por isso o prazo aqui é curto, e ainda mais curto para "não é garçom": um garçom acabado
+# de registar não deve ser tratado como cliente durante muito tempo.
+cache_garcons = CacheTTL(capacidade=1000, ttl_segundos=60, ttl_negativo_segundos=5)
+
+async def _buscar_garcon(api: httpx.AsyncClient, telegram_id: str):
+    """Devolve os dados do garçom com este ID do Telegram, ou None se não for garçom."""
+    garcon = cache_garcons.obter(telegram_id)
+    if garcon is not AUSENTE:
+        return garcon
+    response = await api.get(f"/garcons/by-telegram-id/{telegram_id}")
+    if response.status_code == 200:
+        garcon = response.json()
+    elif response.status_code == 404:
+        garcon = None
+    else:
+        # Erros da API não são guardados em cache
+        response.raise_for_status()
+    cache_garcons.guardar(telegram_id, garcon)
+    return garcon
 
 # --- Lógica da Conversa para Clientes ---
 NOME, TAMANHO_GRUPO = range(2)
@@ -63,7 +140,7 @@ async def receber_tamanho_grupo(update: Update, context: ContextTypes.DEFAULT_TY
             "tamanho_grupo": tamanho_grupo,
             "cliente_telegram_id": cliente_telegram_id 
         }
-        response = requests.post(f"{API_BASE_URL}/fila/", json=fila_data)
+        response = await _api(context).post("/fila/", json=fila_data)
 
         if response.status_code == 201:
             await update.message.reply_text("Perfeito! Adicionei o seu grupo à fila de espera. Iremos notificá-lo em breve quando a sua mesa estiver pronta.")
@@ -75,6 +152,9 @@ async def receber_tamanho_grupo(update: Update, context: ContextTypes.DEFAULT_TY
     except ValueError:
         await update.message.reply_text("Isso não parece ser um número válido. Por favor, envie apenas o número de pessoas.")
         return TAMANHO_GRUPO
+    except httpx.HTTPError as e:
+        await update.message.reply_text("Desculpe, não foi possível adicioná-lo à fila. O sistema parece estar com problemas.")
+        print(f"ERRO de API ao adicionar cliente via bot: {e}")
     
     context.user_data.clear()
     return ConversationHandler.END
@@ -95,16 +175,21 @@ async def handle_garcon_message(update: Update, context: ContextTypes.DEFAULT_TY
     texto_mensagem = update.message.text
     
     try:
-        response = requests.get(f"{API_BASE_URL}/garcons/by-telegram-id/{user_id}")
-        if response.status_code == 200:
-            garcon = response.json()
+        api = _api(context)
+        garcon = await _buscar_garcon(api, user_id)
+        if garcon:
             mensagem_data = {"texto": texto_mensagem, "direcao": "recebida", "garcon_id": garcon['id']}
-            requests.post(f"{API_BASE_URL}/mensagens/", json=mensagem_data)
+            response = await api.post("/mensagens/", json=mensagem_data)
+            if response.status_code == 404:
+                # O garçom foi removido depois de entrar em cache
+                cache_garcons.invalidar(user_id)
+                await update.message.reply_text("Olá! Se quiser entrar na fila, por favor, use o comando /entrar.")
+                return
             await update.message.reply_text("Mensagem recebida pelo sistema.")
         else:
             # Se não for um garçom, assume que não é para o sistema
             await update.message.reply_text("Olá! Se quiser entrar na fila, por favor, use o comando /entrar.")
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"ERRO de API ao lidar com mensagem de garçom: {e}")
 
 # --- Função Principal do Bot ---
@@ -113,7 +198,16 @@ def main() -> None:
         print("ERRO: TELEGRAM_BOT_TOKEN não encontrado no ficheiro .env")
         return
 
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        # Sem isto as atualizações são tratadas uma a uma e cada chamada à API atrasa todos os clientes;
+        # as de um mesmo chat continuam em série, por causa do estado da conversa
+        .concurrent_updates(ProcessadorPorChat(BOT_MAX_ATUALIZACOES_CONCORRENTES))
+        .post_init(iniciar_cliente_api)
+        .post_shutdown(fechar_cliente_api)
+        .build()
+    )
 
     # Cria o ConversationHandler para o fluxo de entrada na fila
     conv_handler = ConversationHandler(
@@ -0,0 +1,58 @@
+# back/cache_ttl.py
+
+import threading
+import time
+from collections import OrderedDict
+
+# Devolvido por CacheTTL.obter quando a chave não está em cache (None é um valor válido: "não existe")
+AUSENTE = object()
+
+
+class CacheTTL:
+    """
+    Cache LRU com prazo de validade por entrada, segura para várias threads.
+    Guardar None regista um resultado negativo ("não existe"), com prazo próprio,
+    para que as consultas repetidas a chaves inexistentes também não cheguem ao banco.
+    """
+
+    def __init__(self, capacidade: int = 1000, ttl_segundos: float = 300, ttl_negativo_segundos: float = 60):
+        self.capacidade = capacidade
+        self.ttl_segundos = ttl_segundos
+        self.ttl_negativo_segundos = ttl_negativo_segundos
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+        self.acertos = 0
+        self.falhas = 0
+
+    def obter(self, chave):
+        """Devolve o valor em cache (que pode ser None) ou AUSENTE se não existir ou tiver expirado."""
+        with self._lock:
+            entrada = self._entradas.get(chave)
+            if entrada is None or entrada[1] <= time.monotonic():
+                if entrada is not None:
+                    del self._entradas[chave]
+                self.falhas += 1
+                return AUSENTE
+            self._entradas.move_to_end(chave)
+            self.acertos += 1
+            return entrada[0]
+
+    def guardar(self, chave, valor):
+        ttl = self.ttl_negativo_segundos if valor is None else self.ttl_segundos
+        with self._lock:
+            self._entradas[chave] = (valor, time.monotonic() + ttl)
+            self._entradas.move_to_end(chave)
+            while len(self._entradas) > self.capacidade:
+                self._entradas.popitem(last=False)
+
+    def invalidar(self, chave):
+        with self._lock:
+            self._entradas.pop(chave, None)
+
+    def limpar(self):
+        with self._lock:
+            self._entradas.clear()
+
+    def estado(self) -> dict:
+        with self._lock:
+            return {"entradas": len(self._entradas), "acertos": self.acertos, "falhas": self.falhas}
@@ -0,0 +1,93 @@
+# back/consultas_relatorios.py
+
+import os
+from datetime import date
+
+from sqlalchemy import case, func
+from sqlalchemy.orm import Session
+
+import crud
+import estatisticas
+import models
+
+# De onde vêm os números do resumo dos relatórios:
+#   'estatisticas' (padrão) - tabela estatisticas_diarias, O(dias) (precisa do backfill em bancos antigos);
+#   'sql'                   - agregados calculados na hora sobre a tabela fila, sem trazer linhas para o Python.
+RELATORIOS_FONTE_RESUMO = os.getenv("RELATORIOS_FONTE_RESUMO", "estatisticas")
+
+# Quantas linhas de detalhe são lidas do banco de cada vez
+TAMANHO_BLOCO_DETALHE = 500
+
+
+def _espera_em_segundos(db: Session):
+    """Expressão SQL com a espera (atendimento - chegada) em segundos, no dialeto do banco."""
+    if db.get_bind().dialect.name == "postgresql":
+        return func.extract("epoch", models.Fila.horario_atendimento - models.Fila.horario_chegada)
+    # SQLite não subtrai datas: converte para dias julianos
+    return (func.julianday(models.Fila.horario_atendimento) - func.julianday(models.Fila.horario_chegada)) * 86400
+
+def resumo_por_sql(db: Session, data_inicio: date, data_fim: date) -> dict:
+    """
+    Totais do período numa única consulta GROUP BY status. Os percentis só são
+    calculados no PostgreSQL (percentile_cont); noutros bancos ficam a None.
+    """
+    inicio, fim = crud._intervalo_dias(data_inicio, data_fim)
+    espera = _espera_em_segundos(db)
+    colunas = [
+        models.Fila.status,
+        func.count(models.Fila.id),
+        func.count(models.Fila.horario_atendimento),
+        func.sum(case((models.Fila.horario_atendimento != None, espera))),
+    ]
+    linhas = db.query(*colunas).filter(
+        models.Fila.horario_chegada >= inicio,
+        models.Fila.horario_chegada < fim
+    ).group_by(models.Fila.status).all()
+
+    resumo = {"chegadas": 0, "atendidos": 0, "cancelados": 0, "tempo_medio_espera": 0, "espera_p50": None, "espera_p90": None}
+    espera_total = 0.0
+    for status, total, com_atendimento, soma_espera in linhas:
+        resumo["chegadas"] += total
+        if status == "atendido":
+            resumo["atendidos"] = com_atendimento
+            espera_total = float(soma_espera or 0)
+        elif status == "cancelado":
+            resumo["cancelados"] = total
+    if resumo["atendidos"]:
+        resumo["tempo_medio_espera"] = round(espera_total / resumo["atendidos"] / 60)
+
+    if resumo["atendidos"] and db.get_bind().dialect.name == "postgresql":
+        p50, p90 = db.query(
+            func.percentile_cont(0.5).within_group(espera),
+            func.percentile_cont(0.9).within_group(espera),
+        ).filter(
+            models.Fila.status == "atendido",
+            models.Fila.horario_atendimento != None,
+            models.Fila.horario_chegada >= inicio,
+            models.Fila.horario_chegada < fim
+        ).one()
+        resumo["espera_p50"] = round(p50 / 60)
+        resumo["espera_p90"] = round(p90 / 60)
+    return resumo
+
+def resumo_periodo(db: Session, data_inicio: date, data_fim: date) -> dict:
+    """Resumo do período a partir da fonte configurada em RELATORIOS_FONTE_RESUMO."""
+    if RELATORIOS_FONTE_RESUMO == "sql":
+        return resumo_por_sql(db, data_inicio, data_fim)
+    return estatisticas.resumo_periodo(db, data_inicio, data_fim)
+
+def iterar_clientes(db: Session, data_inicio: date, data_fim: date, tamanho_bloco: int = TAMANHO_BLOCO_DETALHE):
+    """
+    Percorre os clientes do período por ordem de chegada como tuplos simples
+    (nome_cliente, tamanho_grupo, horario_chegada, status), lidos em blocos:
+    no PostgreSQL o yield_per usa um cursor do lado do servidor.
+    """
+    inicio, fim = crud._intervalo_dias(data_inicio, data_fim)
+    consulta = db.query(
+        models.Fila.nome_cliente, models.Fila.tamanho_grupo, models.Fila.horario_chegada, models.Fila.status
+    ).filter(
+        models.Fila.horario_chegada >= inicio,
+        models.Fila.horario_chegada < fim
+    ).order_by(models.Fila.horario_chegada).yield_per(tamanho_bloco)
+    for linha in consulta:
+        yield tuple(linha)
@@ -1,29 +1,44 @@
 # back/crud.py
 
+import os
 from sqlalchemy.orm import Session
-from sqlalchemy import func
-from itertools import combinations
-from datetime import date, datetime, timedelta
+from sqlalchemy import func, tuple_, update
+from sqlalchemy.exc import OperationalError
+from datetime import date, datetime, time, timedelta
 
 import models
 import schemas
-from notification_manager import add_notification
-from telegram_sender import enviar_mensagem_para_grupo, enviar_mensagem_privada
+import estatisticas
+from alocacao_mesas import motor_alocacao
+from metricas import painel_metricas
+from fila_espera import indice_fila
+from cache_ttl import CacheTTL, AUSENTE
+from database_config import executar_no_banco
+from notification_manager import add_notification, publicar_evento, observar_eventos
+from telegram_sender import registar_mensagem_grupo, registar_mensagem_privada, entregador_telegram, escapar
 
 # --- Funções CRUD para a Mesa ----
 
 async def criar_mesa(db: Session, mesa: schemas.MesaCreate):
     """Cria uma nova entrada de mesa no banco de dados."""
+    return await executar_no_banco(db, _criar_mesa, mesa)
+
+def _criar_mesa(db: Session, mesa: schemas.MesaCreate):
     nova_mesa = models.Mesa(**mesa.model_dump())
     db.add(nova_mesa)
     db.commit()
     db.refresh(nova_mesa)
+    motor_alocacao.sincronizar_mesa(nova_mesa.id, nova_mesa.numero, nova_mesa.capacidade, nova_mesa.status)
     add_notification(f"Mesa {nova_mesa.numero} foi criada com capacidade para {nova_mesa.capacidade}.")
+    publicar_evento("mesa", {"acao": "criada", "ids": [nova_mesa.id], "numeros": [nova_mesa.numero]})
     return nova_mesa
 
-def listar_mesas(db: Session, skip: int = 0, limit: int = 100):
-    """Lista todas as mesas do banco de dados."""
-    return db.query(models.Mesa).offset(skip).limit(limit).all()
+def listar_mesas(db: Session, skip: int = 0, limit: int = 100, apos_numero: int = None):
+    """Lista as mesas por número; com apos_numero, continua a partir dessa mesa (paginação por cursor)."""
+    query = db.query(models.Mesa)
+    if apos_numero is not None:
+        query = query.filter(models.Mesa.numero > apos_numero)
+    return query.order_by(models.Mesa.numero).offset(skip).limit(limit).all()
 
 def buscar_mesa_por_id(db: Session, mesa_id: int):
     """Busca uma única mesa pelo seu ID."""
@@ -31,6 +46,9 @@ def buscar_mesa_por_id(db: Session, mesa_id: int):
 
 async def atualizar_status_mesa(db: Session, mesa_id: int, novo_status: str):
     """Atualiza o status de uma mesa específica no banco de dados."""
+    return await executar_no_banco(db, _atualizar_status_mesa, mesa_id, novo_status)
+
+def _atualizar_status_mesa(db: Session, mesa_id: int, novo_status: str):
     mesa = buscar_mesa_por_id(db, mesa_id)
     if mesa:
         cliente_info = f" por '{mesa.cliente_atual}'" if mesa.cliente_atual else ""
@@ -42,54 +60,102 @@ async def atualizar_status_mesa(db: Session, mesa_id: int, novo_status: str):
             
         db.commit()
         db.refresh(mesa)
+        motor_alocacao.sincronizar_mesa(mesa.id, mesa.numero, mesa.capacidade, mesa.status)
+        publicar_evento("mesa", {"acao": "status", "ids": [mesa.id], "numeros": [mesa.numero], "status": mesa.status})
     return mesa
 
 async def deletar_mesa(db: Session, mesa_id: int):
     """Deleta uma mesa do banco de dados pelo seu ID."""
+    return await executar_no_banco(db, _deletar_mesa, mesa_id)
+
+def _deletar_mesa(db: Session, mesa_id: int):
     mesa = buscar_mesa_por_id(db, mesa_id)
     if mesa:
         add_notification(f"Mesa {mesa.numero} foi deletada do sistema.")
         db.delete(mesa)
         db.commit()
+        motor_alocacao.remover_mesa(mesa_id)
+        publicar_evento("mesa", {"acao": "deletada", "ids": [mesa_id], "numeros": [mesa.numero]})
     return mesa
 
 async def atribuir_proximo_cliente(db: Session, mesa_id: int):
     """Atribui o primeiro cliente da fila a uma mesa disponível."""
-    mesa = buscar_mesa_por_id(db, mesa_id)
-    cliente_fila = db.query(models.Fila).filter(models.Fila.status == 'aguardando').order_by(models.Fila.horario_chegada).first()
+    return await executar_no_banco(db, _atribuir_proximo_cliente, mesa_id)
+
+def _atribuir_proximo_cliente(db: Session, mesa_id: int):
+    for _ in range(TENTATIVAS_ATENDIMENTO):
+        mesa = buscar_mesa_por_id(db, mesa_id)
+        cliente_fila = _primeiro_da_fila(db, capacidade=mesa.capacidade) if mesa else None
+        if not (mesa and cliente_fila):
+            db.rollback()
+            return None
+        try:
+            reservado = _reservar(db, cliente_fila, [mesa])
+        except OperationalError as e:
+            # Deadlock ou bloqueio com um pedido simultâneo: desfaz e tenta de novo
+            print(f"AVISO: conflito ao reservar a mesa {mesa_id}, a tentar de novo: {e}")
+            reservado = False
+        if reservado:
+            break
+        db.rollback()
+        # Se foi a mesa que outro pedido ocupou, não adianta tentar com o cliente seguinte
+        if db.query(models.Mesa.status).filter(models.Mesa.id == mesa_id).scalar() != 'disponivel':
+            return None
+    else:
+        return None
+
+    mesa.status = "ocupada"
+    mesa.cliente_atual = cliente_fila.nome_cliente
+
+    status_anterior, horario_atendimento_anterior = cliente_fila.status, cliente_fila.horario_atendimento
+    cliente_fila.status = "atendido"
+    cliente_fila.horario_atendimento = datetime.utcnow()
+    cliente_fila.mesas_utilizadas = str(mesa.numero)
+    estatisticas.registar_mudanca_status(db, cliente_fila, status_anterior, horario_atendimento_anterior)
+    painel_metricas.registar_mudanca_status(db, cliente_fila, status_anterior)
+    indice_fila.registar(db, cliente_fila)
+    registar_mensagem_grupo(
+        db, f"Cliente '{cliente_fila.nome_cliente}' foi atendido na Mesa {mesa.numero}.",
+        chave=f"atendimento:fila:{cliente_fila.id}"
+    )
 
-    if mesa and cliente_fila:
-        mesa.status = "ocupada"
-        mesa.cliente_atual = cliente_fila.nome_cliente
-        
-        cliente_fila.status = "atendido"
-        cliente_fila.horario_atendimento = datetime.utcnow()
-        cliente_fila.mesas_utilizadas = str(mesa.numero)
-        
-        db.commit()
-        db.refresh(mesa)
-        add_notification(f"Cliente '{cliente_fila.nome_cliente}' foi alocado à Mesa {mesa.numero}.")
-        mensagem_para_grupo = f"Cliente '{cliente_fila.nome_cliente}' foi atendido na Mesa {mesa.numero}."
-        await enviar_mensagem_para_grupo(mensagem_para_grupo)
-        
-        return mesa
-    
-    return None
+    db.commit()
+    db.refresh(mesa)
+    entregador_telegram.acordar()
+    motor_alocacao.remover_mesa(mesa.id)
+    add_notification(f"Cliente '{cliente_fila.nome_cliente}' foi alocado à Mesa {mesa.numero}.")
+    publicar_evento("mesa", {"acao": "status", "ids": [mesa.id], "numeros": [mesa.numero], "status": mesa.status})
+    publicar_evento("fila", {"acao": "atendido", "id": cliente_fila.id})
+
+    return mesa
 
 # --- Funções CRUD para a Fila ---
 
 async def adicionar_cliente_fila(db: Session, cliente: schemas.FilaCreate):
     """Adiciona um novo cliente na fila de espera."""
+    return await executar_no_banco(db, _adicionar_cliente_fila, cliente)
+
+def _adicionar_cliente_fila(db: Session, cliente: schemas.FilaCreate):
     novo_cliente = models.Fila(**cliente.model_dump())
     db.add(novo_cliente)
+    # O flush preenche o horário de chegada, que define o dia/hora das estatísticas
+    db.flush()
+    estatisticas.registar_chegada(db, novo_cliente)
+    painel_metricas.registar_chegada(db, novo_cliente)
+    indice_fila.registar(db, novo_cliente)
     db.commit()
     db.refresh(novo_cliente)
     add_notification(f"Cliente '{novo_cliente.nome_cliente}' (grupo de {novo_cliente.tamanho_grupo}) entrou na fila.")
+    publicar_evento("fila", {"acao": "entrada", "id": novo_cliente.id})
     return novo_cliente
 
-def listar_fila(db: Session, skip: int = 0, limit: int = 100):
-    """Lista os clientes na fila com o status 'aguardando'."""
-    return db.query(models.Fila).filter(models.Fila.status == 'aguardando').order_by(models.Fila.horario_chegada).offset(skip).limit(limit).all()
+def listar_fila(db: Session, skip: int = 0, limit: int = 100, apos: tuple = None):
+    """
+    Lista os clientes na fila com o status 'aguardando', por ordem de chegada, a partir do
+    índice em memória (ver fila_espera.py). Com apos=(horario_chegada, id), continua a partir
+    desse cliente (paginação por cursor).
+    """
+    return indice_fila.listar(db, skip=skip, limit=limit, apos=apos)
 
 def buscar_cliente_fila_por_id(db: Session, fila_id: int):
     """Busca um cliente na fila pelo seu ID."""
@@ -97,104 +163,363 @@ def buscar_cliente_fila_por_id(db: Session, fila_id: int):
 
 async def atualizar_cliente_fila(db: Session, fila_id: int, dados_atualizacao: schemas.FilaUpdate):
     """Atualiza os dados de um cliente na fila."""
-    cliente_db = buscar_cliente_fila_por_id(db, fila_id)
-    if cliente_db:
-        dados = dados_atualizacao.model_dump(exclude_unset=True)
-        for campo, valor in dados.items():
-            setattr(cliente_db, campo, valor)
-        
+    return await executar_no_banco(db, _atualizar_cliente_fila, fila_id, dados_atualizacao)
+
+def _atualizar_cliente_fila(db: Session, fila_id: int, dados_atualizacao: schemas.FilaUpdate):
+    dados = dados_atualizacao.model_dump(exclude_unset=True)
+    for _ in range(TENTATIVAS_ATENDIMENTO):
+        cliente_db = buscar_cliente_fila_por_id(db, fila_id)
+        if not cliente_db:
+            return None
+        status_anterior, horario_atendimento_anterior = cliente_db.status, cliente_db.horario_atendimento
+        tamanho_grupo_anterior = cliente_db.tamanho_grupo
+        valores = dict(dados)
         if dados.get('status') == 'atendido':
-            cliente_db.horario_atendimento = datetime.utcnow()
+            valores['horario_atendimento'] = datetime.utcnow()
+
+        # Só atualiza se o cliente continua como foi lido (compare-and-set, como em _reservar):
+        # os deltas das estatísticas e do painel partem destes valores anteriores
+        atualizado = db.execute(
+            update(models.Fila)
+            .where(
+                models.Fila.id == fila_id,
+                models.Fila.status == status_anterior,
+                models.Fila.tamanho_grupo == tamanho_grupo_anterior,
+                models.Fila.horario_atendimento.is_(None) if horario_atendimento_anterior is None
+                else models.Fila.horario_atendimento == horario_atendimento_anterior,
+            )
+            .values(**valores)
+            .execution_options(synchronize_session=False)
+        ).rowcount == 1
+        if not atualizado:
+            # Outro pedido alterou o cliente entre a leitura e o UPDATE: relê e tenta de novo
+            db.rollback()
+            continue
+        db.refresh(cliente_db)
+
+        estatisticas.registar_mudanca_status(
+            db, cliente_db, status_anterior, horario_atendimento_anterior,
+            tamanho_grupo_anterior if cliente_db.tamanho_grupo != tamanho_grupo_anterior else None
+        )
+        painel_metricas.registar_mudanca_status(db, cliente_db, status_anterior)
+        indice_fila.registar(db, cliente_db)
 
         if 'status' in dados:
             add_notification(f"Status do cliente '{cliente_db.nome_cliente}' alterado para '{dados['status']}'.")
-            
+
         db.commit()
         db.refresh(cliente_db)
-    return cliente_db
+        publicar_evento("fila", {
+            "acao": "atualizado", "id": cliente_db.id, "status": cliente_db.status,
+            "tamanho_grupo": cliente_db.tamanho_grupo, "nome_cliente": cliente_db.nome_cliente,
+        })
+        return cliente_db
+    # Perdeu todas as tentativas para pedidos simultâneos sobre o mesmo cliente
+    return None
+
+# --- Reserva de clientes e mesas entre pedidos simultâneos ---
+
+# Quantas vezes um atendimento recomeça quando um pedido simultâneo ficou com o mesmo cliente ou mesa
+TENTATIVAS_ATENDIMENTO = int(os.getenv("TENTATIVAS_ATENDIMENTO", "10"))
+
+def _sem_esperar_bloqueados(db: Session, query):
+    """
+    No PostgreSQL, SELECT ... FOR UPDATE SKIP LOCKED: cada pedido fica com linhas que nenhum
+    outro está a atender, em vez de esperar por ele. Nos outros bancos a consulta fica igual
+    e a exclusão é garantida só pelas atualizações condicionais de _reservar.
+    """
+    if db.get_bind().dialect.name == "postgresql":
+        return query.with_for_update(skip_locked=True)
+    return query
+
+def _tomar_clientes(db: Session, ids: list) -> dict:
+    """
+    Lê do banco, pela chave primária, os clientes escolhidos no índice da fila que continuam
+    'aguardando' (e, no PostgreSQL, que nenhum outro pedido está a atender). Os que faltam
+    são marcados para o índice os reler.
+    """
+    clientes = {c.id: c for c in _sem_esperar_bloqueados(db, db.query(models.Fila).filter(
+        models.Fila.id.in_(ids), models.Fila.status == 'aguardando')).all()}
+    for fila_id in ids:
+        if fila_id not in clientes:
+            indice_fila.marcar_desatualizado(fila_id)
+    return clientes
+
+def _primeiro_da_fila(db: Session, capacidade: int = None):
+    """Primeiro cliente à espera (que caiba em `capacidade` lugares, se indicada), escolhido no índice em memória."""
+    ignorados = set()
+    while True:
+        fila_id = indice_fila.primeiro(db, capacidade, ignorados)
+        if fila_id is None:
+            return None
+        cliente = _tomar_clientes(db, [fila_id]).get(fila_id)
+        if cliente:
+            return cliente
+        ignorados.add(fila_id)
+
+def _bloquear_mesas(db: Session, ids_mesas: list):
+    """
+    No PostgreSQL, bloqueia as mesas de uma só vez e por ordem de id (SELECT ... ORDER BY id
+    FOR UPDATE), antes de qualquer UPDATE: como todos os pedidos bloqueiam as mesas pela mesma
+    ordem, um lote e um atendimento simultâneos esperam um pelo outro em vez de se bloquearem
+    mutuamente (deadlock). Nos outros bancos não faz nada.
+    """
+    if ids_mesas and db.get_bind().dialect.name == "postgresql":
+        db.query(models.Mesa.id).filter(models.Mesa.id.in_(ids_mesas)).order_by(models.Mesa.id).with_for_update().all()
+
+def _reservar(db: Session, cliente_fila: models.Fila, mesas: list) -> bool:
+    """
+    Toma o cliente e as mesas para esta transação com UPDATEs condicionais ao status lido
+    (compare-and-set): se outro pedido os atendeu entretanto, o UPDATE não encontra a linha.
+    As linhas atualizadas ficam bloqueadas até ao commit. Devolve False se perdeu a corrida;
+    quem chama deve então fazer rollback, porque parte da reserva pode ter ficado feita.
+    Um deadlock ou bloqueio do banco sai como OperationalError, tratado da mesma forma.
+    """
+    _bloquear_mesas(db, [m.id for m in mesas])
+    cliente_reservado = db.execute(
+        update(models.Fila)
+        .where(models.Fila.id == cliente_fila.id, models.Fila.status == 'aguardando')
+        .values(status='atendido')
+        .execution_options(synchronize_session=False)
+    ).rowcount == 1
+    if not cliente_reservado:
+        return False
+    ids_mesas = [m.id for m in mesas]
+    return db.execute(
+        update(models.Mesa)
+        .where(models.Mesa.id.in_(ids_mesas), models.Mesa.status == 'disponivel')
+        .values(status='ocupada')
+        .execution_options(synchronize_session=False)
+    ).rowcount == len(ids_mesas)
+
+def buscar_mesas_para_grupo(db: Session, tamanho_grupo: int):
+    """Escolhe, pelo motor de alocação, a mesa ou combinação de mesas livres que melhor comporta o grupo."""
+    motor_alocacao.garantir_carregado(db)
+    for _ in range(2):
+        mesas_ids = motor_alocacao.encontrar_mesas(tamanho_grupo)
+        if not mesas_ids:
+            # Uma mesa libertada fora deste processo pode ainda não estar no índice
+            if not motor_alocacao.recarregar_se_antigo(db):
+                return None
+            continue
+        mesas = db.query(models.Mesa).filter(
+            models.Mesa.id.in_(mesas_ids),
+            models.Mesa.status == 'disponivel'
+        ).order_by(models.Mesa.numero).all()
+        if len(mesas) == len(mesas_ids):
+            return mesas
+        # O índice divergiu do banco (ex.: alteração feita por outro processo): recarrega e tenta de novo
+        motor_alocacao.carregar(db)
+    return None
+
+def _ocupar_mesas(db: Session, cliente_fila: models.Fila, mesas: list):
+    """Marca as mesas como ocupadas pelo cliente e o cliente como atendido (sem commit)."""
+    numeros_mesas_str = ", ".join(str(m.numero) for m in mesas)
+    for mesa in mesas:
+        mesa.status = "ocupada"
+        mesa.cliente_atual = cliente_fila.nome_cliente
+
+    status_anterior, horario_atendimento_anterior = cliente_fila.status, cliente_fila.horario_atendimento
+    cliente_fila.status = "atendido"
+    cliente_fila.horario_atendimento = datetime.utcnow()
+    cliente_fila.mesas_utilizadas = numeros_mesas_str
+    estatisticas.registar_mudanca_status(db, cliente_fila, status_anterior, horario_atendimento_anterior)
+    painel_metricas.registar_mudanca_status(db, cliente_fila, status_anterior)
+    indice_fila.registar(db, cliente_fila)
+    return numeros_mesas_str
 
 async def atender_proximo_da_fila(db: Session):
     """Busca o primeiro cliente na fila e tenta alocá-lo a uma ou mais mesas."""
-    cliente_fila = db.query(models.Fila).filter(models.Fila.status == 'aguardando').order_by(models.Fila.horario_chegada).first()
-    if not cliente_fila:
-        return {"sucesso": False, "mensagem": "A fila de espera está vazia."}
+    return await executar_no_banco(db, _atender_proximo_da_fila)
 
-    mesas_disponiveis = db.query(models.Mesa).filter(models.Mesa.status == 'disponivel').order_by(models.Mesa.capacidade.desc()).all()
-    
-    mesas_alocadas = None
-    # 1. Tenta encontrar uma única mesa
-    for mesa_unica in mesas_disponiveis:
-        if mesa_unica.capacidade >= cliente_fila.tamanho_grupo:
-            mesas_alocadas = [mesa_unica]
+def _atender_proximo_da_fila(db: Session):
+    for _ in range(TENTATIVAS_ATENDIMENTO):
+        cliente_fila = _primeiro_da_fila(db)
+        if not cliente_fila:
+            db.rollback()
+            return {"sucesso": False, "mensagem": "A fila de espera está vazia."}
+
+        mesas_alocadas = buscar_mesas_para_grupo(db, cliente_fila.tamanho_grupo)
+        if not mesas_alocadas:
             break
-            
-    # 2. Se não encontrou, tenta combinar
-    if not mesas_alocadas and cliente_fila.tamanho_grupo > 4 and len(mesas_disponiveis) >= 2:
-        for combo in combinations(mesas_disponiveis, 2):
-            if sum(m.capacidade for m in combo) >= cliente_fila.tamanho_grupo:
-                mesas_alocadas = list(combo)
+        try:
+            if _reservar(db, cliente_fila, mesas_alocadas):
                 break
+        except OperationalError as e:
+            print(f"AVISO: conflito ao atender o próximo da fila, a tentar de novo: {e}")
+        # Outro pedido atendeu o cliente ou ocupou uma das mesas (ou houve um deadlock): recomeça com o estado atual
+        db.rollback()
+        motor_alocacao.invalidar()
+    else:
+        return {"sucesso": False, "mensagem": "Muitos atendimentos em simultâneo. Tente novamente."}
 
     if mesas_alocadas:
-        numeros_mesas_str = ", ".join(str(m.numero) for m in mesas_alocadas)
-        for mesa in mesas_alocadas:
-            mesa.status = "ocupada"
-            mesa.cliente_atual = cliente_fila.nome_cliente
-        
-        cliente_fila.status = "atendido"
-        cliente_fila.horario_atendimento = datetime.utcnow()
-        cliente_fila.mesas_utilizadas = numeros_mesas_str
+        numeros_mesas_str = _ocupar_mesas(db, cliente_fila, mesas_alocadas)
+        nome_cliente = cliente_fila.nome_cliente
+        registar_mensagem_grupo(
+            db, f"Cliente '{nome_cliente}' foi atendido na(s) Mesa(s) {numeros_mesas_str}.",
+            chave=f"atendimento:fila:{cliente_fila.id}"
+        )
         
         db.commit()
+        entregador_telegram.acordar()
+        for mesa in mesas_alocadas:
+            motor_alocacao.remover_mesa(mesa.id)
         
-        add_notification(f"Cliente '{cliente_fila.nome_cliente}' atendido na(s) Mesa(s) {numeros_mesas_str}.")
-        mensagem_para_grupo = f"Cliente '{cliente_fila.nome_cliente}' foi atendido na(s) Mesa(s) {numeros_mesas_str}."
-        await enviar_mensagem_para_grupo(mensagem_para_grupo)
+        add_notification(f"Cliente '{nome_cliente}' atendido na(s) Mesa(s) {numeros_mesas_str}.")
+        publicar_evento("fila", {"acao": "atendido", "id": cliente_fila.id})
+        publicar_evento("mesa", {
+            "acao": "status", "ids": [m.id for m in mesas_alocadas],
+            "numeros": [m.numero for m in mesas_alocadas], "status": "ocupada",
+        })
+
+        return {
+            "sucesso": True,
+            "cliente": cliente_fila,
+            "mesas": mesas_alocadas,
+            # Valores já resolvidos: os objetos expiram no commit e não devem ser recarregados no event loop
+            "nome_cliente": nome_cliente,
+            "numeros_mesas": numeros_mesas_str,
+        }
+
+    db.rollback()
+    return {"sucesso": False, "mensagem": "Não há mesas ou combinação de mesas disponíveis que comportem o grupo."}
 
-        return {"sucesso": True, "cliente": cliente_fila, "mesas": mesas_alocadas}
+POLITICAS_ATENDIMENTO_LOTE = ("fifo", "fifo_com_avanco")
+
+async def atender_fila_em_lote(db: Session, politica: str = "fifo"):
+    """
+    Atende o maior número possível de clientes da fila numa única transação.
+    Com a política 'fifo' para no primeiro grupo que não cabe nas mesas livres;
+    com 'fifo_com_avanco' os grupos seguintes que couberem podem passar à frente.
+    """
+    return await executar_no_banco(db, _atender_fila_em_lote, politica)
+
+def _atender_fila_em_lote(db: Session, politica: str):
+    for _ in range(TENTATIVAS_ATENDIMENTO):
+        try:
+            atribuicoes = _montar_lote(db, politica)
+        except OperationalError as e:
+            print(f"AVISO: conflito ao atender a fila em lote, a tentar de novo: {e}")
+            atribuicoes = None
+        if atribuicoes is not None:
+            break
+        # Um pedido simultâneo ficou com um dos clientes ou mesas (ou houve um deadlock): o lote recomeça do zero
+        db.rollback()
+        motor_alocacao.invalidar()
+    else:
+        return []
 
-    return {"sucesso": False, "mensagem": "Não há mesas ou combinação de mesas disponíveis que comportem o grupo."}
+    if not atribuicoes:
+        return atribuicoes
+
+    try:
+        db.commit()
+    except Exception:
+        db.rollback()
+        # As reservas feitas no índice deixaram de ser válidas
+        motor_alocacao.invalidar()
+        raise
+
+    entregador_telegram.acordar()
+    add_notification(f"{len(atribuicoes)} cliente(s) atendido(s) em lote.")
+    publicar_evento("fila", {"acao": "atendido", "ids": [a["fila_id"] for a in atribuicoes]})
+    publicar_evento("mesa", {
+        "acao": "status", "ids": [i for a in atribuicoes for i in a["mesas_ids"]],
+        "numeros": [n for a in atribuicoes for n in a["mesas"]], "status": "ocupada",
+    })
+
+    return atribuicoes
+
+def _montar_lote(db: Session, politica: str):
+    """Reserva e ocupa as mesas de cada cliente do lote (sem commit); None se perdeu uma corrida."""
+    ids = [c.id for c in indice_fila.listar(db, limit=None)]
+    por_id = _tomar_clientes(db, ids) if ids else {}
+    clientes_fila = [por_id[fila_id] for fila_id in ids if fila_id in por_id]
+
+    # Primeiro escolhe as mesas de todos os clientes, para as bloquear todas de uma vez
+    plano = []
+    for cliente_fila in clientes_fila:
+        mesas_alocadas = buscar_mesas_para_grupo(db, cliente_fila.tamanho_grupo)
+        if not mesas_alocadas:
+            if politica == "fifo":
+                break
+            continue
+        # Reserva as mesas no índice já agora, para os próximos grupos do lote não as receberem
+        for mesa in mesas_alocadas:
+            motor_alocacao.remover_mesa(mesa.id)
+        plano.append((cliente_fila, mesas_alocadas))
+    _bloquear_mesas(db, [mesa.id for _, mesas_alocadas in plano for mesa in mesas_alocadas])
+
+    atribuicoes = []
+    for cliente_fila, mesas_alocadas in plano:
+        if not _reservar(db, cliente_fila, mesas_alocadas):
+            return None
+
+        numeros_mesas_str = _ocupar_mesas(db, cliente_fila, mesas_alocadas)
+        # Uma mensagem por cliente: o entregador junta a rajada numa só mensagem para o grupo
+        registar_mensagem_grupo(
+            db, f"Cliente '{cliente_fila.nome_cliente}' foi atendido na(s) Mesa(s) {numeros_mesas_str}.",
+            chave=f"atendimento:fila:{cliente_fila.id}"
+        )
+        atribuicoes.append({
+            "fila_id": cliente_fila.id,
+            "nome_cliente": cliente_fila.nome_cliente,
+            "tamanho_grupo": cliente_fila.tamanho_grupo,
+            "mesas": [m.numero for m in mesas_alocadas],
+            "mesas_ids": [m.id for m in mesas_alocadas],
+        })
+    return atribuicoes
 
 # --- Funções para a Central de Interações e Relatórios ---
 
-def listar_historico_completo(db: Session, limit: int = 50):
-    return db.query(models.Fila).order_by(models.Fila.horario_chegada.desc()).limit(limit).all()
+def listar_historico_completo(db: Session, limit: int = 50, antes: tuple = None, depois_do_id: int = None):
+    """
+    Histórico do mais recente para o mais antigo; com antes=(horario_chegada, id), continua a partir
+    desse cliente; com depois_do_id, só os clientes que entraram depois desse.
+    """
+    query = db.query(models.Fila)
+    if antes is not None:
+        query = query.filter(tuple_(models.Fila.horario_chegada, models.Fila.id) < tuple_(*antes))
+    if depois_do_id is not None:
+        query = query.filter(models.Fila.id > depois_do_id)
+    return query.order_by(models.Fila.horario_chegada.desc(), models.Fila.id.desc()).limit(limit).all()
+
+def _intervalo_dias(data_inicio: date, data_fim: date):
+    """
+    Converte um intervalo de dias (inclusivo) em [início, fim) de timestamps.
+    Filtrar a coluna diretamente, em vez de func.date(coluna), permite usar os índices.
+    """
+    return datetime.combine(data_inicio, time.min), datetime.combine(data_fim + timedelta(days=1), time.min)
 
 def calcular_metricas(db: Session):
-    """Calcula as métricas para o dashboard de interações."""
-    hoje = date.today()
-    clientes_na_fila = db.query(func.count(models.Fila.id)).filter(models.Fila.status == 'aguardando').scalar() or 0
-    desistencias_hoje = db.query(func.count(models.Fila.id)).filter(
-        models.Fila.status == 'cancelado',
-        func.date(models.Fila.horario_chegada) == hoje
-    ).scalar() or 0
-    
-    numero_promocoes = contar_total_promocoes(db)
-
-    return {
-        "clientes_na_fila": clientes_na_fila,
-        "desistencias_hoje": desistencias_hoje,
-        "numero_promocoes": numero_promocoes
-    }
+    """Métricas para o dashboard de interações, servidas do painel em memória (ver metricas.py)."""
+    return painel_metricas.obter(db)
 
 def contar_clientes_por_status_no_dia(db: Session, status: str, dia: date):
+    inicio, fim = _intervalo_dias(dia, dia)
     return db.query(func.count(models.Fila.id)).filter(
         models.Fila.status == status,
-        func.date(models.Fila.horario_chegada) == dia
+        models.Fila.horario_chegada >= inicio,
+        models.Fila.horario_chegada < fim
     ).scalar() or 0
 
 def contar_total_mesas(db: Session):
     return db.query(func.count(models.Mesa.id)).scalar() or 0
 
 def listar_clientes_do_dia(db: Session, dia: date):
+    inicio, fim = _intervalo_dias(dia, dia)
     return db.query(models.Fila).filter(
-        func.date(models.Fila.horario_chegada) == dia
+        models.Fila.horario_chegada >= inicio,
+        models.Fila.horario_chegada < fim
     ).order_by(models.Fila.horario_chegada).all()
 
 def listar_clientes_atendidos_no_dia(db: Session, dia: date):
+    inicio, fim = _intervalo_dias(dia, dia)
     return db.query(models.Fila).filter(
         models.Fila.status == 'atendido',
-        func.date(models.Fila.horario_chegada) == dia,
+        models.Fila.horario_chegada >= inicio,
+        models.Fila.horario_chegada < fim,
         models.Fila.horario_atendimento != None
     ).all()
     
@@ -204,28 +529,43 @@ def contar_total_promocoes(db: Session):
 
 def listar_clientes_da_semana(db: Session, hoje: date):
     """Busca a lista de todos os clientes que entraram na fila nos últimos 7 dias."""
-    data_inicio = hoje - timedelta(days=6)
-    return db.query(models.Fila).filter(
-        func.date(models.Fila.horario_chegada) >= data_inicio,
-        func.date(models.Fila.horario_chegada) <= hoje
-    ).order_by(models.Fila.horario_chegada).all()
+    return listar_clientes_por_periodo(db, data_inicio=hoje - timedelta(days=6), data_fim=hoje)
 
 def listar_clientes_por_periodo(db: Session, data_inicio: date, data_fim: date):
     """Busca a lista de todos os clientes que entraram na fila num período específico."""
+    inicio, fim = _intervalo_dias(data_inicio, data_fim)
     return db.query(models.Fila).filter(
-        func.date(models.Fila.horario_chegada) >= data_inicio,
-        func.date(models.Fila.horario_chegada) <= data_fim
+        models.Fila.horario_chegada >= inicio,
+        models.Fila.horario_chegada < fim
     ).order_by(models.Fila.horario_chegada).all()
 
+def obter_versao_clientes_por_periodo(db: Session, data_inicio: date, data_fim: date):
+    """
+    Versão dos dados da fila num período: (número de linhas, última alteração).
+    Qualquer entrada, alteração ou remoção no período muda este par.
+    """
+    inicio, fim = _intervalo_dias(data_inicio, data_fim)
+    total, ultima_alteracao = db.query(func.count(models.Fila.id), func.max(models.Fila.atualizado_em)).filter(
+        models.Fila.horario_chegada >= inicio,
+        models.Fila.horario_chegada < fim
+    ).one()
+    return total, ultima_alteracao
+
 # --- Funções CRUD para Garçons ---
 
 async def criar_garcon(db: Session, garcon: schemas.GarconCreate):
     """Cria um novo garçom no banco de dados."""
+    return await executar_no_banco(db, _criar_garcon, garcon)
+
+def _criar_garcon(db: Session, garcon: schemas.GarconCreate):
     novo_garcon = models.Garcon(**garcon.model_dump())
     db.add(novo_garcon)
     db.commit()
     db.refresh(novo_garcon)
+    # Pode haver um resultado negativo em cache para este ID do Telegram
+    cache_garcons_por_telegram_id.invalidar(novo_garcon.telegram_id)
     add_notification(f"Garçom '{novo_garcon.nome}' foi adicionado ao sistema.")
+    publicar_evento("garcon", {"acao": "criado", "id": novo_garcon.id, "telegram_ids": [novo_garcon.telegram_id]})
     return novo_garcon
 
 def listar_garcons(db: Session):
@@ -238,24 +578,40 @@ def buscar_garcon_por_id(db: Session, garcon_id: int):
 
 async def atualizar_garcon(db: Session, garcon_id: int, dados_atualizacao: schemas.GarconUpdate):
     """Atualiza os dados de um garçom."""
+    return await executar_no_banco(db, _atualizar_garcon, garcon_id, dados_atualizacao)
+
+def _atualizar_garcon(db: Session, garcon_id: int, dados_atualizacao: schemas.GarconUpdate):
     garcon_db = buscar_garcon_por_id(db, garcon_id)
     if garcon_db:
+        telegram_id_anterior = garcon_db.telegram_id
         dados = dados_atualizacao.model_dump(exclude_unset=True)
         for campo, valor in dados.items():
             setattr(garcon_db, campo, valor)
         db.commit()
         db.refresh(garcon_db)
+        cache_garcons_por_telegram_id.invalidar(telegram_id_anterior)
+        cache_garcons_por_telegram_id.invalidar(garcon_db.telegram_id)
         add_notification(f"Dados do garçom '{garcon_db.nome}' foram atualizados.")
+        publicar_evento("garcon", {
+            "acao": "atualizado", "id": garcon_db.id,
+            "telegram_ids": sorted({telegram_id_anterior, garcon_db.telegram_id} - {None}),
+        })
     return garcon_db
 
 async def deletar_garcon(db: Session, garcon_id: int):
     """Deleta um garçom do sistema."""
+    return await executar_no_banco(db, _deletar_garcon, garcon_id)
+
+def _deletar_garcon(db: Session, garcon_id: int):
     garcon_db = buscar_garcon_por_id(db, garcon_id)
     if garcon_db:
         nome_garcon = garcon_db.nome
+        telegram_id = garcon_db.telegram_id
         db.delete(garcon_db)
         db.commit()
+        cache_garcons_por_telegram_id.invalidar(telegram_id)
         add_notification(f"Garçom '{nome_garcon}' foi removido do sistema.")
+        publicar_evento("garcon", {"acao": "deletado", "id": garcon_id, "telegram_ids": [telegram_id]})
     return garcon_db
 
 
@@ -266,6 +622,33 @@ def buscar_garcon_por_telegram_id(db: Session, telegram_id: str):
     """Busca um garçom pelo seu ID do Telegram."""
     return db.query(models.Garcon).filter(models.Garcon.telegram_id == telegram_id).first()
 
+# O bot consulta o remetente de cada mensagem recebida; quase sempre é alguém já visto.
+# Guarda também os IDs que não são de garçons (clientes). As escritas de garçons invalidam
+# as entradas, neste processo e, pelos eventos 'garcon', nos outros; o prazo é só uma rede de segurança.
+cache_garcons_por_telegram_id = CacheTTL(capacidade=1000, ttl_segundos=300, ttl_negativo_segundos=60)
+
+def _invalidar_cache_garcons(evento: dict):
+    if evento["tipo"] != "garcon":
+        return
+    telegram_ids = evento["dados"].get("telegram_ids")
+    if telegram_ids is None:
+        cache_garcons_por_telegram_id.limpar()
+        return
+    for telegram_id in telegram_ids:
+        cache_garcons_por_telegram_id.invalidar(telegram_id)
+
+observar_eventos(_invalidar_cache_garcons)
+
+def buscar_garcon_por_telegram_id_em_cache(db: Session, telegram_id: str):
+    """Como buscar_garcon_por_telegram_id, mas devolve os dados do garçom (ou None) a partir do cache quando possível."""
+    dados = cache_garcons_por_telegram_id.obter(telegram_id)
+    if dados is not AUSENTE:
+        return dados
+    garcon = buscar_garcon_por_telegram_id(db, telegram_id)
+    dados = schemas.GarconOut.model_validate(garcon).model_dump() if garcon else None
+    cache_garcons_por_telegram_id.guardar(telegram_id, dados)
+    return dados
+
 
 
 
@@ -274,20 +657,28 @@ def buscar_garcon_por_telegram_id(db: Session, telegram_id: str):
 
 async def criar_promocao(db: Session, promocao: schemas.PromocaoCreate):
     """Cria uma nova promoção no banco de dados e notifica o grupo do Telegram."""
+    return await executar_no_banco(db, _criar_promocao, promocao)
+
+def _criar_promocao(db: Session, promocao: schemas.PromocaoCreate):
     nova_promocao = models.Promocao(**promocao.model_dump())
     db.add(nova_promocao)
+    # O flush atribui o id, usado na chave de idempotência da mensagem
+    db.flush()
+    # Só o negrito e o itálico são formatação; os textos da promoção são escapados
+    regras = nova_promocao.regras or 'N/A'
+    mensagem_telegram = (
+        f"*{escapar('Nova Promoção Ativa!')}*\n\n"
+        f"*{escapar(nova_promocao.nome)}*\n"
+        f"{escapar(nova_promocao.descricao)}\n\n"
+        f"_{escapar(f'Regras: {regras}')}_"
+    )
+    registar_mensagem_grupo(db, mensagem_telegram, chave=f"promocao:{nova_promocao.id}:criada", formatada=True)
+    painel_metricas.registar_promocao(db, 1)
     db.commit()
     db.refresh(nova_promocao)
+    entregador_telegram.acordar()
     add_notification(f"Promoção '{nova_promocao.nome}' foi criada.")
-    
-    mensagem_telegram = (
-        f"*Nova Promoção Ativa!*\n\n"
-        f"*{nova_promocao.nome}*\n"
-        f"{nova_promocao.descricao}\n\n"
-        f"_Regras: {nova_promocao.regras or 'N/A'}_"
-    )
-    await enviar_mensagem_para_grupo(mensagem_telegram)
-    
+    publicar_evento("promocao", {"acao": "criada", "id": nova_promocao.id})
     return nova_promocao
 
 def listar_promocoes(db: Session):
@@ -300,6 +691,9 @@ def buscar_promocao_por_id(db: Session, promocao_id: int):
 
 async def atualizar_promocao(db: Session, promocao_id: int, dados_atualizacao: schemas.PromocaoUpdate):
     """Atualiza os dados de uma promoção."""
+    return await executar_no_banco(db, _atualizar_promocao, promocao_id, dados_atualizacao)
+
+def _atualizar_promocao(db: Session, promocao_id: int, dados_atualizacao: schemas.PromocaoUpdate):
     promocao_db = buscar_promocao_por_id(db, promocao_id)
     if promocao_db:
         dados = dados_atualizacao.model_dump(exclude_unset=True)
@@ -308,28 +702,66 @@ async def atualizar_promocao(db: Session, promocao_id: int, dados_atualizacao: s
         db.commit()
         db.refresh(promocao_db)
         add_notification(f"Promoção '{promocao_db.nome}' foi atualizada.")
+        publicar_evento("promocao", {"acao": "atualizada", "id": promocao_db.id})
     return promocao_db
 
 async def deletar_promocao(db: Session, promocao_id: int):
     """Deleta uma promoção do sistema."""
+    return await executar_no_banco(db, _deletar_promocao, promocao_id)
+
+def _deletar_promocao(db: Session, promocao_id: int):
     promocao_db = buscar_promocao_por_id(db, promocao_id)
     if promocao_db:
         nome_promocao = promocao_db.nome
         db.delete(promocao_db)
+        painel_metricas.registar_promocao(db, -1)
         db.commit()
         add_notification(f"Promoção '{nome_promocao}' foi removida.")
+        publicar_evento("promocao", {"acao": "deletada", "id": promocao_id})
     return promocao_db
 
 # --- Funções CRUD para Mensagens ---
 
 async def criar_mensagem(db: Session, mensagem: schemas.MensagemCreate):
     """Cria uma nova mensagem no banco de dados."""
+    return await executar_no_banco(db, _criar_mensagem, mensagem)
+
+def _criar_mensagem(db: Session, mensagem: schemas.MensagemCreate):
     nova_mensagem = models.Mensagem(**mensagem.model_dump())
     db.add(nova_mensagem)
     db.commit()
     db.refresh(nova_mensagem)
+    publicar_evento("mensagem", {"id": nova_mensagem.id, "garcon_id": nova_mensagem.garcon_id, "direcao": nova_mensagem.direcao})
+    return nova_mensagem
+
+async def enviar_mensagem_a_garcon(db: Session, garcon: models.Garcon, texto: str):
+    """Guarda a mensagem do admin para um garçom e regista, na mesma transação, o envio privado e a cópia para o grupo."""
+    return await executar_no_banco(db, _enviar_mensagem_a_garcon, garcon.id, garcon.telegram_id, garcon.nome, texto)
+
+def _enviar_mensagem_a_garcon(db: Session, garcon_id: int, telegram_id: str, nome_garcon: str, texto: str):
+    nova_mensagem = models.Mensagem(texto=texto, direcao="enviada", garcon_id=garcon_id)
+    db.add(nova_mensagem)
+    db.flush()
+    registar_mensagem_privada(db, telegram_id, texto, chave=f"mensagem:{nova_mensagem.id}:privada")
+    registar_mensagem_grupo(db, f"*{escapar(f'(Admin para {nome_garcon})')}*: {escapar(texto)}",
+                            chave=f"mensagem:{nova_mensagem.id}:grupo", formatada=True)
+    db.commit()
+    db.refresh(nova_mensagem)
+    entregador_telegram.acordar()
+    publicar_evento("mensagem", {"id": nova_mensagem.id, "garcon_id": nova_mensagem.garcon_id, "direcao": nova_mensagem.direcao})
     return nova_mensagem
 
-def listar_mensagens_por_garcon(db: Session, garcon_id: int):
-    """Lista todas as mensagens de uma conversa com um garçom específico."""
-    return db.query(models.Mensagem).filter(models.Mensagem.garcon_id == garcon_id).order_by(models.Mensagem.timestamp).all()
\ No newline at end of file
+def listar_mensagens_por_garcon(db: Session, garcon_id: int, after_id: int = None, before_id: int = None, limit: int = 200):
+    """
+    Mensagens de uma conversa com um garçom, por ordem. Com after_id devolve as seguintes
+    a esse id (as novas); com before_id as `limit` anteriores (para ver o histórico);
+    sem nenhum, as `limit` mais recentes.
+    """
+    consulta = db.query(models.Mensagem).filter(models.Mensagem.garcon_id == garcon_id)
+    if after_id is not None:
+        return consulta.filter(models.Mensagem.id > after_id).order_by(models.Mensagem.id).limit(limit).all()
+    if before_id is not None:
+        consulta = consulta.filter(models.Mensagem.id < before_id)
+    mensagens = consulta.order_by(models.Mensagem.id.desc()).limit(limit).all()
+    mensagens.reverse()
+    return mensagens
\ No newline at end of file
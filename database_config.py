@@ -1,7 +1,14 @@
 import os
-from sqlalchemy import create_engine
+import asyncio
+import threading
+import time
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import NullPool
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from starlette.concurrency import run_in_threadpool
 from dotenv import load_dotenv
 
 # Carrega as variáveis de ambiente do arquivo .env
@@ -15,14 +22,204 @@ DB_NAME = os.getenv("DB_NAME")
 
 DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
-engine = create_engine(DATABASE_URL)
+# Como as rotas assíncronas acedem ao banco:
+#   'thread' (padrão) - Session síncrona executada no threadpool, fora do event loop;
+#   'async'           - AsyncSession com o driver asyncpg (requer o pacote asyncpg).
+DB_MODO_ACESSO = os.getenv("DB_MODO_ACESSO", "thread")
+ASYNC_DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+
+def _ler_flag(nome: str, padrao: str) -> bool:
+    return os.getenv(nome, padrao).strip().lower() in ("1", "true", "sim", "yes")
+
+# --- Configuração do pool de ligações ---
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = _ler_flag("DB_POOL_PRE_PING", "true")
+# Tempo máximo de cada comando no servidor (0 = sem limite)
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+# Com PgBouncer em modo transação, o pooling fica a cargo dele e não há prepared statements
+DB_PGBOUNCER = _ler_flag("DB_PGBOUNCER", "false")
+
+def opcoes_engine(assincrono: bool = False) -> dict:
+    """Monta os argumentos de create_engine/create_async_engine a partir da configuração."""
+    connect_args = {}
+    if DB_PGBOUNCER:
+        opcoes = {"poolclass": NullPool}
+        if assincrono:
+            # O asyncpg prepara statements por ligação, o que não funciona atrás do PgBouncer
+            connect_args["statement_cache_size"] = 0
+            connect_args["prepared_statement_cache_size"] = 0
+        # Parâmetros de arranque como statement_timeout são rejeitados pelo PgBouncer;
+        # nesse caso configure-o no papel do banco (ALTER ROLE ... SET statement_timeout).
+    else:
+        opcoes = {
+            "pool_size": DB_POOL_SIZE,
+            "max_overflow": DB_MAX_OVERFLOW,
+            "pool_timeout": DB_POOL_TIMEOUT,
+            "pool_recycle": DB_POOL_RECYCLE,
+            "pool_pre_ping": DB_POOL_PRE_PING,
+        }
+        if DB_STATEMENT_TIMEOUT_MS:
+            if assincrono:
+                connect_args["server_settings"] = {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}
+            else:
+                connect_args["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+    if connect_args:
+        opcoes["connect_args"] = connect_args
+    return opcoes
+
+
+class EstatisticasPool:
+    """Contadores de utilização do pool, alimentados pelos eventos do SQLAlchemy e pelo get_db."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ligacoes_abertas = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.invalidacoes = 0
+        self.timeouts = 0
+        self.em_uso = 0
+        self.maximo_em_uso = 0
+        self.esperas = 0
+        self.espera_total_segundos = 0.0
+        self.espera_maxima_segundos = 0.0
+
+    def observar(self, engine_alvo):
+        """Regista os listeners de eventos no pool de um engine."""
+        event.listen(engine_alvo, "connect", self._ao_conectar)
+        event.listen(engine_alvo, "checkout", self._ao_checkout)
+        event.listen(engine_alvo, "checkin", self._ao_checkin)
+        event.listen(engine_alvo, "invalidate", self._ao_invalidar)
+
+    def registar_espera(self, segundos: float):
+        with self._lock:
+            self.esperas += 1
+            self.espera_total_segundos += segundos
+            self.espera_maxima_segundos = max(self.espera_maxima_segundos, segundos)
+
+    def registar_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def resumo(self, engine_alvo) -> dict:
+        pool = engine_alvo.pool
+        with self._lock:
+            dados = {
+                "pool": type(pool).__name__,
+                "pgbouncer": DB_PGBOUNCER,
+                "ligacoes_abertas": self.ligacoes_abertas,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "invalidacoes": self.invalidacoes,
+                "timeouts": self.timeouts,
+                "em_uso": self.em_uso,
+                "maximo_em_uso": self.maximo_em_uso,
+                "espera_media_ms": round(self.espera_total_segundos / self.esperas * 1000, 3) if self.esperas else 0.0,
+                "espera_maxima_ms": round(self.espera_maxima_segundos * 1000, 3),
+            }
+        # Só o QueuePool tem tamanho e overflow
+        if hasattr(pool, "size") and hasattr(pool, "overflow"):
+            dados.update({
+                "tamanho": pool.size(),
+                "max_overflow": DB_MAX_OVERFLOW,
+                "livres": pool.checkedin(),
+                "overflow_atual": pool.overflow(),
+            })
+        return dados
+
+    def _ao_conectar(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.ligacoes_abertas += 1
+
+    def _ao_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+            self.em_uso += 1
+            self.maximo_em_uso = max(self.maximo_em_uso, self.em_uso)
+
+    def _ao_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.checkins += 1
+            self.em_uso = max(self.em_uso - 1, 0)
+
+    def _ao_invalidar(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidacoes += 1
+
+
+engine = create_engine(DATABASE_URL, **opcoes_engine())
+estatisticas_pool = EstatisticasPool()
+estatisticas_pool.observar(engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+async_engine = None
+AsyncSessionLocal = None
+if DB_MODO_ACESSO == "async":
+    async_engine = create_async_engine(ASYNC_DATABASE_URL, **opcoes_engine(assincrono=True))
+    estatisticas_pool.observar(async_engine.sync_engine)
+    # Sem expirar no commit: os objetos devolvidos às rotas não podem fazer lazy load fora do greenlet
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+elif DB_MODO_ACESSO != "thread":
+    raise ValueError(f"DB_MODO_ACESSO inválido: {DB_MODO_ACESSO} (use 'thread' ou 'async')")
+
+def _obter_ligacao(db):
+    """Obtém já a ligação da sessão, medindo quanto tempo se esperou por ela no pool."""
+    inicio = time.perf_counter()
+    try:
+        db.connection()
+    except PoolTimeoutError:
+        estatisticas_pool.registar_timeout()
+        raise
+    estatisticas_pool.registar_espera(time.perf_counter() - inicio)
+
 # Função para obter uma sessão do banco de dados
 def get_db():
+    db = SessionLocal()
+    try:
+        _obter_ligacao(db)
+        yield db
+    finally:
+        db.close()
+
+def get_db_sob_demanda():
+    """Sessão que só vai buscar uma ligação ao pool se for usada (rotas que respondem muitas vezes a partir de cache)."""
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+async def get_async_db():
+    """Sessão para as rotas assíncronas: AsyncSession no modo 'async', Session síncrona no modo 'thread'."""
+    if AsyncSessionLocal is not None:
+        async with AsyncSessionLocal() as db:
+            yield db
+        return
+
+    db = SessionLocal()
+    try:
+        await asyncio.to_thread(_obter_ligacao, db)
+        yield db
+    finally:
+        # O close faz rollback no servidor; também não deve bloquear o event loop
+        await asyncio.to_thread(db.close)
+
+async def executar_no_banco(db, funcao, *args, **kwargs):
+    """
+    Executa uma função síncrona do crud (que recebe a Session como primeiro argumento)
+    sem bloquear o event loop: via run_sync numa AsyncSession ou no threadpool numa Session.
+    """
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(funcao, *args, **kwargs)
+    return await run_in_threadpool(funcao, db, *args, **kwargs)
+
+async def libertar_sessao(db):
+    """Devolve já a ligação da sessão ao pool (ex.: antes de um trabalho demorado que não usa o banco)."""
+    if isinstance(db, AsyncSession):
+        await db.close()
+    else:
+        await run_in_threadpool(db.close)
@@ -0,0 +1,228 @@
+# back/estatisticas.py
+
+import argparse
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+
+from sqlalchemy import func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+import models
+
+# Colunas somáveis de EstatisticaDiaria
+CONTADORES = (
+    "chegadas", "atendidos", "cancelados", "espera_total_segundos",
+    "espera_ate_10", "espera_10_20", "espera_20_30", "espera_30_60", "espera_mais_60",
+    "grupos_1_2", "grupos_3_4", "grupos_5_6", "grupos_7_mais",
+)
+
+# Baldes do histograma de espera: (coluna, limite inferior em minutos, limite superior)
+BALDES_ESPERA = (
+    ("espera_ate_10", 0, 10),
+    ("espera_10_20", 10, 20),
+    ("espera_20_30", 20, 30),
+    ("espera_30_60", 30, 60),
+    ("espera_mais_60", 60, None),
+)
+
+
+def hoje() -> date:
+    """
+    Dia de hoje no mesmo relógio dos horários guardados (datetime.utcnow): os dias das
+    estatísticas, dos relatórios e das métricas são todos dias em UTC.
+    """
+    return datetime.utcnow().date()
+
+def _balde_espera(segundos: float) -> str:
+    minutos = segundos / 60
+    for coluna, _, limite in BALDES_ESPERA:
+        if limite is None or minutos < limite:
+            return coluna
+
+def _balde_grupo(tamanho_grupo: int) -> str:
+    if tamanho_grupo <= 2:
+        return "grupos_1_2"
+    if tamanho_grupo <= 4:
+        return "grupos_3_4"
+    if tamanho_grupo <= 6:
+        return "grupos_5_6"
+    return "grupos_7_mais"
+
+def _contribuicao_status(status: str, horario_chegada, horario_atendimento) -> dict:
+    """O que um cliente neste status soma aos contadores do seu dia/hora de chegada."""
+    if status == "cancelado":
+        return {"cancelados": 1}
+    if status == "atendido" and horario_atendimento:
+        espera = (horario_atendimento - horario_chegada).total_seconds()
+        return {"atendidos": 1, "espera_total_segundos": espera, _balde_espera(espera): 1}
+    return {}
+
+
+# --- Manutenção incremental (dentro da transação de quem chama) ---
+
+def _aplicar(db: Session, dia: date, hora: int, deltas: dict):
+    """Soma os deltas à linha (dia, hora), criando-a se ainda não existir, numa única instrução."""
+    deltas = {coluna: valor for coluna, valor in deltas.items() if valor}
+    if not deltas:
+        return
+    tabela = models.EstatisticaDiaria.__table__
+    valores = {"dia": dia, "hora": hora, **{coluna: 0 for coluna in CONTADORES}, **deltas}
+    dialeto = db.get_bind().dialect.name
+    if dialeto in ("postgresql", "sqlite"):
+        insert = postgresql.insert if dialeto == "postgresql" else sqlite.insert
+        instrucao = insert(tabela).values(**valores)
+        instrucao = instrucao.on_conflict_do_update(
+            index_elements=["dia", "hora"],
+            set_={
+                **{coluna: tabela.c[coluna] + instrucao.excluded[coluna] for coluna in deltas},
+                "atualizado_em": datetime.utcnow(),
+            },
+        )
+        db.execute(instrucao)
+        return
+
+    atualizadas = db.query(models.EstatisticaDiaria).filter(
+        models.EstatisticaDiaria.dia == dia,
+        models.EstatisticaDiaria.hora == hora
+    ).update({
+        getattr(models.EstatisticaDiaria, coluna): getattr(models.EstatisticaDiaria, coluna) + valor
+        for coluna, valor in deltas.items()
+    } | {models.EstatisticaDiaria.atualizado_em: datetime.utcnow()}, synchronize_session=False)
+    if not atualizadas:
+        db.add(models.EstatisticaDiaria(**valores))
+        db.flush()
+
+def registar_chegada(db: Session, cliente: models.Fila):
+    """Conta a entrada de um cliente na fila (o horário de chegada já tem de estar preenchido)."""
+    chegada = cliente.horario_chegada
+    deltas = {"chegadas": 1, _balde_grupo(cliente.tamanho_grupo): 1}
+    for coluna, valor in _contribuicao_status(cliente.status, chegada, cliente.horario_atendimento).items():
+        deltas[coluna] = deltas.get(coluna, 0) + valor
+    _aplicar(db, chegada.date(), chegada.hour, deltas)
+
+def registar_mudanca_status(db: Session, cliente: models.Fila, status_anterior: str, horario_atendimento_anterior,
+                            tamanho_grupo_anterior: int = None):
+    """
+    Troca a contribuição do status anterior pela do status atual do cliente e, se o tamanho
+    do grupo mudou, passa-o do balde de grupo antigo para o novo.
+    """
+    chegada = cliente.horario_chegada
+    antes = _contribuicao_status(status_anterior, chegada, horario_atendimento_anterior)
+    depois = _contribuicao_status(cliente.status, chegada, cliente.horario_atendimento)
+    if tamanho_grupo_anterior is not None:
+        antes[_balde_grupo(tamanho_grupo_anterior)] = antes.get(_balde_grupo(tamanho_grupo_anterior), 0) + 1
+        depois[_balde_grupo(cliente.tamanho_grupo)] = depois.get(_balde_grupo(cliente.tamanho_grupo), 0) + 1
+    deltas = {coluna: depois.get(coluna, 0) - antes.get(coluna, 0) for coluna in set(antes) | set(depois)}
+    _aplicar(db, chegada.date(), chegada.hour, deltas)
+
+
+# --- Consultas ---
+
+def _somar(db: Session, data_inicio: date, data_fim: date, agrupar_por: tuple = ()):
+    colunas = [getattr(models.EstatisticaDiaria, c) for c in agrupar_por]
+    somas = [func.coalesce(func.sum(getattr(models.EstatisticaDiaria, c)), 0).label(c) for c in CONTADORES]
+    consulta = db.query(*colunas, *somas).filter(
+        models.EstatisticaDiaria.dia >= data_inicio,
+        models.EstatisticaDiaria.dia <= data_fim
+    )
+    if colunas:
+        consulta = consulta.group_by(*colunas).order_by(*colunas)
+    return consulta
+
+def versao_periodo(db: Session, data_inicio: date, data_fim: date):
+    """
+    Versão do resumo num período: (número de linhas, última escrita). Muda também quando
+    a reconstrução reescreve o período sem que nenhum cliente tenha mudado.
+    """
+    return db.query(func.count(), func.max(models.EstatisticaDiaria.atualizado_em)).filter(
+        models.EstatisticaDiaria.dia >= data_inicio,
+        models.EstatisticaDiaria.dia <= data_fim
+    ).one()
+
+def estimar_percentil_espera(totais: dict, percentil: float) -> int:
+    """Estima um percentil da espera (em minutos) a partir do histograma, interpolando dentro do balde."""
+    total = sum(totais[coluna] for coluna, _, _ in BALDES_ESPERA)
+    if not total:
+        return 0
+    alvo = percentil * total
+    acumulado = 0
+    for coluna, inferior, superior in BALDES_ESPERA:
+        quantidade = totais[coluna]
+        if quantidade and acumulado + quantidade >= alvo:
+            if superior is None:
+                return inferior
+            return round(inferior + (alvo - acumulado) / quantidade * (superior - inferior))
+        acumulado += quantidade
+    return BALDES_ESPERA[-1][1]
+
+def _completar(totais: dict) -> dict:
+    atendidos = totais["atendidos"]
+    totais["tempo_medio_espera"] = round(totais["espera_total_segundos"] / atendidos / 60) if atendidos else 0
+    totais["espera_p50"] = estimar_percentil_espera(totais, 0.5)
+    totais["espera_p90"] = estimar_percentil_espera(totais, 0.9)
+    return totais
+
+def resumo_periodo(db: Session, data_inicio: date, data_fim: date) -> dict:
+    """Totais do período (inclusivo), com tempo médio e percentis estimados da espera em minutos."""
+    linha = _somar(db, data_inicio, data_fim).one()
+    return _completar({coluna: linha._mapping[coluna] for coluna in CONTADORES})
+
+def resumo_por_dia(db: Session, data_inicio: date, data_fim: date) -> list:
+    """Totais de cada dia do período que teve movimento, por ordem."""
+    return [
+        _completar({"dia": linha.dia, **{coluna: linha._mapping[coluna] for coluna in CONTADORES}})
+        for linha in _somar(db, data_inicio, data_fim, ("dia",))
+    ]
+
+def resumo_por_hora(db: Session, data_inicio: date, data_fim: date) -> list:
+    """Totais por hora do dia (somando todos os dias do período), por ordem."""
+    return [
+        _completar({"hora": linha.hora, **{coluna: linha._mapping[coluna] for coluna in CONTADORES}})
+        for linha in _somar(db, data_inicio, data_fim, ("hora",))
+    ]
+
+
+# --- Reconstrução a partir da tabela fila ---
+
+def reconstruir(db: Session, data_inicio: date = None, data_fim: date = None) -> int:
+    """
+    Recalcula o resumo a partir das linhas da fila (todas, ou só as do período).
+    Usado para preencher a tabela pela primeira vez ou corrigir divergências.
+    Devolve o número de linhas (dia, hora) escritas.
+    """
+    consulta = db.query(
+        models.Fila.tamanho_grupo, models.Fila.status, models.Fila.horario_chegada, models.Fila.horario_atendimento
+    ).filter(models.Fila.horario_chegada != None)
+    apagar = db.query(models.EstatisticaDiaria)
+    if data_inicio is not None:
+        consulta = consulta.filter(models.Fila.horario_chegada >= datetime.combine(data_inicio, time.min))
+        apagar = apagar.filter(models.EstatisticaDiaria.dia >= data_inicio)
+    if data_fim is not None:
+        consulta = consulta.filter(models.Fila.horario_chegada < datetime.combine(data_fim + timedelta(days=1), time.min))
+        apagar = apagar.filter(models.EstatisticaDiaria.dia <= data_fim)
+
+    linhas = defaultdict(lambda: dict.fromkeys(CONTADORES, 0))
+    for tamanho_grupo, status, horario_chegada, horario_atendimento in consulta.yield_per(1000):
+        totais = linhas[(horario_chegada.date(), horario_chegada.hour)]
+        totais["chegadas"] += 1
+        totais[_balde_grupo(tamanho_grupo)] += 1
+        for coluna, valor in _contribuicao_status(status, horario_chegada, horario_atendimento).items():
+            totais[coluna] += valor
+
+    apagar.delete(synchronize_session=False)
+    db.add_all(models.EstatisticaDiaria(dia=dia, hora=hora, **totais) for (dia, hora), totais in linhas.items())
+    db.commit()
+    return len(linhas)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconstrói a tabela estatisticas_diarias a partir da fila.")
+    parser.add_argument("--desde", type=date.fromisoformat, help="primeiro dia (AAAA-MM-DD); por omissão, desde o início")
+    parser.add_argument("--ate", type=date.fromisoformat, help="último dia (AAAA-MM-DD); por omissão, até hoje")
+    argumentos = parser.parse_args()
+
+    from database_config import SessionLocal
+    with SessionLocal() as sessao:
+        total = reconstruir(sessao, argumentos.desde, argumentos.ate)
+    print(f"Estatísticas reconstruídas: {total} linha(s) por dia/hora.")
@@ -0,0 +1,152 @@
+# back/exportacoes.py
+
+import csv
+import io
+import tempfile
+from datetime import date, datetime
+
+from sqlalchemy import select
+
+import crud
+import models
+
+try:  # o formato Parquet é opcional: só existe se o pyarrow estiver instalado
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Linhas lidas do banco (e escritas no CSV) de cada vez
+TAMANHO_BLOCO_EXPORTACAO = 1000
+
+
+def _espera_minutos(linha):
+    chegada, atendimento = linha[3], linha[4]
+    return round((atendimento - chegada).total_seconds() / 60, 1)
+
+# O que cada exportação contém: colunas do CSV, consulta e a coluna de data que define o período.
+# As colunas "calculadas" são (título, função sobre a linha lida) e vão no fim de cada linha.
+EXPORTACOES = {
+    "fila": {
+        "colunas": ["id", "nome_cliente", "tamanho_grupo", "status", "horario_chegada", "horario_atendimento"],
+        "consulta": lambda: select(
+            models.Fila.id, models.Fila.nome_cliente, models.Fila.tamanho_grupo, models.Fila.status,
+            models.Fila.horario_chegada, models.Fila.horario_atendimento
+        ),
+        "data": models.Fila.horario_chegada,
+    },
+    "mensagens": {
+        "colunas": ["id", "garcon_id", "garcon", "direcao", "timestamp", "texto"],
+        "consulta": lambda: select(
+            models.Mensagem.id, models.Mensagem.garcon_id, models.Garcon.nome, models.Mensagem.direcao,
+            models.Mensagem.timestamp, models.Mensagem.texto
+        ).outerjoin(models.Garcon, models.Garcon.id == models.Mensagem.garcon_id),
+        "data": models.Mensagem.timestamp,
+    },
+    # A fila não guarda a mesa de cada atendimento, só quando e quem foi sentado
+    "atendimentos": {
+        "colunas": ["fila_id", "nome_cliente", "tamanho_grupo", "horario_chegada", "horario_atendimento"],
+        "calculadas": [("espera_minutos", _espera_minutos)],
+        "consulta": lambda: select(
+            models.Fila.id, models.Fila.nome_cliente, models.Fila.tamanho_grupo,
+            models.Fila.horario_chegada, models.Fila.horario_atendimento
+        ).where(models.Fila.status == "atendido", models.Fila.horario_atendimento != None),
+        "data": models.Fila.horario_atendimento,
+    },
+}
+
+# Textos que o Excel/LibreOffice interpretariam como fórmula (nome_cliente e o texto das mensagens vêm de fora)
+_INICIO_FORMULA = ("=", "+", "-", "@", "\t", "\r")
+
+def _celula_csv(valor):
+    """Datas em ISO; textos que começam como uma fórmula ganham um apóstrofo à frente, para serem lidos como texto."""
+    if hasattr(valor, "isoformat"):
+        return valor.isoformat(sep=" ")
+    if isinstance(valor, str) and valor.startswith(_INICIO_FORMULA):
+        return "'" + valor
+    return valor
+
+def cabecalho(recurso: str) -> list:
+    definicao = EXPORTACOES[recurso]
+    return definicao["colunas"] + [titulo for titulo, _ in definicao.get("calculadas", [])]
+
+def parquet_disponivel() -> bool:
+    return pyarrow is not None
+
+def _esquema_parquet(recurso: str):
+    """Tipos das colunas Parquet a partir dos tipos das colunas da consulta (as calculadas são decimais)."""
+    definicao = EXPORTACOES[recurso]
+    tipos = []
+    for coluna in definicao["consulta"]().selected_columns:
+        tipo_python = coluna.type.python_type
+        if tipo_python is int:
+            tipos.append(pyarrow.int64())
+        elif tipo_python is datetime:
+            tipos.append(pyarrow.timestamp("us"))
+        else:
+            tipos.append(pyarrow.string())
+    tipos += [pyarrow.float64()] * len(definicao.get("calculadas", []))
+    return pyarrow.schema(list(zip(cabecalho(recurso), tipos)))
+
+
+class Exportador:
+    """
+    Exporta o histórico de um período em CSV (ou Parquet), lendo o banco em blocos com
+    um cursor do lado do servidor: o primeiro bloco sai logo e a memória usada não
+    depende do tamanho do período. Cada exportação usa uma sessão própria, que vive
+    enquanto a resposta está a ser enviada.
+    """
+
+    def __init__(self, session_factory=None, tamanho_bloco: int = TAMANHO_BLOCO_EXPORTACAO):
+        self.session_factory = session_factory
+        self.tamanho_bloco = tamanho_bloco
+
+    def _sessao(self):
+        if self.session_factory is None:
+            from database_config import SessionLocal
+            self.session_factory = SessionLocal
+        return self.session_factory()
+
+    def iterar_blocos(self, recurso: str, data_inicio: date, data_fim: date):
+        """Devolve listas de até tamanho_bloco linhas (tuplos), por ordem de id."""
+        definicao = EXPORTACOES[recurso]
+        inicio, fim = crud._intervalo_dias(data_inicio, data_fim)
+        consulta = definicao["consulta"]()
+        consulta = consulta.where(
+            definicao["data"] >= inicio,
+            definicao["data"] < fim
+        ).order_by(consulta.selected_columns[0]).execution_options(yield_per=self.tamanho_bloco)
+        calculadas = [funcao for _, funcao in definicao.get("calculadas", [])]
+        with self._sessao() as db:
+            for bloco in db.execute(consulta).partitions():
+                yield [tuple(linha) + tuple(funcao(linha) for funcao in calculadas) for linha in bloco]
+
+    def gerar_csv(self, recurso: str, data_inicio: date, data_fim: date):
+        """Gera o CSV em pedaços de bytes (UTF-8 com BOM, para abrir bem no Excel)."""
+        buffer = io.StringIO()
+        escritor = csv.writer(buffer)
+        buffer.write("\ufeff")
+        escritor.writerow(cabecalho(recurso))
+        yield buffer.getvalue().encode("utf-8")
+        for bloco in self.iterar_blocos(recurso, data_inicio, data_fim):
+            buffer.seek(0)
+            buffer.truncate()
+            escritor.writerows([_celula_csv(valor) for valor in linha] for linha in bloco)
+            yield buffer.getvalue().encode("utf-8")
+
+    def gerar_parquet(self, recurso: str, data_inicio: date, data_fim: date):
+        """
+        Gera um ficheiro Parquet com um row group por bloco. O formato só fica completo
+        no fim (o rodapé tem o índice), por isso é escrito num ficheiro temporário e
+        enviado depois, em pedaços.
+        """
+        esquema = _esquema_parquet(recurso)
+        with tempfile.TemporaryFile() as ficheiro:
+            with pyarrow.parquet.ParquetWriter(ficheiro, esquema) as escritor:
+                for bloco in self.iterar_blocos(recurso, data_inicio, data_fim):
+                    escritor.write_table(pyarrow.Table.from_pylist([dict(zip(esquema.names, linha)) for linha in bloco], schema=esquema))
+            ficheiro.seek(0)
+            while pedaco := ficheiro.read(64 * 1024):
+                yield pedaco
+
+exportador = Exportador()
@@ -0,0 +1,248 @@
+# back/fila_espera.py
+
+import os
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from dataclasses import dataclass
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+import models
+from notification_manager import observar_eventos
+
+# De quanto em quanto tempo o índice é reconstruído a partir do banco, para apanhar
+# alterações que não passaram pelo crud deste processo
+FILA_RECONCILIACAO_SEGUNDOS = float(os.getenv("FILA_RECONCILIACAO_SEGUNDOS", "30"))
+
+# Chave em Session.info onde ficam as alterações à espera do commit
+_PENDENTES = "fila_pendentes"
+
+
+@dataclass(frozen=True)
+class ClienteEmEspera:
+    """Cópia dos campos de um cliente 'aguardando' (os de schemas.FilaOut)."""
+    id: int
+    nome_cliente: str
+    tamanho_grupo: int
+    horario_chegada: datetime
+    status: str = "aguardando"
+
+    @property
+    def chave(self):
+        return self.horario_chegada, self.id
+
+
+class IndiceFila:
+    """
+    Fila de espera (clientes 'aguardando') mantida em memória por ordem de chegada, com um
+    balde por tamanho de grupo para encontrar o primeiro grupo que cabe numa mesa sem
+    percorrer a fila toda. Como no painel de métricas, o crud regista as alterações na sessão
+    e elas só entram no índice depois do commit. O banco continua a ser a fonte da verdade:
+    o índice é reconstruído periodicamente e os clientes alterados por outros processos
+    (vistos pelos eventos) são relidos do banco antes da leitura seguinte.
+    """
+
+    def __init__(self, reconciliacao_segundos: float = FILA_RECONCILIACAO_SEGUNDOS, session_factory=None):
+        self.reconciliacao_segundos = reconciliacao_segundos
+        self.session_factory = session_factory
+        self._lock = threading.RLock()
+        self.carregado = False
+        self._carregado_em = 0.0
+        self._alteracoes = 0      # conta alterações aplicadas, para detetar as que chegam durante um carregamento
+        self._clientes = {}       # id -> ClienteEmEspera
+        self._ordem = []          # (horario_chegada, id) de todos, em ordem
+        self._tamanhos = []       # tamanhos de grupo presentes, em ordem crescente
+        self._baldes = {}         # tamanho -> lista ordenada de (horario_chegada, id)
+        self._desatualizados = set()  # ids a reler do banco antes da próxima leitura
+
+    def _sessao(self):
+        if self.session_factory is None:
+            from database_config import SessionLocal
+            return SessionLocal()
+        return self.session_factory()
+
+    # --- Carregamento e reconciliação ---
+
+    def carregar(self, db: Session):
+        """(Re)constrói o índice a partir dos clientes com status 'aguardando'."""
+        with self._lock:
+            alteracoes_antes = self._alteracoes
+        linhas = db.query(
+            models.Fila.id, models.Fila.nome_cliente, models.Fila.tamanho_grupo, models.Fila.horario_chegada
+        ).filter(models.Fila.status == 'aguardando').all()
+        with self._lock:
+            self._limpar()
+            for linha in linhas:
+                self._inserir(ClienteEmEspera(*linha))
+            self.carregado = True
+            # Commits durante a leitura podem ter ficado de fora: volta a carregar na próxima utilização
+            self._carregado_em = time.monotonic() if self._alteracoes == alteracoes_antes else 0.0
+
+    def carregar_no_arranque(self):
+        """Carrega o índice com uma sessão própria; se falhar, fica para a primeira utilização."""
+        try:
+            with self._sessao() as db:
+                self.carregar(db)
+        except Exception as e:
+            print(f"ERRO ao carregar a fila de espera: {e}")
+
+    def garantir_atual(self, db: Session):
+        """Recarrega se preciso (primeira utilização ou reconciliação) e relê os clientes desatualizados."""
+        with self._lock:
+            expirado = not self.carregado or time.monotonic() - self._carregado_em >= self.reconciliacao_segundos
+            ids = set() if expirado else set(self._desatualizados)
+            self._desatualizados.clear()
+        if expirado:
+            self.carregar(db)
+            return
+        if not ids:
+            return
+        linhas = db.query(
+            models.Fila.id, models.Fila.nome_cliente, models.Fila.tamanho_grupo, models.Fila.horario_chegada, models.Fila.status
+        ).filter(models.Fila.id.in_(ids)).all()
+        with self._lock:
+            for fila_id in ids:
+                self._remover(fila_id)
+            for fila_id, nome, tamanho, chegada, status in linhas:
+                if status == 'aguardando':
+                    self._inserir(ClienteEmEspera(fila_id, nome, tamanho, chegada))
+
+    def invalidar(self):
+        """Descarta o índice; será recarregado do banco na próxima utilização."""
+        with self._lock:
+            self._limpar()
+            self.carregado = False
+
+    def marcar_desatualizado(self, fila_id: int):
+        """Pede que o cliente seja relido do banco antes da próxima leitura."""
+        with self._lock:
+            self._desatualizados.add(fila_id)
+
+    def observar(self, evento: dict):
+        """
+        Eventos de 'fila' que não batem com o índice vêm de outro processo (os deste processo
+        já foram aplicados no commit, antes de serem publicados): esses clientes são relidos.
+        """
+        if evento["tipo"] != "fila":
+            return
+        dados = evento["dados"]
+        ids = dados.get("ids") or ([dados["id"]] if "id" in dados else [])
+        with self._lock:
+            if not self.carregado:
+                return
+            for fila_id in ids:
+                em_espera = fila_id in self._clientes
+                if dados.get("acao") == "entrada" and em_espera:
+                    continue
+                if dados.get("acao") == "atendido" and not em_espera:
+                    continue
+                if dados.get("acao") == "atualizado" and self._coincide(fila_id, dados):
+                    continue
+                self._desatualizados.add(fila_id)
+
+    def _coincide(self, fila_id: int, dados: dict) -> bool:
+        """Um evento 'atualizado' já refletido no índice (status, tamanho e nome iguais aos guardados)."""
+        cliente = self._clientes.get(fila_id)
+        if dados.get("status") != 'aguardando':
+            return cliente is None and "status" in dados
+        return cliente is not None and all(
+            dados.get(campo) == getattr(cliente, campo) for campo in ("tamanho_grupo", "nome_cliente")
+        )
+
+    # --- Leitura ---
+
+    def listar(self, db: Session, skip: int = 0, limit: int = 100, apos: tuple = None) -> list:
+        """
+        Clientes à espera por ordem de chegada (todos com limit=None); com apos=(horario_chegada, id),
+        a partir desse cliente.
+        """
+        self.garantir_atual(db)
+        with self._lock:
+            inicio = (bisect_right(self._ordem, apos) if apos is not None else 0) + skip
+            chaves = self._ordem[inicio:None if limit is None else inicio + limit]
+            return [self._clientes[fila_id] for _, fila_id in chaves]
+
+    def primeiro(self, db: Session, capacidade: int = None, ignorar: set = frozenset()):
+        """
+        Id do primeiro cliente à espera, ou do primeiro cujo grupo cabe em `capacidade` lugares:
+        compara só a cabeça de cada balde de tamanho até à capacidade.
+        """
+        self.garantir_atual(db)
+        with self._lock:
+            if capacidade is None:
+                return next((fila_id for _, fila_id in self._ordem if fila_id not in ignorar), None)
+            melhor = None
+            for tamanho in self._tamanhos[:bisect_right(self._tamanhos, capacidade)]:
+                chave = next((c for c in self._baldes[tamanho] if c[1] not in ignorar), None)
+                if chave is not None and (melhor is None or chave < melhor):
+                    melhor = chave
+            return melhor[1] if melhor else None
+
+    # --- Alterações (dentro da transação de quem chama) ---
+
+    def registar(self, db: Session, cliente: models.Fila):
+        """Regista o estado atual do cliente, aplicado ao índice depois do commit."""
+        pendentes = db.info.setdefault(_PENDENTES, {})
+        pendentes[cliente.id] = ClienteEmEspera(
+            cliente.id, cliente.nome_cliente, cliente.tamanho_grupo, cliente.horario_chegada
+        ) if cliente.status == 'aguardando' else None
+
+    def _aplicar(self, pendentes: dict):
+        with self._lock:
+            self._alteracoes += 1
+            if not self.carregado:
+                return
+            for fila_id, cliente in pendentes.items():
+                self._remover(fila_id)
+                if cliente is not None:
+                    self._inserir(cliente)
+
+    # --- Estruturas internas ---
+
+    def _limpar(self):
+        self._clientes = {}
+        self._ordem = []
+        self._tamanhos = []
+        self._baldes = {}
+        self._desatualizados = set()
+
+    def _inserir(self, cliente: ClienteEmEspera):
+        if cliente.id in self._clientes:
+            self._remover(cliente.id)
+        self._clientes[cliente.id] = cliente
+        insort(self._ordem, cliente.chave)
+        balde = self._baldes.get(cliente.tamanho_grupo)
+        if balde is None:
+            balde = self._baldes[cliente.tamanho_grupo] = []
+            insort(self._tamanhos, cliente.tamanho_grupo)
+        insort(balde, cliente.chave)
+
+    def _remover(self, fila_id: int):
+        cliente = self._clientes.pop(fila_id, None)
+        if cliente is None:
+            return
+        del self._ordem[bisect_left(self._ordem, cliente.chave)]
+        balde = self._baldes[cliente.tamanho_grupo]
+        del balde[bisect_left(balde, cliente.chave)]
+        if not balde:
+            del self._baldes[cliente.tamanho_grupo]
+            self._tamanhos.remove(cliente.tamanho_grupo)
+
+
+# Instância única partilhada pelo processo
+indice_fila = IndiceFila()
+observar_eventos(indice_fila.observar)
+
+
+@event.listens_for(Session, "after_commit")
+def _aplicar_depois_do_commit(db: Session):
+    pendentes = db.info.pop(_PENDENTES, None)
+    if pendentes:
+        indice_fila._aplicar(pendentes)
+
+@event.listens_for(Session, "after_rollback")
+def _descartar_depois_do_rollback(db: Session):
+    db.info.pop(_PENDENTES, None)
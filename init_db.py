@@ -1,7 +1,8 @@
 # back/init_db.py
 
+from sqlalchemy import inspect, text
 from database_config import Base, engine
-from models import Mesa, Fila, Garcon, Promocao, Mensagem 
+from models import Mesa, Fila, EstatisticaDiaria, Garcon, Promocao, Mensagem, MensagemOutbox, EventoNotificacao, TrabalhoRelatorio
 
 def create_tables():
     """
@@ -11,5 +12,38 @@ def create_tables():
     Base.metadata.create_all(bind=engine)
     print("Tabelas verificadas/criadas com sucesso!")
 
+def add_missing_columns():
+    """
+    Acrescenta às tabelas já existentes as colunas declaradas nos modelos que ainda
+    não existem no banco (ex.: fila.atualizado_em). As linhas antigas ficam com NULL.
+    """
+    print("A verificar/criar colunas em falta no banco de dados...")
+    inspetor = inspect(engine)
+    with engine.begin() as conexao:
+        for tabela in Base.metadata.sorted_tables:
+            if not inspetor.has_table(tabela.name):
+                continue
+            existentes = {coluna["name"] for coluna in inspetor.get_columns(tabela.name)}
+            for coluna in tabela.columns:
+                if coluna.name not in existentes:
+                    tipo = coluna.type.compile(dialect=engine.dialect)
+                    conexao.execute(text(f'ALTER TABLE {tabela.name} ADD COLUMN {coluna.name} {tipo}'))
+                    print(f"Coluna {tabela.name}.{coluna.name} criada.")
+    print("Colunas verificadas/criadas com sucesso!")
+
+def create_indexes():
+    """
+    Cria os índices que ainda não existem em tabelas já existentes.
+    O create_all ignora tabelas que já existem, por isso bancos criados antes
+    de um novo índice ser declarado nos modelos precisam deste passo.
+    """
+    print("A verificar/criar índices no banco de dados...")
+    for tabela in Base.metadata.sorted_tables:
+        for indice in tabela.indexes:
+            indice.create(bind=engine, checkfirst=True)
+    print("Índices verificados/criados com sucesso!")
+
 if __name__ == "__main__":
-    create_tables()
\ No newline at end of file
+    create_tables()
+    add_missing_columns()
+    create_indexes()
\ No newline at end of file
@@ -23,12 +23,19 @@
 
 
 
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
+import asyncio
 import os
 
 
 import routes
+import notification_manager
+from telegram_sender import entregador_telegram
+from relatorios_jobs import gestor_relatorios
+from agendador_relatorios import agendador_relatorios
+from fila_espera import indice_fila
 
 
 # Descobre o caminho absoluto para a pasta 'back' 
@@ -42,11 +49,32 @@ front_dir = os.path.join(current_dir, "..", "front")
 
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Arranca e encerra as tarefas de fundo da aplicação."""
+    notification_manager.add_notification("Sistema iniciado. Bem-vindo!")
+    if int(os.getenv("WEB_CONCURRENCY", "1")) > 1 and not gestor_relatorios.armazem.partilhado:
+        print("AVISO: vários workers com RELATORIOS_JOBS_BACKEND=memoria: o estado e o download de um "
+              "trabalho de relatório só respondem no worker que o criou. Use RELATORIOS_JOBS_BACKEND=banco.")
+    # A fila de espera é servida da memória: carrega-a já, em vez de no primeiro pedido
+    await asyncio.to_thread(indice_fila.carregar_no_arranque)
+    tarefa_eventos = asyncio.create_task(notification_manager.distribuir_eventos_de_outros_processos())
+    await entregador_telegram.iniciar()
+    agendador_relatorios.iniciar()
+    yield
+    tarefa_eventos.cancel()
+    await agendador_relatorios.parar()
+    await entregador_telegram.parar()
+    gestor_relatorios.parar()
+    await asyncio.to_thread(notification_manager.descarregar_eventos)
+
+
 # Cria a aplicação principal
 app = FastAPI(
     title="MesaJa API",
     description="API para gerenciamento de fila de restaurante.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Monta um caminho para servir arquivos estáticos usando o caminho absoluto
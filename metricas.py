@@ -0,0 +1,109 @@
+# back/metricas.py
+
+import os
+import threading
+import time
+
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+
+import estatisticas
+import models
+
+# De quanto em quanto tempo o painel é recalculado no banco, para apanhar alterações
+# feitas por outros processos (ou qualquer divergência)
+METRICAS_RECONCILIACAO_SEGUNDOS = float(os.getenv("METRICAS_RECONCILIACAO_SEGUNDOS", "30"))
+
+# Chave em Session.info onde ficam as alterações à espera do commit
+_PENDENTES = "metricas_pendentes"
+
+
+class PainelMetricas:
+    """
+    Métricas do dashboard (clientes na fila, desistências de hoje e promoções) mantidas
+    em memória. As funções do crud registam as alterações na sessão e estas só são
+    aplicadas ao painel depois do commit; um rollback descarta-as. O painel é
+    recalculado no banco na primeira utilização, ao mudar o dia e periodicamente.
+    """
+
+    def __init__(self, reconciliacao_segundos: float = METRICAS_RECONCILIACAO_SEGUNDOS):
+        self.reconciliacao_segundos = reconciliacao_segundos
+        self._lock = threading.Lock()
+        self._valores = None
+        self._dia = None
+        self._carregado_em = 0.0
+        self._alteracoes = 0  # conta alterações aplicadas, para detetar as que chegam durante um carregamento
+
+    # --- Leitura ---
+
+    def obter(self, db: Session) -> dict:
+        """Devolve as métricas a partir da memória, recalculando-as no banco só quando preciso."""
+        with self._lock:
+            if (self._valores is not None and self._dia == estatisticas.hoje()
+                    and time.monotonic() - self._carregado_em < self.reconciliacao_segundos):
+                return dict(self._valores)
+        return self.carregar(db)
+
+    def carregar(self, db: Session) -> dict:
+        """Recalcula as métricas no banco e substitui o painel."""
+        with self._lock:
+            alteracoes_antes = self._alteracoes
+        hoje = estatisticas.hoje()
+        valores = {
+            "clientes_na_fila": db.query(func.count(models.Fila.id)).filter(models.Fila.status == 'aguardando').scalar() or 0,
+            "desistencias_hoje": estatisticas.resumo_periodo(db, hoje, hoje)["cancelados"],
+            "numero_promocoes": db.query(func.count(models.Promocao.id)).scalar() or 0,
+        }
+        with self._lock:
+            self._valores, self._dia = valores, hoje
+            # Se houve commits durante a contagem eles podem ter ficado contados duas vezes: volta a contar na próxima
+            self._carregado_em = time.monotonic() if self._alteracoes == alteracoes_antes else 0.0
+        return dict(valores)
+
+    def invalidar(self):
+        with self._lock:
+            self._valores = None
+            self._dia = None
+
+    # --- Alterações (dentro da transação de quem chama) ---
+
+    def _registar(self, db: Session, metrica: str, delta: int):
+        pendentes = db.info.setdefault(_PENDENTES, {})
+        pendentes[metrica] = pendentes.get(metrica, 0) + delta
+
+    def registar_chegada(self, db: Session, cliente: models.Fila):
+        if cliente.status == 'aguardando':
+            self._registar(db, "clientes_na_fila", 1)
+
+    def registar_mudanca_status(self, db: Session, cliente: models.Fila, status_anterior: str):
+        if status_anterior == cliente.status:
+            return
+        if 'aguardando' in (status_anterior, cliente.status):
+            self._registar(db, "clientes_na_fila", 1 if cliente.status == 'aguardando' else -1)
+        # As desistências contam no dia de chegada do cliente, como nas estatísticas
+        if 'cancelado' in (status_anterior, cliente.status) and cliente.horario_chegada.date() == estatisticas.hoje():
+            self._registar(db, "desistencias_hoje", 1 if cliente.status == 'cancelado' else -1)
+
+    def registar_promocao(self, db: Session, delta: int):
+        self._registar(db, "numero_promocoes", delta)
+
+    def _aplicar(self, pendentes: dict):
+        with self._lock:
+            self._alteracoes += 1
+            if self._valores is None or self._dia != estatisticas.hoje():
+                return
+            for metrica, delta in pendentes.items():
+                self._valores[metrica] = max(self._valores[metrica] + delta, 0)
+
+painel_metricas = PainelMetricas()
+
+
+@event.listens_for(Session, "after_commit")
+def _aplicar_depois_do_commit(db: Session):
+    pendentes = db.info.pop(_PENDENTES, None)
+    if pendentes:
+        painel_metricas._aplicar(pendentes)
+
+@event.listens_for(Session, "after_rollback")
+def _descartar_depois_do_rollback(db: Session):
+    db.info.pop(_PENDENTES, None)
@@ -1,6 +1,6 @@
 # back/models.py
 
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, Float, String, Text, Boolean, Date, DateTime, ForeignKey, Index, LargeBinary, text
 from sqlalchemy.orm import relationship
 from database_config import Base
 from datetime import datetime
@@ -21,8 +21,52 @@ class Fila(Base):
     status = Column(String, default="aguardando")
     horario_chegada = Column(DateTime, default=datetime.utcnow)
     horario_atendimento = Column(DateTime, nullable=True)
+    # Última alteração da linha: junto com a contagem, identifica a versão dos dados de um período
+    atualizado_em = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        # Relatórios por período e contagens por status no dia
+        Index("ix_fila_horario_chegada", "horario_chegada"),
+        Index("ix_fila_status_horario_chegada", "status", "horario_chegada"),
+        # Paginação por cursor do histórico (ordem estável mesmo com chegadas no mesmo instante)
+        Index("ix_fila_horario_chegada_id", "horario_chegada", "id"),
+        # Fila de espera atual: só as linhas 'aguardando', já ordenadas por chegada
+        Index(
+            "ix_fila_aguardando_horario_chegada", "horario_chegada",
+            postgresql_where=text("status = 'aguardando'"),
+            sqlite_where=text("status = 'aguardando'"),
+        ),
+    )
     
 
+class EstatisticaDiaria(Base):
+    """
+    Resumo da fila por dia e hora de chegada, mantido na mesma transação que as
+    entradas e mudanças de status. Os relatórios somam estas linhas em vez de ler
+    cada cliente. Reconstrua com: python estatisticas.py
+    """
+    __tablename__ = "estatisticas_diarias"
+    dia = Column(Date, primary_key=True)
+    hora = Column(Integer, primary_key=True)
+    chegadas = Column(Integer, nullable=False, default=0)
+    atendidos = Column(Integer, nullable=False, default=0)
+    cancelados = Column(Integer, nullable=False, default=0)
+    # Soma das esperas dos atendidos; a média é espera_total_segundos / atendidos
+    espera_total_segundos = Column(Float, nullable=False, default=0)
+    # Histograma das esperas dos atendidos (minutos), para estimar percentis
+    espera_ate_10 = Column(Integer, nullable=False, default=0)
+    espera_10_20 = Column(Integer, nullable=False, default=0)
+    espera_20_30 = Column(Integer, nullable=False, default=0)
+    espera_30_60 = Column(Integer, nullable=False, default=0)
+    espera_mais_60 = Column(Integer, nullable=False, default=0)
+    # Histograma do tamanho dos grupos que chegaram
+    grupos_1_2 = Column(Integer, nullable=False, default=0)
+    grupos_3_4 = Column(Integer, nullable=False, default=0)
+    grupos_5_6 = Column(Integer, nullable=False, default=0)
+    grupos_7_mais = Column(Integer, nullable=False, default=0)
+    # Última escrita na linha (incremental ou reconstrução); entra no ETag dos relatórios
+    atualizado_em = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
 class Garcon(Base):
     __tablename__ = "garcons"
     id = Column(Integer, primary_key=True, index=True)
@@ -46,4 +90,67 @@ class Mensagem(Base):
     timestamp = Column(DateTime, default=datetime.utcnow)
     direcao = Column(String, nullable=False) 
     garcon_id = Column(Integer, ForeignKey("garcons.id"))
-    garcon = relationship("Garcon", back_populates="mensagens")
\ No newline at end of file
+    garcon = relationship("Garcon", back_populates="mensagens")
+
+    __table_args__ = (
+        # Conversa de um garçom por ordem, e "mensagens depois/antes do id X" sem percorrer o histórico
+        Index("ix_mensagens_garcon_id_id", "garcon_id", "id"),
+    )
+
+class MensagemOutbox(Base):
+    """
+    Mensagem a enviar para o Telegram, gravada na mesma transação que a originou.
+    A chave de idempotência impede que a mesma mensagem lógica seja registada duas vezes.
+    """
+    __tablename__ = "outbox"
+    id = Column(Integer, primary_key=True, index=True)
+    chave_idempotencia = Column(String, unique=True, nullable=False)
+    chat_id = Column(String, nullable=False)
+    texto = Column(Text, nullable=False)
+    grupo = Column(Boolean, nullable=False, default=False)
+    # pendente -> enviando -> enviada | falhou
+    status = Column(String, nullable=False, default="pendente")
+    tentativas = Column(Integer, nullable=False, default=0)
+    proxima_tentativa = Column(DateTime, nullable=False, default=datetime.utcnow)
+    ultimo_erro = Column(String, nullable=True)
+    criado_em = Column(DateTime, default=datetime.utcnow)
+    enviada_em = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        # O entregador procura as mensagens prontas a (re)enviar
+        Index("ix_outbox_status_proxima_tentativa", "status", "proxima_tentativa"),
+    )
+
+class TrabalhoRelatorio(Base):
+    """
+    Trabalho de relatório em segundo plano (backend 'banco' do relatorios_jobs), visível
+    a todos os workers: o estado, o progresso e, quando concluído, o PDF.
+    """
+    __tablename__ = "trabalhos_relatorios"
+    id = Column(String, primary_key=True)
+    tipo = Column(String, nullable=False)
+    data_inicio = Column(Date, nullable=False)
+    data_fim = Column(Date, nullable=False)
+    # na_fila -> a_buscar_dados -> a_renderizar -> concluido | falhou
+    estado = Column(String, nullable=False)
+    progresso = Column(Integer, nullable=False, default=0)
+    # "tipo|início|fim" enquanto o trabalho está ativo, NULL depois: no máximo um ativo por relatório
+    chave_ativa = Column(String, unique=True, nullable=True)
+    criado_em = Column(DateTime, default=datetime.utcnow)
+    concluido_em = Column(DateTime, nullable=True)
+    erro = Column(Text, nullable=True)
+    nome_ficheiro = Column(String, nullable=True)
+    # Versão dos dados com que o PDF foi gerado (reports.calcular_etag)
+    etag = Column(String, nullable=True)
+    # Depois de terminar, o trabalho fica disponível durante validade_segundos (até expira_em)
+    validade_segundos = Column(Integer, nullable=False)
+    expira_em = Column(DateTime, nullable=True)
+    conteudo = Column(LargeBinary, nullable=True)
+
+class EventoNotificacao(Base):
+    """Anel de eventos partilhado entre processos (backend 'banco' do notification_manager)."""
+    __tablename__ = "eventos_notificacao"
+    seq = Column(Integer, primary_key=True, autoincrement=True)
+    tipo = Column(String, nullable=False)
+    dados = Column(Text, nullable=False)
+    criado_em = Column(DateTime, default=datetime.utcnow)
@@ -1,20 +1,294 @@
-
-
+import asyncio
+import json
+import os
+import queue
+import threading
 from collections import deque
 from datetime import datetime
 
-# Usamos um 'deque' com um tamanho máximo. Ele automaticamente remove
-# o item mais antigo quando um novo é adicionado e a lista está cheia.
-notifications = deque(maxlen=5)
+# Quantas notificações de texto são mostradas no painel
+TOTAL_NOTIFICACOES_VISIVEIS = 5
+
+# Quantos eventos o anel guarda para quem pede "tudo depois do seq N"
+CAPACIDADE_ANEL_EVENTOS = int(os.getenv("NOTIFICACOES_CAPACIDADE", "1000"))
+
+# Intervalo com que cada processo procura eventos publicados pelos outros (backend 'banco')
+INTERVALO_SONDAGEM_SEGUNDOS = float(os.getenv("NOTIFICACOES_INTERVALO_SONDAGEM", "0.5"))
+
+# Quantos eventos um assinante lento pode acumular antes de começar a perdê-los
+TAMANHO_MAXIMO_FILA_ASSINANTE = 100
+
+# Máximo de eventos gravados numa só transação pelo escritor do backend 'banco'
+TAMANHO_LOTE_ESCRITA_EVENTOS = 100
+
+
+# --- Backends de armazenamento dos eventos ---
+
+class BackendNotificacoesMemoria:
+    """
+    Anel de eventos dentro do próprio processo. Serve para testes e para correr
+    com um único worker; cada processo tem a sua própria sequência.
+    """
+    distribui_localmente = True
+
+    def __init__(self, capacidade: int = CAPACIDADE_ANEL_EVENTOS):
+        self._eventos = deque(maxlen=capacidade)
+        self._ultimo_seq = 0
+        self._lock = threading.Lock()
+
+    def publicar(self, tipo: str, dados: dict) -> dict:
+        with self._lock:
+            self._ultimo_seq += 1
+            evento = _novo_evento(self._ultimo_seq, tipo, dados, datetime.utcnow())
+            self._eventos.append(evento)
+        return evento
+
+    def desde(self, seq: int, limite: int = 100) -> list:
+        with self._lock:
+            return [e for e in self._eventos if e["seq"] > seq][:limite]
+
+    def recentes(self, tipo: str, limite: int) -> list:
+        with self._lock:
+            eventos = [e for e in reversed(self._eventos) if e["tipo"] == tipo]
+        return eventos[:limite]
+
+    def ultimo_seq(self) -> int:
+        return self._ultimo_seq
+
+    def descarregar(self):
+        pass
+
+
+class BackendNotificacoesBanco:
+    """
+    Anel de eventos na tabela 'eventos_notificacao', partilhado por todos os workers
+    do uvicorn (e por outros processos, como o bot). A sequência vem da chave primária.
+    Quem publica (o crud, logo depois do seu commit) só põe o evento numa fila em memória:
+    uma thread de fundo grava-os em lotes, sem uma segunda transação no pedido e sem
+    I/O no event loop. O evento devolvido por publicar() ainda não tem sequência.
+    """
+    distribui_localmente = False
+
+    def __init__(self, session_factory=None, capacidade: int = CAPACIDADE_ANEL_EVENTOS):
+        if session_factory is None:
+            from database_config import SessionLocal
+            session_factory = SessionLocal
+        self._session_factory = session_factory
+        self.capacidade = capacidade
+        self._pendentes = queue.Queue()
+        self._escritor = None
+        self._escritor_lock = threading.Lock()
+
+    def publicar(self, tipo: str, dados: dict) -> dict:
+        evento = _novo_evento(None, tipo, dados, datetime.utcnow())
+        self._pendentes.put(evento)
+        with self._escritor_lock:
+            if self._escritor is None or not self._escritor.is_alive():
+                self._escritor = threading.Thread(target=self._escrever, name="escritor-eventos", daemon=True)
+                self._escritor.start()
+        return evento
+
+    def descarregar(self):
+        """Espera até os eventos já publicados estarem gravados (encerramento e testes)."""
+        self._pendentes.join()
+
+    def _escrever(self):
+        while True:
+            lote = [self._pendentes.get()]
+            while len(lote) < TAMANHO_LOTE_ESCRITA_EVENTOS:
+                try:
+                    lote.append(self._pendentes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._gravar(lote)
+            except Exception as e:
+                print(f"ERRO ao gravar eventos de notificação: {e}")
+            finally:
+                for _ in lote:
+                    self._pendentes.task_done()
+
+    def _gravar(self, lote: list):
+        import models
+        with self._session_factory() as db:
+            registos = [
+                models.EventoNotificacao(
+                    tipo=e["tipo"], dados=json.dumps(e["dados"], ensure_ascii=False),
+                    criado_em=datetime.fromisoformat(e["criado_em"]),
+                )
+                for e in lote
+            ]
+            db.add_all(registos)
+            db.flush()
+            ultimo = max(r.seq for r in registos)
+            # De tempos a tempos apaga o que já saiu do anel
+            if ultimo // 100 != (ultimo - len(registos)) // 100:
+                db.query(models.EventoNotificacao).filter(
+                    models.EventoNotificacao.seq <= ultimo - self.capacidade
+                ).delete(synchronize_session=False)
+            db.commit()
+
+    def desde(self, seq: int, limite: int = 100) -> list:
+        import models
+        with self._session_factory() as db:
+            registos = db.query(models.EventoNotificacao).filter(
+                models.EventoNotificacao.seq > seq
+            ).order_by(models.EventoNotificacao.seq).limit(limite).all()
+            return [_evento_do_registo(r) for r in registos]
+
+    def recentes(self, tipo: str, limite: int) -> list:
+        import models
+        with self._session_factory() as db:
+            registos = db.query(models.EventoNotificacao).filter(
+                models.EventoNotificacao.tipo == tipo
+            ).order_by(models.EventoNotificacao.seq.desc()).limit(limite).all()
+            return [_evento_do_registo(r) for r in registos]
+
+    def ultimo_seq(self) -> int:
+        import models
+        from sqlalchemy import func
+        with self._session_factory() as db:
+            return db.query(func.max(models.EventoNotificacao.seq)).scalar() or 0
+
+
+def _novo_evento(seq: int, tipo: str, dados: dict, criado_em: datetime) -> dict:
+    return {"seq": seq, "tipo": tipo, "dados": dados, "criado_em": criado_em.isoformat()}
+
+def _evento_do_registo(registo) -> dict:
+    return _novo_evento(registo.seq, registo.tipo, json.loads(registo.dados), registo.criado_em)
+
+def criar_backend(nome: str):
+    """Cria o backend configurado em NOTIFICACOES_BACKEND ('memoria' ou 'banco')."""
+    if nome == "banco":
+        return BackendNotificacoesBanco()
+    if nome == "memoria":
+        return BackendNotificacoesMemoria()
+    raise ValueError(f"Backend de notificações desconhecido: {nome}")
+
+backend = criar_backend(os.getenv("NOTIFICACOES_BACKEND", "memoria"))
+
+def configurar_backend(novo_backend):
+    """Troca o backend em uso (usado nos testes e na inicialização)."""
+    global backend
+    backend = novo_backend
+
+def descarregar_eventos():
+    """Espera que o backend grave os eventos pendentes (chamado no encerramento)."""
+    backend.descarregar()
+
+
+# --- API usada pelo resto da aplicação ---
 
 def add_notification(message: str):
     """Adiciona uma nova notificação à lista."""
     timestamp = datetime.now().strftime("%H:%M:%S")
-    notifications.appendleft(f"[{timestamp}] {message}")
+    publicar_evento("notificacao", {"mensagem": f"[{timestamp}] {message}"})
 
 def get_notifications():
     """Retorna a lista de notificações atuais."""
-    return list(notifications)
+    return [e["dados"]["mensagem"] for e in backend.recentes("notificacao", TOTAL_NOTIFICACOES_VISIVEIS)]
+
+def publicar_evento(tipo: str, dados: dict = None):
+    """Regista um evento tipado ('notificacao', 'fila', 'mesa', 'garcon', 'mensagem', 'promocao') no backend."""
+    evento = backend.publicar(tipo, dados or {})
+    _notificar_observadores(evento)
+    if backend.distribui_localmente:
+        _distribuir(evento)
+    return evento
+
+def eventos_desde(seq: int, limite: int = 100):
+    """Devolve os eventos com sequência maior do que `seq`, por ordem."""
+    return backend.desde(seq, limite)
+
+
+# --- Observadores (código do próprio processo que reage a eventos) ---
+
+# Funções chamadas com cada evento publicado neste processo ou lido dos outros
+_observadores = []
+
+def observar_eventos(funcao):
+    """
+    Regista uma função chamada, na thread de quem publica, com cada evento. Com o backend
+    'banco' os eventos deste processo chegam duas vezes (ao publicar e ao ler do anel),
+    por isso a função deve tolerar repetições.
+    """
+    _observadores.append(funcao)
+
+def _notificar_observadores(evento: dict):
+    for funcao in _observadores:
+        try:
+            funcao(evento)
+        except Exception as e:
+            print(f"ERRO num observador de eventos: {e}")
+
+
+# --- Assinantes do fluxo de eventos (Server-Sent Events) ---
+
+# Pares (event loop, asyncio.Queue). Os eventos podem ser publicados a partir de qualquer
+# thread (as rotas síncronas correm num threadpool), por isso a entrega passa sempre
+# pelo loop do assinante.
+_assinantes = set()
+_assinantes_lock = threading.Lock()
+
+def _distribuir(evento: dict):
+    with _assinantes_lock:
+        assinantes = list(_assinantes)
+    for assinante in assinantes:
+        loop, fila = assinante
+        try:
+            loop.call_soon_threadsafe(_entregar, fila, evento)
+        except RuntimeError:
+            # O loop do assinante já foi fechado
+            with _assinantes_lock:
+                _assinantes.discard(assinante)
+
+def _entregar(fila: asyncio.Queue, evento: dict):
+    try:
+        fila.put_nowait(evento)
+    except asyncio.QueueFull:
+        # Cliente lento: descarta o evento; ao reconectar ele recupera pelo Last-Event-ID
+        pass
+
+def assinar() -> asyncio.Queue:
+    """Regista um novo assinante no loop atual e devolve a fila onde os eventos chegam."""
+    fila = asyncio.Queue(maxsize=TAMANHO_MAXIMO_FILA_ASSINANTE)
+    with _assinantes_lock:
+        _assinantes.add((asyncio.get_running_loop(), fila))
+    return fila
+
+def cancelar_assinatura(fila: asyncio.Queue):
+    """Remove um assinante registado com assinar()."""
+    with _assinantes_lock:
+        for assinante in [a for a in _assinantes if a[1] is fila]:
+            _assinantes.discard(assinante)
+
+def formatar_evento_sse(evento: dict) -> str:
+    """Serializa um evento no formato text/event-stream (o id permite retomar com Last-Event-ID)."""
+    return f"id: {evento['seq']}\nevent: {evento['tipo']}\ndata: {json.dumps(evento['dados'], ensure_ascii=False)}\n\n"
 
-# Adiciona uma notificação inicial
-add_notification("Sistema iniciado. Bem-vindo!")
\ No newline at end of file
+async def distribuir_eventos_de_outros_processos():
+    """
+    Tarefa de fundo para backends partilhados: lê do anel os eventos novos (de qualquer
+    worker) e entrega-os aos assinantes deste processo. Como as sequências de transações
+    concorrentes podem ficar visíveis fora de ordem, relê sempre uma pequena janela atrás.
+    """
+    if backend.distribui_localmente:
+        return
+    janela = 50
+    # Eventos anteriores ao arranque não são redistribuídos
+    inicio = ultimo = await asyncio.to_thread(backend.ultimo_seq)
+    entregues = set()
+    while True:
+        try:
+            eventos = await asyncio.to_thread(backend.desde, max(ultimo - janela, inicio), 500)
+            for evento in eventos:
+                if evento["seq"] in entregues:
+                    continue
+                entregues.add(evento["seq"])
+                ultimo = max(ultimo, evento["seq"])
+                _notificar_observadores(evento)
+                _distribuir(evento)
+            entregues = {seq for seq in entregues if seq > ultimo - janela}
+        except Exception as e:
+            print(f"ERRO ao ler eventos de notificação: {e}")
+        await asyncio.sleep(INTERVALO_SONDAGEM_SEGUNDOS)
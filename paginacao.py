@@ -0,0 +1,53 @@
+# back/paginacao.py
+
+import base64
+import json
+from datetime import datetime
+
+# Cabeçalho com o cursor da página seguinte (ausente na última página)
+CABECALHO_PROXIMO_CURSOR = "X-Proximo-Cursor"
+
+
+def codificar_cursor(valores: dict) -> str:
+    """Cursor opaco para o cliente: JSON em base64 url-safe, sem padding."""
+    texto = json.dumps(valores, separators=(",", ":"), default=str)
+    return base64.urlsafe_b64encode(texto.encode()).decode().rstrip("=")
+
+def decodificar_cursor(cursor: str) -> dict:
+    """Levanta ValueError se o cursor não for um dos emitidos por codificar_cursor."""
+    try:
+        valores = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception as erro:
+        raise ValueError("Cursor inválido.") from erro
+    if not isinstance(valores, dict):
+        raise ValueError("Cursor inválido.")
+    return valores
+
+
+# --- Chaves de ordenação: (horario_chegada, id) para a fila e o histórico, numero para as mesas ---
+
+def cursor_cliente(cliente) -> str:
+    return codificar_cursor({"h": cliente.horario_chegada.isoformat(), "id": cliente.id})
+
+def chave_cliente(cursor: str) -> tuple:
+    valores = decodificar_cursor(cursor)
+    try:
+        return datetime.fromisoformat(valores["h"]), int(valores["id"])
+    except (KeyError, TypeError, ValueError) as erro:
+        raise ValueError("Cursor inválido.") from erro
+
+def cursor_mesa(mesa) -> str:
+    return codificar_cursor({"n": mesa.numero})
+
+def chave_mesa(cursor: str) -> int:
+    valores = decodificar_cursor(cursor)
+    try:
+        return int(valores["n"])
+    except (KeyError, TypeError, ValueError) as erro:
+        raise ValueError("Cursor inválido.") from erro
+
+def proximo_cursor(linhas: list, limit: int, cursor_de) -> str:
+    """Cursor a seguir à última linha, ou None se a página veio incompleta (não há mais)."""
+    if limit <= 0 or len(linhas) < limit:
+        return None
+    return cursor_de(linhas[-1])
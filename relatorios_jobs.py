@@ -0,0 +1,413 @@
+# back/relatorios_jobs.py
+
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field, fields
+from datetime import date, datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import defer
+
+import models
+import reports
+
+# Quantos relatórios são preparados ao mesmo tempo (cada um ocupa uma sessão do banco enquanto busca os dados)
+RELATORIOS_JOBS_SIMULTANEOS = int(os.getenv("RELATORIOS_JOBS_SIMULTANEOS", "2"))
+# Processos que montam os PDFs; 0 monta na própria thread do trabalho (sem processos extra)
+RELATORIOS_JOBS_PROCESSOS = int(os.getenv("RELATORIOS_JOBS_PROCESSOS", "2"))
+# Como esses processos são criados: nunca por fork do servidor, que tem threads, locks e ligações
+# ao banco abertas; "forkserver" onde existe (Linux), senão "spawn"
+RELATORIOS_JOBS_INICIO_PROCESSOS = os.getenv(
+    "RELATORIOS_JOBS_INICIO_PROCESSOS",
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn",
+)
+# Durante quanto tempo um trabalho terminado (e o seu PDF) fica disponível para download
+RELATORIOS_JOBS_VALIDADE_SEGUNDOS = int(os.getenv("RELATORIOS_JOBS_VALIDADE_SEGUNDOS", "3600"))
+# Onde ficam os trabalhos: 'memoria' (um só worker) ou 'banco' (partilhados por todos os workers)
+RELATORIOS_JOBS_BACKEND = os.getenv("RELATORIOS_JOBS_BACKEND", "memoria")
+# Um trabalho ativo há mais tempo do que isto é dado como abandonado (ex.: o worker que o gerava morreu)
+RELATORIOS_JOBS_TEMPO_MAXIMO_SEGUNDOS = int(os.getenv("RELATORIOS_JOBS_TEMPO_MAXIMO_SEGUNDOS", "900"))
+
+# Estados de um trabalho, pela ordem em que acontecem
+NA_FILA = "na_fila"
+A_BUSCAR_DADOS = "a_buscar_dados"
+A_RENDERIZAR = "a_renderizar"
+CONCLUIDO = "concluido"
+FALHOU = "falhou"
+
+
+@dataclass
+class TrabalhoRelatorio:
+    id: str
+    tipo: str
+    data_inicio: date
+    data_fim: date
+    estado: str = NA_FILA
+    progresso: int = 0  # percentagem aproximada, avança por fases
+    criado_em: datetime = field(default_factory=datetime.utcnow)
+    concluido_em: Optional[datetime] = None
+    erro: Optional[str] = None
+    nome_ficheiro: Optional[str] = None
+    etag: Optional[str] = None
+    validade_segundos: int = RELATORIOS_JOBS_VALIDADE_SEGUNDOS  # quanto tempo fica disponível depois de terminar
+    expira_em: Optional[datetime] = None
+    conteudo: Optional[bytes] = field(default=None, repr=False)
+
+    @property
+    def ativo(self) -> bool:
+        return self.estado not in (CONCLUIDO, FALHOU)
+
+    @property
+    def chave(self) -> str:
+        return f"{self.tipo}|{self.data_inicio.isoformat()}|{self.data_fim.isoformat()}"
+
+    def para_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "tipo": self.tipo,
+            "data_inicio": self.data_inicio,
+            "data_fim": self.data_fim,
+            "estado": self.estado,
+            "progresso": self.progresso,
+            "criado_em": self.criado_em,
+            "concluido_em": self.concluido_em,
+            "erro": self.erro,
+            "nome_ficheiro": self.nome_ficheiro,
+            "download": f"/relatorios/jobs/{self.id}/download" if self.estado == CONCLUIDO else None,
+        }
+
+
+# --- Onde ficam os trabalhos ---
+
+class ArmazemTrabalhosMemoria:
+    """
+    Trabalhos na memória do processo. Serve para testes e para correr com um único worker:
+    com vários, o estado e o download só existem no worker que recebeu o pedido.
+    """
+    partilhado = False
+
+    def __init__(self):
+        self._trabalhos = {}
+        self._ativos_por_chave = {}
+        self._lock = threading.Lock()
+
+    def criar_ou_obter_ativo(self, novo: TrabalhoRelatorio) -> tuple:
+        """Guarda o trabalho novo ou devolve o que já está a gerar o mesmo relatório: (trabalho, criado)."""
+        with self._lock:
+            existente = self._trabalhos.get(self._ativos_por_chave.get(novo.chave))
+            if existente is not None and existente.ativo:
+                return existente, False
+            self._trabalhos[novo.id] = novo
+            self._ativos_por_chave[novo.chave] = novo.id
+            return novo, True
+
+    def obter(self, trabalho_id: str, com_conteudo: bool = True) -> Optional[TrabalhoRelatorio]:
+        with self._lock:
+            return self._trabalhos.get(trabalho_id)
+
+    def obter_concluido(self, tipo: str, data_inicio: date, data_fim: date, etag: str) -> Optional[TrabalhoRelatorio]:
+        """O trabalho concluído mais recente desse relatório gerado com os dados na versão `etag`."""
+        with self._lock:
+            concluidos = [t for t in self._trabalhos.values() if t.estado == CONCLUIDO and t.etag == etag
+                          and (t.tipo, t.data_inicio, t.data_fim) == (tipo, data_inicio, data_fim)]
+        return max(concluidos, key=lambda t: t.concluido_em, default=None)
+
+    def guardar(self, trabalho: TrabalhoRelatorio):
+        pass  # o gestor altera o próprio objeto guardado
+
+    def descartar_expirados(self, agora: datetime):
+        """Esquece os trabalhos cuja validade já acabou."""
+        with self._lock:
+            for trabalho_id in [t.id for t in self._trabalhos.values()
+                                if t.expira_em is not None and t.expira_em < agora]:
+                trabalho = self._trabalhos.pop(trabalho_id)
+                if self._ativos_por_chave.get(trabalho.chave) == trabalho_id:
+                    del self._ativos_por_chave[trabalho.chave]
+
+    def estado(self) -> dict:
+        with self._lock:
+            contagem = {}
+            for trabalho in self._trabalhos.values():
+                contagem[trabalho.estado] = contagem.get(trabalho.estado, 0) + 1
+            return contagem
+
+    def limpar(self):
+        with self._lock:
+            self._trabalhos.clear()
+            self._ativos_por_chave.clear()
+
+
+class ArmazemTrabalhosBanco:
+    """
+    Trabalhos na tabela 'trabalhos_relatorios', partilhados por todos os workers do uvicorn:
+    o estado e o download respondem em qualquer worker e o mesmo relatório pedido a dois
+    workers é gerado uma só vez (coluna única chave_ativa). O trabalho corre no worker que
+    o criou, que grava cada mudança de estado.
+    """
+    partilhado = True
+
+    def __init__(self, sessao, tempo_maximo_segundos: int = RELATORIOS_JOBS_TEMPO_MAXIMO_SEGUNDOS):
+        self._sessao = sessao
+        self.tempo_maximo_segundos = tempo_maximo_segundos
+
+    def criar_ou_obter_ativo(self, novo: TrabalhoRelatorio) -> tuple:
+        """Guarda o trabalho novo ou devolve o que já está a gerar o mesmo relatório: (trabalho, criado)."""
+        for _ in range(3):
+            with self._sessao() as db:
+                existente = db.query(models.TrabalhoRelatorio).filter(
+                    models.TrabalhoRelatorio.chave_ativa == novo.chave
+                ).first()
+                if existente is not None and not self._abandonado(db, existente):
+                    return _trabalho_do_registo(existente, com_conteudo=False), False
+                db.add(models.TrabalhoRelatorio(**_campos(novo), chave_ativa=novo.chave))
+                try:
+                    db.commit()
+                    return novo, True
+                except IntegrityError:
+                    # Outro worker criou o mesmo trabalho entretanto: na próxima volta usa o dele
+                    db.rollback()
+        raise RuntimeError("Não foi possível registar o trabalho de relatório.")
+
+    def obter(self, trabalho_id: str, com_conteudo: bool = True) -> Optional[TrabalhoRelatorio]:
+        with self._sessao() as db:
+            # O estado é consultado muitas vezes: o PDF só é lido para o download
+            opcoes = [] if com_conteudo else [defer(models.TrabalhoRelatorio.conteudo)]
+            registo = db.get(models.TrabalhoRelatorio, trabalho_id, options=opcoes)
+            if registo is None:
+                return None
+            self._abandonado(db, registo)
+            return _trabalho_do_registo(registo, com_conteudo)
+
+    def obter_concluido(self, tipo: str, data_inicio: date, data_fim: date, etag: str) -> Optional[TrabalhoRelatorio]:
+        """O trabalho concluído mais recente desse relatório gerado com os dados na versão `etag`."""
+        with self._sessao() as db:
+            registo = db.query(models.TrabalhoRelatorio).filter(
+                models.TrabalhoRelatorio.tipo == tipo,
+                models.TrabalhoRelatorio.data_inicio == data_inicio,
+                models.TrabalhoRelatorio.data_fim == data_fim,
+                models.TrabalhoRelatorio.etag == etag,
+                models.TrabalhoRelatorio.estado == CONCLUIDO
+            ).order_by(models.TrabalhoRelatorio.concluido_em.desc()).first()
+            return _trabalho_do_registo(registo, com_conteudo=True) if registo else None
+
+    def guardar(self, trabalho: TrabalhoRelatorio):
+        valores = {campo: getattr(trabalho, campo) for campo in
+                   ("estado", "progresso", "concluido_em", "expira_em", "erro", "nome_ficheiro", "etag", "conteudo")}
+        if not trabalho.ativo:
+            valores["chave_ativa"] = None
+        with self._sessao() as db:
+            db.query(models.TrabalhoRelatorio).filter(
+                models.TrabalhoRelatorio.id == trabalho.id
+            ).update(valores, synchronize_session=False)
+            db.commit()
+
+    def descartar_expirados(self, agora: datetime):
+        """Apaga os trabalhos cuja validade já acabou (e os seus PDFs)."""
+        with self._sessao() as db:
+            db.query(models.TrabalhoRelatorio).filter(
+                models.TrabalhoRelatorio.expira_em < agora
+            ).delete(synchronize_session=False)
+            db.commit()
+
+    def estado(self) -> dict:
+        with self._sessao() as db:
+            return dict(db.query(models.TrabalhoRelatorio.estado, func.count()).group_by(models.TrabalhoRelatorio.estado).all())
+
+    def limpar(self):
+        with self._sessao() as db:
+            db.query(models.TrabalhoRelatorio).delete(synchronize_session=False)
+            db.commit()
+
+    def _abandonado(self, db, registo) -> bool:
+        """
+        Um trabalho ativo há mais do que o tempo máximo ficou sem worker (que morreu ou foi
+        reiniciado): é marcado como falhado, o que liberta a chave para um trabalho novo.
+        """
+        limite = datetime.utcnow() - timedelta(seconds=self.tempo_maximo_segundos)
+        if registo.chave_ativa is None or registo.criado_em >= limite:
+            return False
+        registo.estado, registo.erro, registo.chave_ativa = FALHOU, "Trabalho abandonado pelo worker que o gerava.", None
+        registo.concluido_em = datetime.utcnow()
+        registo.expira_em = registo.concluido_em + timedelta(seconds=registo.validade_segundos)
+        db.commit()
+        return True
+
+
+def _campos(trabalho: TrabalhoRelatorio) -> dict:
+    return {f.name: getattr(trabalho, f.name) for f in fields(TrabalhoRelatorio)}
+
+def _trabalho_do_registo(registo, com_conteudo: bool) -> TrabalhoRelatorio:
+    valores = {f.name: getattr(registo, f.name) for f in fields(TrabalhoRelatorio) if f.name != "conteudo"}
+    return TrabalhoRelatorio(**valores, conteudo=registo.conteudo if com_conteudo else None)
+
+def criar_armazem(nome: str, sessao):
+    """Cria o armazém configurado em RELATORIOS_JOBS_BACKEND ('memoria' ou 'banco')."""
+    if nome == "banco":
+        return ArmazemTrabalhosBanco(sessao)
+    if nome == "memoria":
+        return ArmazemTrabalhosMemoria()
+    raise ValueError(f"Backend de trabalhos de relatório desconhecido: {nome}")
+
+
+class GestorTrabalhosRelatorios:
+    """
+    Gera relatórios fora do pedido HTTP. Cada trabalho busca os dados numa thread
+    (com uma sessão própria) e monta o PDF num processo à parte, para que relatórios
+    grandes não bloqueiem o servidor nem esbarrem no timeout do proxy. Pedir o mesmo
+    relatório enquanto ele ainda está a ser gerado devolve o trabalho já existente.
+    Os trabalhos ficam no armazém configurado (RELATORIOS_JOBS_BACKEND).
+    """
+
+    def __init__(self, session_factory=None, simultaneos: int = RELATORIOS_JOBS_SIMULTANEOS,
+                 processos: int = RELATORIOS_JOBS_PROCESSOS, validade_segundos: int = RELATORIOS_JOBS_VALIDADE_SEGUNDOS,
+                 backend: str = RELATORIOS_JOBS_BACKEND):
+        self.session_factory = session_factory
+        self.simultaneos = simultaneos
+        self.processos = processos
+        self.validade_segundos = validade_segundos
+        self.armazem = criar_armazem(backend, self._sessao)
+        self._lock = threading.Lock()
+        self._threads = None
+        self._processos = None
+
+    def _sessao(self):
+        if self.session_factory is None:
+            from database_config import SessionLocal
+            self.session_factory = SessionLocal
+        return self.session_factory()
+
+    # --- Ciclo de vida ---
+
+    def _executores(self):
+        """Cria os executores na primeira utilização (não há processos extra se nunca houver trabalhos)."""
+        with self._lock:
+            if self._threads is None:
+                self._threads = ThreadPoolExecutor(max_workers=self.simultaneos, thread_name_prefix="relatorios")
+                if self.processos > 0:
+                    self._processos = self._novo_processos()
+            return self._threads, self._processos
+
+    def _novo_processos(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=self.processos, mp_context=multiprocessing.get_context(RELATORIOS_JOBS_INICIO_PROCESSOS)
+        )
+
+    def _renderizar(self, dados) -> bytes:
+        """
+        Monta o PDF num dos processos. Se um processo morreu (ex.: falta de memória) o executor
+        fica inutilizável: é substituído por um novo e o PDF é tentado mais uma vez.
+        """
+        _, processos = self._executores()
+        if processos is None:
+            return reports.renderizar_relatorio_pdf(dados)
+        try:
+            return processos.submit(reports.renderizar_relatorio_pdf, dados).result()
+        except BrokenProcessPool:
+            with self._lock:
+                # Outro trabalho pode já o ter substituído
+                if self._processos is processos:
+                    self._processos = self._novo_processos()
+                novos = self._processos
+            processos.shutdown(wait=False, cancel_futures=True)
+            if novos is None:
+                raise
+            return novos.submit(reports.renderizar_relatorio_pdf, dados).result()
+
+    def parar(self):
+        """Encerra os executores (chamado no fim da aplicação); trabalhos a meio são abandonados."""
+        with self._lock:
+            threads, processos = self._threads, self._processos
+            self._threads = self._processos = None
+        if threads is not None:
+            threads.shutdown(wait=False, cancel_futures=True)
+        if processos is not None:
+            processos.shutdown(wait=False, cancel_futures=True)
+
+    def limpar(self):
+        self.armazem.limpar()
+
+    # --- Trabalhos ---
+
+    def submeter(self, tipo: str, data_inicio: date, data_fim: date, validade_segundos: int = None) -> TrabalhoRelatorio:
+        """
+        Cria um trabalho para o relatório, ou devolve o que já está a gerar o mesmo relatório.
+        Depois de terminar fica disponível durante `validade_segundos` (por omissão, a do gestor).
+        """
+        threads, _ = self._executores()
+        self._descartar_expirados()
+        trabalho, criado = self.armazem.criar_ou_obter_ativo(TrabalhoRelatorio(
+            id=uuid.uuid4().hex, tipo=tipo, data_inicio=data_inicio, data_fim=data_fim,
+            validade_segundos=self.validade_segundos if validade_segundos is None else validade_segundos))
+        if criado:
+            threads.submit(self._executar, trabalho)
+        return trabalho
+
+    def obter(self, trabalho_id: str, com_conteudo: bool = True) -> Optional[TrabalhoRelatorio]:
+        self._descartar_expirados()
+        return self.armazem.obter(trabalho_id, com_conteudo)
+
+    def pdf_pronto(self, tipo: str, data_inicio: date, data_fim: date, etag: str):
+        """
+        (nome_ficheiro, conteúdo) de um trabalho já concluído com os dados na versão `etag`: com o
+        backend 'banco', os relatórios gerados por outro worker (ex.: os pré-gerados) servem aqui.
+        """
+        self._descartar_expirados()
+        trabalho = self.armazem.obter_concluido(tipo, data_inicio, data_fim, etag)
+        return (trabalho.nome_ficheiro, trabalho.conteudo) if trabalho else None
+
+    def estado(self) -> dict:
+        return self.armazem.estado()
+
+    def _descartar_expirados(self):
+        self.armazem.descartar_expirados(datetime.utcnow())
+
+    def _executar(self, trabalho: TrabalhoRelatorio):
+        try:
+            trabalho.estado, trabalho.progresso = A_BUSCAR_DADOS, 10
+            self.armazem.guardar(trabalho)
+            with self._sessao() as db:
+                etag = reports.calcular_etag(db, trabalho.tipo, trabalho.data_inicio, trabalho.data_fim)
+                em_cache = reports.cache_relatorios.obter(trabalho.tipo, trabalho.data_inicio, trabalho.data_fim, etag) \
+                    or self.pdf_pronto(trabalho.tipo, trabalho.data_inicio, trabalho.data_fim, etag)
+                dados = None if em_cache else reports.buscar_dados_relatorio(
+                    db, trabalho.tipo, trabalho.data_inicio, trabalho.data_fim)
+
+            if em_cache:
+                nome_ficheiro, conteudo = em_cache
+            else:
+                trabalho.estado, trabalho.progresso = A_RENDERIZAR, 40
+                self.armazem.guardar(trabalho)
+                conteudo = self._renderizar(dados)
+                nome_ficheiro = dados.nome_ficheiro
+                reports.cache_relatorios.guardar(trabalho.tipo, trabalho.data_inicio, trabalho.data_fim,
+                                                 etag, nome_ficheiro, conteudo)
+
+            trabalho.nome_ficheiro, trabalho.conteudo, trabalho.etag = nome_ficheiro, conteudo, etag
+            trabalho.estado, trabalho.progresso = CONCLUIDO, 100
+        except Exception as e:
+            print(f"Erro no trabalho de relatório {trabalho.id}: {e}")
+            trabalho.estado, trabalho.erro = FALHOU, str(e)
+        trabalho.concluido_em = datetime.utcnow()
+        trabalho.expira_em = trabalho.concluido_em + timedelta(seconds=trabalho.validade_segundos)
+        try:
+            self.armazem.guardar(trabalho)
+        except Exception as e:
+            print(f"Erro ao gravar o trabalho de relatório {trabalho.id}: {e}")
+
+    def esperar(self, trabalho_id: str, timeout: float = 30) -> Optional[TrabalhoRelatorio]:
+        """Espera (a bloquear) até o trabalho terminar; útil em scripts e testes."""
+        limite = time.monotonic() + timeout
+        trabalho = self.obter(trabalho_id, com_conteudo=False)
+        while trabalho is not None and trabalho.ativo and time.monotonic() < limite:
+            time.sleep(0.05)
+            trabalho = self.obter(trabalho_id, com_conteudo=False)
+        return self.obter(trabalho_id)
+
+gestor_relatorios = GestorTrabalhosRelatorios()
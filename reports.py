@@ -1,208 +1,339 @@
 # back/reports.py
 
+import hashlib
+import math
+import os
+import threading
+from collections import OrderedDict
+from itertools import islice
+from dataclasses import dataclass, field
 from fpdf import FPDF
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
+from typing import Optional
 from sqlalchemy.orm import Session
+import consultas_relatorios
 import crud
+import estatisticas
 
 class PDF(FPDF):
     def header(self):
         self.set_font('Arial', 'B', 14)
         # O título será definido em cada função para ser específico
-    
+
     def footer(self):
         self.set_y(-15)
         self.set_font('Arial', 'I', 8)
         self.cell(0, 10, f'Página {self.page_no()}', 0, 0, 'C')
 
-def gerar_relatorio_diario_pdf(db: Session):
-    hoje = date.today()
-    
-    # --- BUSCAR DADOS (CORRIGIDO) ---
-    clientes_do_dia = crud.listar_clientes_do_dia(db, dia=hoje)
-    clientes_atendidos_hoje = [c for c in clientes_do_dia if c.status == 'atendido' and c.horario_atendimento]
-    clientes_cancelados_hoje = len([c for c in clientes_do_dia if c.status == 'cancelado']) # <-- CORREÇÃO AQUI
-
-    # --- CÁLCULO DO TEMPO MÉDIO DE ESPERA ---
-    tempo_medio_espera = 0
-    if clientes_atendidos_hoje:
-        total_espera_segundos = sum((c.horario_atendimento - c.horario_chegada).total_seconds() for c in clientes_atendidos_hoje)
-        tempo_medio_espera = round((total_espera_segundos / len(clientes_atendidos_hoje)) / 60)
-
-    # --- MONTAR PDF ---
-    pdf = PDF()
-    pdf.add_page()
-    pdf.set_font('Arial', 'B', 14)
-    pdf.cell(0, 10, 'Relatório Diário de Atividade - MesaJa', 0, 1, 'C')
-    pdf.ln(5)
 
-    # RESUMO (CORRIGIDO)
-    pdf.set_font('Arial', 'B', 12)
-    pdf.cell(0, 10, 'Resumo do Dia', 0, 1, 'L')
-    pdf.set_font('Arial', '', 11)
-    pdf.cell(0, 8, f"Data do Relatório: {hoje.strftime('%d/%m/%Y')}", 0, 1)
-    pdf.cell(0, 8, f"- Total de Clientes na Fila Hoje: {len(clientes_do_dia)}", 0, 1) # <-- NOME PADRONIZADO
-    pdf.cell(0, 8, f"- Total de Clientes Atendidos: {len(clientes_atendidos_hoje)}", 0, 1)
-    pdf.cell(0, 8, f"- Total de Desistências: {clientes_cancelados_hoje}", 0, 1) # <-- LINHA ADICIONADA
+# --- Fase 1: buscar os dados (precisa da sessão) ---
 
-    pdf.set_font('Arial', 'B', 11)
-    pdf.cell(0, 8, f"- Tempo Médio de Espera: {tempo_medio_espera} minutos", 0, 1)
-    pdf.ln(10)
+# Acima deste número de clientes no período o registo linha a linha é substituído
+# por totais por dia e por hora, para que o PDF tenha tamanho e tempo de geração limitados
+RELATORIOS_MAX_LINHAS_DETALHE = int(os.getenv("RELATORIOS_MAX_LINHAS_DETALHE", "1000"))
 
-    # TABELA DE CLIENTES
-    pdf.set_font('Arial', 'B', 12)
-    pdf.cell(0, 10, 'Registo de Clientes na Fila', 0, 1, 'L')
-    
-    if not clientes_do_dia:
-        pdf.set_font('Arial', 'I', 11)
-        pdf.cell(0, 10, "Nenhuma atividade de clientes registada hoje.", 0, 1)
-    else:
+@dataclass
+class DadosRelatorio:
+    """
+    Tudo o que um relatório precisa, já fora do banco: valores simples que podem ser
+    renderizados depois de a sessão ter sido devolvida ao pool.
+    """
+    tipo: str  # 'diario', 'semanal' ou 'personalizado'
+    data_inicio: date
+    data_fim: date
+    # (nome_cliente, tamanho_grupo, horario_chegada, status) por ordem de chegada
+    clientes: list = field(default_factory=list)
+    total_clientes: int = 0
+    total_atendidos: int = 0
+    total_cancelados: int = 0
+    tempo_medio_espera: int = 0
+    espera_p50: Optional[int] = 0  # None quando a fonte do resumo não calcula percentis
+    espera_p90: Optional[int] = 0
+    # Preenchidos só quando o detalhe excede o limite (e então 'clientes' fica vazio):
+    # (dia, chegadas, atendidos, cancelados, espera média) e (hora, ...) por ordem
+    detalhe_omitido: bool = False
+    por_dia: list = field(default_factory=list)
+    por_hora: list = field(default_factory=list)
+
+    @property
+    def nome_ficheiro(self) -> str:
+        if self.tipo == "personalizado":
+            return f"relatorio_personalizado_{self.data_inicio.strftime('%Y%m%d')}_a_{self.data_fim.strftime('%Y%m%d')}.pdf"
+        return f"relatorio_{self.tipo}_{self.data_fim.strftime('%Y_%m_%d')}.pdf"
+
+def _montar_dados(db: Session, tipo: str, data_inicio: date, data_fim: date) -> DadosRelatorio:
+    # O resumo vem de agregados (estatísticas ou GROUP BY em SQL) e o detalhe de tuplos lidos em blocos,
+    # sem materializar objetos models.Fila
+    resumo = consultas_relatorios.resumo_periodo(db, data_inicio, data_fim)
+    limite = RELATORIOS_MAX_LINHAS_DETALHE
+    # Lê no máximo uma linha além do limite: o suficiente para saber se ele foi ultrapassado
+    clientes = list(islice(consultas_relatorios.iterar_clientes(db, data_inicio, data_fim), limite + 1))
+    dados = DadosRelatorio(
+        tipo=tipo,
+        data_inicio=data_inicio,
+        data_fim=data_fim,
+        clientes=clientes,
+        total_clientes=resumo["chegadas"],
+        total_atendidos=resumo["atendidos"],
+        total_cancelados=resumo["cancelados"],
+        tempo_medio_espera=resumo["tempo_medio_espera"],
+        espera_p50=resumo["espera_p50"],
+        espera_p90=resumo["espera_p90"],
+    )
+    if len(clientes) > limite:
+        dados.clientes = []
+        dados.detalhe_omitido = True
+        dados.por_dia = [
+            (linha["dia"], linha["chegadas"], linha["atendidos"], linha["cancelados"], linha["tempo_medio_espera"])
+            for linha in estatisticas.resumo_por_dia(db, data_inicio, data_fim)
+        ]
+        dados.por_hora = [
+            (linha["hora"], linha["chegadas"], linha["atendidos"], linha["cancelados"], linha["tempo_medio_espera"])
+            for linha in estatisticas.resumo_por_hora(db, data_inicio, data_fim)
+        ]
+    return dados
+
+def buscar_dados_relatorio_diario(db: Session, dia: date = None) -> DadosRelatorio:
+    dia = dia or estatisticas.hoje()
+    return _montar_dados(db, "diario", dia, dia)
+
+def buscar_dados_relatorio_semanal(db: Session, hoje: date = None) -> DadosRelatorio:
+    hoje = hoje or estatisticas.hoje()
+    return _montar_dados(db, "semanal", hoje - timedelta(days=6), hoje)
+
+def buscar_dados_relatorio_personalizado(db: Session, data_inicio: date, data_fim: date) -> DadosRelatorio:
+    return _montar_dados(db, "personalizado", data_inicio, data_fim)
+
+def periodo_relatorio(tipo: str, hoje: date = None):
+    """Intervalo de dias (inclusivo) coberto pelos relatórios diário e semanal."""
+    hoje = hoje or estatisticas.hoje()
+    if tipo == "diario":
+        return hoje, hoje
+    return hoje - timedelta(days=6), hoje
+
+def buscar_dados_relatorio(db: Session, tipo: str, data_inicio: date, data_fim: date) -> DadosRelatorio:
+    if tipo == "diario":
+        return buscar_dados_relatorio_diario(db, dia=data_fim)
+    if tipo == "semanal":
+        return buscar_dados_relatorio_semanal(db, hoje=data_fim)
+    return buscar_dados_relatorio_personalizado(db, data_inicio=data_inicio, data_fim=data_fim)
+
+
+# --- Fase 2: montar o PDF (sem acesso ao banco) ---
+
+# Textos e colunas de cada tipo de relatório: (título da coluna, largura, formato da chegada)
+_LAYOUTS = {
+    "diario": {
+        "titulo": 'Relatório Diário de Atividade - MesaJa',
+        "resumo": 'Resumo do Dia',
+        "total": "- Total de Clientes na Fila Hoje",
+        "registo": 'Registo de Clientes na Fila',
+        "vazio": "Nenhuma atividade de clientes registada hoje.",
+        "colunas": [('Nome do Cliente', 80), ('Grupo', 30), ('Horário Chegada', 40), ('Status', 30)],
+        "formatos_chegada": ['%H:%M:%S'],
+        "fonte_linhas": 10,
+    },
+    "semanal": {
+        "titulo": 'Relatório Semanal de Atividade - MesaJa',
+        "resumo": 'Resumo da Semana',
+        "total": "- Total de Clientes na Fila Durante a Semana",
+        "registo": 'Registo de Clientes na Semana',
+        "vazio": "Nenhuma atividade de clientes registada na semana.",
+        "colunas": [('Cliente', 60), ('Grupo', 20), ('Data', 30), ('Chegada', 30), ('Status', 40)],
+        "formatos_chegada": ['%d/%m', '%H:%M'],
+        "fonte_linhas": 9,
+    },
+    "personalizado": {
+        "titulo": 'Relatório Personalizado de Atividade - MesaJa',
+        "resumo": 'Resumo do Período',
+        "total": "- Total de Clientes na Fila No Periodo Escolhido",
+        "registo": 'Registo de Clientes no Período',
+        "vazio": "Nenhuma atividade de clientes registada no período selecionado.",
+        "colunas": [('Cliente', 60), ('Grupo', 20), ('Data', 30), ('Chegada', 30), ('Status', 40)],
+        "formatos_chegada": ['%d/%m/%y', '%H:%M'],
+        "fonte_linhas": 9,
+    },
+}
+
+# Altura das linhas das tabelas, em mm (layout compacto)
+ALTURA_CABECALHO_TABELA = 7
+ALTURA_LINHA_TABELA = 6
+
+_COLUNAS_AGREGADAS = [('Chegadas', 30), ('Atendidos', 30), ('Desistências', 30), ('Espera Média (min)', 40)]
+
+def _tabela(pdf: FPDF, colunas: list, linhas, tamanho_fonte: int):
+    """Desenha uma tabela linha a linha, repetindo o cabeçalho no topo de cada nova página."""
+    def cabecalho():
         pdf.set_font('Arial', 'B', 10)
-        pdf.cell(80, 10, 'Nome do Cliente', 1, 0, 'C')
-        pdf.cell(30, 10, 'Grupo', 1, 0, 'C')
-        pdf.cell(40, 10, 'Horário Chegada', 1, 0, 'C')
-        pdf.cell(30, 10, 'Status', 1, 1, 'C')
-        
-        pdf.set_font('Arial', '', 10)
-        for cliente in clientes_do_dia:
-            horario_chegada_str = cliente.horario_chegada.strftime('%H:%M:%S')
-            status_str = cliente.status.capitalize()
-            pdf.cell(80, 10, cliente.nome_cliente, 1, 0)
-            pdf.cell(30, 10, str(cliente.tamanho_grupo), 1, 0, 'C')
-            pdf.cell(40, 10, horario_chegada_str, 1, 0, 'C')
-            pdf.cell(30, 10, status_str, 1, 1, 'C')
-
-    # SALVAR PDF
-    nome_ficheiro = f"relatorio_diario_{hoje.strftime('%Y_%m_%d')}.pdf"
-    caminho_completo = f"relatorios/{nome_ficheiro}"
-    import os
-    os.makedirs("relatorios", exist_ok=True)
-    pdf.output(caminho_completo)
-    
-    return caminho_completo
-
-def gerar_relatorio_semanal_pdf(db: Session):
-    hoje = date.today()
-    data_inicio = hoje - timedelta(days=6)
-    
-    clientes_semana = crud.listar_clientes_da_semana(db, hoje=hoje)
-    clientes_atendidos_semana = [c for c in clientes_semana if c.status == 'atendido' and c.horario_atendimento]
-    clientes_cancelados_semana = len([c for c in clientes_semana if c.status == 'cancelado'])
-
-    tempo_medio_espera = 0
-    if clientes_atendidos_semana:
-        total_espera_segundos = sum((c.horario_atendimento - c.horario_chegada).total_seconds() for c in clientes_atendidos_semana)
-        tempo_medio_espera = round((total_espera_segundos / len(clientes_atendidos_semana)) / 60)
+        for i, (titulo, largura) in enumerate(colunas):
+            pdf.cell(largura, ALTURA_CABECALHO_TABELA, titulo, 1, 1 if i == len(colunas) - 1 else 0, 'C')
+        pdf.set_font('Arial', '', tamanho_fonte)
 
-    pdf = PDF()
-    pdf.add_page()
-    pdf.set_font('Arial', 'B', 14)
-    pdf.cell(0, 10, 'Relatório Semanal de Atividade - MesaJa', 0, 1, 'C')
-    pdf.ln(5)
+    cabecalho()
+    for valores in linhas:
+        if pdf.will_page_break(ALTURA_LINHA_TABELA):
+            pdf.add_page()
+            cabecalho()
+        for i, ((_, largura), valor) in enumerate(zip(colunas, valores)):
+            ultima = i == len(colunas) - 1
+            pdf.cell(largura, ALTURA_LINHA_TABELA, valor, 1, 1 if ultima else 0, '' if i == 0 else 'C')
 
-    pdf.set_font('Arial', 'B', 12)
-    pdf.cell(0, 10, 'Resumo da Semana', 0, 1, 'L')
-    pdf.set_font('Arial', '', 11)
-    pdf.cell(0, 8, f"Período: {data_inicio.strftime('%d/%m/%Y')} a {hoje.strftime('%d/%m/%Y')}", 0, 1)
-    pdf.cell(0, 8, f"- Total de Clientes na Fila Durante a Semana: {len(clientes_semana)}", 0, 1) # <-- NOME PADRONIZADO
-    pdf.cell(0, 8, f"- Total de Clientes Atendidos: {len(clientes_atendidos_semana)}", 0, 1)
-    pdf.cell(0, 8, f"- Total de Desistências: {clientes_cancelados_semana}", 0, 1) # <-- JÁ ESTAVA CORRETO
-    
+def _grafico_barras(pdf: FPDF, titulo: str, rotulos: list, valores: list, altura: float = 40):
+    """Gráfico de barras verticais simples; com muitas barras só alguns rótulos são escritos."""
+    if pdf.will_page_break(altura + 20):
+        pdf.add_page()
     pdf.set_font('Arial', 'B', 11)
-    pdf.cell(0, 8, f"- Tempo Médio de Espera: {tempo_medio_espera} minutos", 0, 1)
-    pdf.ln(10)
+    pdf.cell(0, 8, titulo, 0, 1)
 
-    pdf.set_font('Arial', 'B', 12)
-    pdf.cell(0, 10, 'Registo de Clientes na Semana', 0, 1, 'L')
+    maximo = max(valores) or 1
+    largura_barra = (pdf.w - pdf.l_margin - pdf.r_margin) / len(valores)
+    passo_rotulos = math.ceil(len(valores) / 24)
+    base = pdf.get_y() + altura
+    pdf.set_fill_color(70, 130, 180)
+    pdf.set_font('Arial', '', 6)
+    for i, (rotulo, valor) in enumerate(zip(rotulos, valores)):
+        x = pdf.l_margin + i * largura_barra
+        if valor:
+            pdf.rect(x + 0.3, base - altura * valor / maximo, max(largura_barra - 0.6, 0.2), altura * valor / maximo, style='F')
+        if i % passo_rotulos == 0:
+            pdf.text(x + 0.3, base + 3, rotulo)
+    pdf.set_y(base + 6)
 
-    if not clientes_semana:
-        pdf.set_font('Arial', 'I', 11)
-        pdf.cell(0, 10, "Nenhuma atividade de clientes registada na semana.", 0, 1)
-    else:
-        pdf.set_font('Arial', 'B', 10)
-        pdf.cell(60, 10, 'Cliente', 1, 0, 'C')
-        pdf.cell(20, 10, 'Grupo', 1, 0, 'C')
-        pdf.cell(30, 10, 'Data', 1, 0, 'C')
-        pdf.cell(30, 10, 'Chegada', 1, 0, 'C')
-        pdf.cell(40, 10, 'Status', 1, 1, 'C')
-        
-        pdf.set_font('Arial', '', 9)
-        for cliente in clientes_semana:
-            data_chegada_str = cliente.horario_chegada.strftime('%d/%m')
-            horario_chegada_str = cliente.horario_chegada.strftime('%H:%M')
-            status_str = cliente.status.capitalize()
-            pdf.cell(60, 10, cliente.nome_cliente, 1, 0)
-            pdf.cell(20, 10, str(cliente.tamanho_grupo), 1, 0, 'C')
-            pdf.cell(30, 10, data_chegada_str, 1, 0, 'C')
-            pdf.cell(30, 10, horario_chegada_str, 1, 0, 'C')
-            pdf.cell(40, 10, status_str, 1, 1, 'C')
-
-    nome_ficheiro = f"relatorio_semanal_{hoje.strftime('%Y_%m_%d')}.pdf"
-    caminho_completo = f"relatorios/{nome_ficheiro}"
-    import os
-    os.makedirs("relatorios", exist_ok=True)
-    pdf.output(caminho_completo)
-    
-    return caminho_completo
-
-def gerar_relatorio_personalizado_pdf(db: Session, data_inicio: date, data_fim: date):
-    
-    clientes_periodo = crud.listar_clientes_por_periodo(db, data_inicio=data_inicio, data_fim=data_fim)
-    clientes_atendidos = [c for c in clientes_periodo if c.status == 'atendido' and c.horario_atendimento]
-    clientes_cancelados = len([c for c in clientes_periodo if c.status == 'cancelado'])
-
-    tempo_medio_espera = 0
-    if clientes_atendidos:
-        total_espera_segundos = sum((c.horario_atendimento - c.horario_chegada).total_seconds() for c in clientes_atendidos)
-        tempo_medio_espera = round((total_espera_segundos / len(clientes_atendidos)) / 60)
+def _linhas_agregadas(linhas: list, formatar_rotulo):
+    for rotulo, chegadas, atendidos, cancelados, espera in linhas:
+        yield [formatar_rotulo(rotulo), str(chegadas), str(atendidos), str(cancelados), str(espera)]
+
+def renderizar_relatorio_pdf(dados: DadosRelatorio) -> bytes:
+    """Monta o PDF inteiro em memória e devolve os bytes."""
+    layout = _LAYOUTS[dados.tipo]
 
     pdf = PDF()
     pdf.add_page()
     pdf.set_font('Arial', 'B', 14)
-    pdf.cell(0, 10, 'Relatório Personalizado de Atividade - MesaJa', 0, 1, 'C')
+    pdf.cell(0, 10, layout["titulo"], 0, 1, 'C')
     pdf.ln(5)
 
+    # RESUMO
     pdf.set_font('Arial', 'B', 12)
-    pdf.cell(0, 10, 'Resumo do Período', 0, 1, 'L')
+    pdf.cell(0, 10, layout["resumo"], 0, 1, 'L')
     pdf.set_font('Arial', '', 11)
-    pdf.cell(0, 8, f"Período: {data_inicio.strftime('%d/%m/%Y')} a {data_fim.strftime('%d/%m/%Y')}", 0, 1)
-    pdf.cell(0, 8, f"- Total de Clientes na Fila No Periodo Escolhido: {len(clientes_periodo)}", 0, 1)
-    pdf.cell(0, 8, f"- Total de Clientes Atendidos: {len(clientes_atendidos)}", 0, 1)
-    pdf.cell(0, 8, f"- Total de Desistências: {clientes_cancelados}", 0, 1)
-    
+    if dados.tipo == "diario":
+        pdf.cell(0, 8, f"Data do Relatório: {dados.data_fim.strftime('%d/%m/%Y')}", 0, 1)
+    else:
+        pdf.cell(0, 8, f"Período: {dados.data_inicio.strftime('%d/%m/%Y')} a {dados.data_fim.strftime('%d/%m/%Y')}", 0, 1)
+    pdf.cell(0, 8, f"{layout['total']}: {dados.total_clientes}", 0, 1)
+    pdf.cell(0, 8, f"- Total de Clientes Atendidos: {dados.total_atendidos}", 0, 1)
+    pdf.cell(0, 8, f"- Total de Desistências: {dados.total_cancelados}", 0, 1)
+
     pdf.set_font('Arial', 'B', 11)
-    pdf.cell(0, 8, f"- Tempo Médio de Espera: {tempo_medio_espera} minutos", 0, 1)
+    pdf.cell(0, 8, f"- Tempo Médio de Espera: {dados.tempo_medio_espera} minutos", 0, 1)
+    pdf.set_font('Arial', '', 11)
+    if dados.espera_p50 is not None:
+        pdf.cell(0, 8, f"- Espera Mediana / 90% dos Clientes (estimada): {dados.espera_p50} / {dados.espera_p90} minutos", 0, 1)
     pdf.ln(10)
 
+    if dados.detalhe_omitido:
+        # TOTAIS POR HORA E POR DIA (período grande demais para o registo linha a linha)
+        pdf.set_font('Arial', 'I', 10)
+        pdf.multi_cell(0, 6, f"O período tem mais de {RELATORIOS_MAX_LINHAS_DETALHE} clientes: o registo individual "
+                             "foi substituído por totais por hora e por dia.")
+        pdf.ln(4)
+        if dados.por_hora:
+            _grafico_barras(pdf, 'Chegadas por Hora do Dia',
+                            [f"{hora}h" for hora, *_ in dados.por_hora], [linha[1] for linha in dados.por_hora])
+            _tabela(pdf, [('Hora', 30)] + _COLUNAS_AGREGADAS,
+                    _linhas_agregadas(dados.por_hora, lambda hora: f"{hora:02d}:00"), 9)
+            pdf.ln(8)
+        if dados.por_dia:
+            _grafico_barras(pdf, 'Chegadas por Dia',
+                            [dia.strftime('%d/%m') for dia, *_ in dados.por_dia], [linha[1] for linha in dados.por_dia])
+            _tabela(pdf, [('Dia', 30)] + _COLUNAS_AGREGADAS,
+                    _linhas_agregadas(dados.por_dia, lambda dia: dia.strftime('%d/%m/%Y')), 9)
+        return bytes(pdf.output())
+
+    # TABELA DE CLIENTES
     pdf.set_font('Arial', 'B', 12)
-    pdf.cell(0, 10, 'Registo de Clientes no Período', 0, 1, 'L')
+    pdf.cell(0, 10, layout["registo"], 0, 1, 'L')
 
-    if not clientes_periodo:
+    if not dados.clientes:
         pdf.set_font('Arial', 'I', 11)
-        pdf.cell(0, 10, "Nenhuma atividade de clientes registada no período selecionado.", 0, 1)
+        pdf.cell(0, 10, layout["vazio"], 0, 1)
     else:
-        pdf.set_font('Arial', 'B', 10)
-        pdf.cell(60, 10, 'Cliente', 1, 0, 'C')
-        pdf.cell(20, 10, 'Grupo', 1, 0, 'C')
-        pdf.cell(30, 10, 'Data', 1, 0, 'C')
-        pdf.cell(30, 10, 'Chegada', 1, 0, 'C')
-        pdf.cell(40, 10, 'Status', 1, 1, 'C')
-        
-        pdf.set_font('Arial', '', 9)
-        for cliente in clientes_periodo:
-            data_chegada_str = cliente.horario_chegada.strftime('%d/%m/%y')
-            horario_chegada_str = cliente.horario_chegada.strftime('%H:%M')
-            status_str = cliente.status.capitalize()
-            pdf.cell(60, 10, cliente.nome_cliente, 1, 0)
-            pdf.cell(20, 10, str(cliente.tamanho_grupo), 1, 0, 'C')
-            pdf.cell(30, 10, data_chegada_str, 1, 0, 'C')
-            pdf.cell(30, 10, horario_chegada_str, 1, 0, 'C')
-            pdf.cell(40, 10, status_str, 1, 1, 'C')
-
-    nome_ficheiro = f"relatorio_personalizado_{data_inicio.strftime('%Y%m%d')}_a_{data_fim.strftime('%Y%m%d')}.pdf"
-    caminho_completo = f"relatorios/{nome_ficheiro}"
-    import os
-    os.makedirs("relatorios", exist_ok=True)
-    pdf.output(caminho_completo)
-    
-    return caminho_completo
\ No newline at end of file
+        linhas = (
+            [nome_cliente, str(tamanho_grupo)]
+            + [horario_chegada.strftime(formato) for formato in layout["formatos_chegada"]]
+            + [status.capitalize()]
+            for nome_cliente, tamanho_grupo, horario_chegada, status in dados.clientes
+        )
+        _tabela(pdf, layout["colunas"], linhas, layout["fonte_linhas"])
+
+    return bytes(pdf.output())
+
+
+# --- Cache dos PDFs gerados ---
+
+def calcular_etag(db: Session, tipo: str, data_inicio: date, data_fim: date) -> str:
+    """
+    ETag de um relatório a partir da versão dos dados do período (clientes da fila e linhas
+    do resumo, que a reconstrução pode reescrever): só muda quando alguma delas muda, por
+    isso pode ser calculado sem gerar o PDF.
+    """
+    versoes = (
+        *crud.obter_versao_clientes_por_periodo(db, data_inicio, data_fim),
+        *estatisticas.versao_periodo(db, data_inicio, data_fim),
+    )
+    chave = "|".join([tipo, data_inicio.isoformat(), data_fim.isoformat()] + [
+        valor.isoformat() if isinstance(valor, datetime) else "-" if valor is None else str(valor)
+        for valor in versoes
+    ])
+    return '"' + hashlib.sha1(chave.encode()).hexdigest() + '"'
+
+RELATORIOS_CACHE_MAX_BYTES = int(float(os.getenv("RELATORIOS_CACHE_MAX_MB", "64")) * 1024 * 1024)
+
+class CacheRelatorios:
+    """
+    PDFs já gerados, um por (tipo, período), guardados com o ETag da versão dos dados.
+    Quando os dados do período mudam o ETag muda e a entrada é substituída na próxima
+    geração. Acima do limite de tamanho descarta os relatórios usados há mais tempo.
+    """
+
+    def __init__(self, max_bytes: int = RELATORIOS_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entradas = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def obter(self, tipo: str, data_inicio: date, data_fim: date, etag: str):
+        """Devolve (nome_ficheiro, conteúdo) se o PDF em cache corresponder ao ETag atual."""
+        chave = (tipo, data_inicio, data_fim)
+        with self._lock:
+            entrada = self._entradas.get(chave)
+            if entrada is None or entrada[0] != etag:
+                return None
+            self._entradas.move_to_end(chave)
+            return entrada[1], entrada[2]
+
+    def guardar(self, tipo: str, data_inicio: date, data_fim: date, etag: str, nome_ficheiro: str, conteudo: bytes):
+        if len(conteudo) > self.max_bytes:
+            return
+        chave = (tipo, data_inicio, data_fim)
+        with self._lock:
+            anterior = self._entradas.pop(chave, None)
+            if anterior is not None:
+                self._bytes -= len(anterior[2])
+            self._entradas[chave] = (etag, nome_ficheiro, conteudo)
+            self._bytes += len(conteudo)
+            while self._bytes > self.max_bytes:
+                _, removida = self._entradas.popitem(last=False)
+                self._bytes -= len(removida[2])
+
+    def limpar(self):
+        with self._lock:
+            self._entradas.clear()
+            self._bytes = 0
+
+    def estado(self) -> dict:
+        with self._lock:
+            return {"relatorios": len(self._entradas), "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+cache_relatorios = CacheRelatorios()
@@ -1,21 +1,28 @@
 # back/routes.py
 from fastapi import APIRouter, Depends, HTTPException, Request, Form
-from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import IntegrityError
-from typing import List
-from datetime import date
+from typing import List, Optional
+from pydantic import TypeAdapter
+from datetime import date, datetime
+import asyncio
+from starlette.concurrency import run_in_threadpool
 
 # Importa 
 import crud
 import schemas
 import models
 import reports
-from database_config import get_db
+from relatorios_jobs import gestor_relatorios
+import exportacoes
+from versoes_recursos import lista_serializada
+import paginacao
+from database_config import get_db, get_db_sob_demanda, get_async_db, executar_no_banco, libertar_sessao, engine, estatisticas_pool
 from auth_logic import ADMIN_EMAIL, ADMIN_PASSWORD, ADMIN_NAME, PASSWORD_HINT_1, PASSWORD_HINT_2
-from notification_manager import get_notifications
-from telegram_sender import enviar_mensagem_privada
+from notification_manager import get_notifications, eventos_desde, assinar, cancelar_assinatura, formatar_evento_sse
+from telegram_sender import entregador_telegram, telegram_configurado, reenviar_falhadas
 
 router = APIRouter()
 templates = Jinja2Templates(directory="templates")
@@ -72,33 +79,61 @@ async def handle_logout():
 
 # --- Rotas da API de Mesas ---
 @router.post("/mesas/", response_model=schemas.MesaOut, tags=["Mesas"], status_code=201)
-async def criar_nova_mesa(mesa: schemas.MesaCreate, db: Session = Depends(get_db)):
+async def criar_nova_mesa(mesa: schemas.MesaCreate, db: Session = Depends(get_async_db)):
     try:
         nova_mesa = await crud.criar_mesa(db=db, mesa=mesa)
         return nova_mesa
     except IntegrityError:
         raise HTTPException(status_code=409, detail="Uma mesa com este número já existe.")
 
+# --- Listas com ETag: respondidas da memória (ou com 304) enquanto a versão do recurso não muda ---
+
+def _resposta_lista(request: Request, db: Session, recurso: str, parametros: tuple, consultar, adaptador: TypeAdapter, proximo=None) -> Response:
+    etag, corpo, proximo_cursor = lista_serializada(db, recurso, parametros, consultar, adaptador, proximo)
+    cabecalhos = {"ETag": etag, "Cache-Control": "no-cache"}
+    if proximo_cursor:
+        cabecalhos[paginacao.CABECALHO_PROXIMO_CURSOR] = proximo_cursor
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=cabecalhos)
+    return Response(content=corpo, media_type="application/json", headers=cabecalhos)
+
+_LISTA_MESAS = TypeAdapter(List[schemas.MesaOut])
+_LISTA_FILA = TypeAdapter(List[schemas.FilaOut])
+_LISTA_GARCONS = TypeAdapter(List[schemas.GarconOut])
+_LISTA_PROMOCOES = TypeAdapter(List[schemas.PromocaoOut])
+
+def _chave_do_cursor(cursor: Optional[str], decodificar):
+    """Converte o cursor opaco recebido na chave de ordenação; 400 se não for válido."""
+    if cursor is None:
+        return None
+    try:
+        return decodificar(cursor)
+    except ValueError as erro:
+        raise HTTPException(status_code=400, detail=str(erro))
+
 @router.get("/mesas/", response_model=List[schemas.MesaOut], tags=["Mesas"])
-def obter_mesas(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    return crud.listar_mesas(db, skip=skip, limit=limit)
+def obter_mesas(request: Request, skip: int = 0, limit: int = 100, cursor: Optional[str] = None, db: Session = Depends(get_db_sob_demanda)):
+    apos_numero = _chave_do_cursor(cursor, paginacao.chave_mesa)
+    return _resposta_lista(request, db, "mesas", (skip, limit, apos_numero),
+                           lambda db: crud.listar_mesas(db, skip=skip, limit=limit, apos_numero=apos_numero), _LISTA_MESAS,
+                           lambda linhas: paginacao.proximo_cursor(linhas, limit, paginacao.cursor_mesa))
 
 @router.put("/mesas/{mesa_id}", response_model=schemas.MesaOut, tags=["Mesas"])
-async def mudar_status_mesa(mesa_id: int, mesa_update: schemas.MesaUpdate, db: Session = Depends(get_db)):
+async def mudar_status_mesa(mesa_id: int, mesa_update: schemas.MesaUpdate, db: Session = Depends(get_async_db)):
     mesa = await crud.atualizar_status_mesa(db, mesa_id=mesa_id, novo_status=mesa_update.status)
     if not mesa:
         raise HTTPException(status_code=404, detail="Mesa não encontrada")
     return mesa
 
 @router.delete("/mesas/{mesa_id}", response_model=schemas.MesaOut, tags=["Mesas"])
-async def remover_mesa(mesa_id: int, db: Session = Depends(get_db)):
+async def remover_mesa(mesa_id: int, db: Session = Depends(get_async_db)):
     mesa_deletada = await crud.deletar_mesa(db, mesa_id=mesa_id)
     if not mesa_deletada:
         raise HTTPException(status_code=404, detail="Mesa não encontrada")
     return mesa_deletada
 
 @router.post("/mesas/{mesa_id}/atribuir-proximo", response_model=schemas.MesaOut, tags=["Mesas"])
-async def atribuir_cliente_mesa(mesa_id: int, db: Session = Depends(get_db)):
+async def atribuir_cliente_mesa(mesa_id: int, db: Session = Depends(get_async_db)):
     mesa_atualizada = await crud.atribuir_proximo_cliente(db, mesa_id=mesa_id)
     if not mesa_atualizada:
         raise HTTPException(status_code=404, detail="Mesa não encontrada ou fila vazia.")
@@ -131,58 +166,81 @@ def obter_mesa_por_id(mesa_id: int, db: Session = Depends(get_db)):
 #
 
 @router.post("/fila/", response_model=schemas.FilaOut, tags=["Fila"], status_code=201)
-async def entrar_na_fila(cliente: schemas.FilaCreate, db: Session = Depends(get_db)):
+async def entrar_na_fila(cliente: schemas.FilaCreate, db: Session = Depends(get_async_db)):
     return await crud.adicionar_cliente_fila(db=db, cliente=cliente)
 
 
 
 @router.get("/fila/", response_model=List[schemas.FilaOut], tags=["Fila"])
-def obter_fila_espera(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    return crud.listar_fila(db, skip=skip, limit=limit)
+def obter_fila_espera(request: Request, skip: int = 0, limit: int = 100, cursor: Optional[str] = None, db: Session = Depends(get_db_sob_demanda)):
+    apos = _chave_do_cursor(cursor, paginacao.chave_cliente)
+    return _resposta_lista(request, db, "fila", (skip, limit, apos),
+                           lambda db: crud.listar_fila(db, skip=skip, limit=limit, apos=apos), _LISTA_FILA,
+                           lambda linhas: paginacao.proximo_cursor(linhas, limit, paginacao.cursor_cliente))
 
 @router.put("/fila/{fila_id}", response_model=schemas.FilaOut, tags=["Fila"])
-async def modificar_cliente_fila(fila_id: int, cliente_update: schemas.FilaUpdate, db: Session = Depends(get_db)):
+async def modificar_cliente_fila(fila_id: int, cliente_update: schemas.FilaUpdate, db: Session = Depends(get_async_db)):
     cliente_atualizado = await crud.atualizar_cliente_fila(db, fila_id=fila_id, dados_atualizacao=cliente_update)
     if not cliente_atualizado:
         raise HTTPException(status_code=404, detail="Cliente na fila não encontrado")
     return cliente_atualizado
 
 @router.post("/fila/atender-proximo", tags=["Fila"])
-async def atender_proximo_cliente_da_fila(db: Session = Depends(get_db)):
+async def atender_proximo_cliente_da_fila(db: Session = Depends(get_async_db)):
     resultado = await crud.atender_proximo_da_fila(db)
     if not resultado["sucesso"]:
         raise HTTPException(status_code=409, detail=resultado["mensagem"])
-    numeros_mesas = ", ".join([str(m.numero) for m in resultado["mesas"]])
-    mensagem = f"Cliente {resultado['cliente'].nome_cliente} atendido na(s) Mesa(s) {numeros_mesas}."
+    mensagem = f"Cliente {resultado['nome_cliente']} atendido na(s) Mesa(s) {resultado['numeros_mesas']}."
     return {"detail": mensagem}
+
+@router.post("/fila/atender-lote", response_model=schemas.AtendimentoLoteOut, tags=["Fila"])
+async def atender_fila_em_lote(politica: str = "fifo", db: Session = Depends(get_async_db)):
+    """Atende de uma só vez todos os clientes da fila que couberem nas mesas livres."""
+    if politica not in crud.POLITICAS_ATENDIMENTO_LOTE:
+        raise HTTPException(status_code=422, detail=f"Política inválida. Use uma de: {', '.join(crud.POLITICAS_ATENDIMENTO_LOTE)}.")
+    atribuicoes = await crud.atender_fila_em_lote(db, politica=politica)
+    return {"politica": politica, "total_atendidos": len(atribuicoes), "atribuicoes": atribuicoes}
     
 # --- Rotas da API da Central de Interações ---
+LIMITE_MAXIMO_HISTORICO = 500
+
 @router.get("/historico-completo", response_model=List[schemas.FilaOut], tags=["Interações"])
-def obter_historico_completo(db: Session = Depends(get_db)):
-    return crud.listar_historico_completo(db)
+def obter_historico_completo(
+    response: Response, limit: int = 50, cursor: Optional[str] = None, after_id: Optional[int] = None,
+    db: Session = Depends(get_db)
+):
+    limit = max(1, min(limit, LIMITE_MAXIMO_HISTORICO))
+    historico = crud.listar_historico_completo(
+        db, limit=limit, antes=_chave_do_cursor(cursor, paginacao.chave_cliente), depois_do_id=after_id
+    )
+    # Com after_id só se pedem os clientes novos, para pôr no topo: não há página seguinte
+    proximo = None if after_id is not None else paginacao.proximo_cursor(historico, limit, paginacao.cursor_cliente)
+    if proximo:
+        response.headers[paginacao.CABECALHO_PROXIMO_CURSOR] = proximo
+    return historico
 
 @router.get("/metricas", tags=["Interações"])
-def obter_metricas(db: Session = Depends(get_db)):
+def obter_metricas(db: Session = Depends(get_db_sob_demanda)):
     return crud.calcular_metricas(db)
 
 # --- Rotas da API de Garçons ---
 @router.post("/garcons/", response_model=schemas.GarconOut, tags=["Garçons"])
-async def criar_novo_garcon(garcon: schemas.GarconCreate, db: Session = Depends(get_db)):
+async def criar_novo_garcon(garcon: schemas.GarconCreate, db: Session = Depends(get_async_db)):
     return await crud.criar_garcon(db=db, garcon=garcon)
 
 @router.get("/garcons/", response_model=List[schemas.GarconOut], tags=["Garçons"])
-def obter_garcons(db: Session = Depends(get_db)):
-    return crud.listar_garcons(db)
+def obter_garcons(request: Request, db: Session = Depends(get_db_sob_demanda)):
+    return _resposta_lista(request, db, "garcons", (), crud.listar_garcons, _LISTA_GARCONS)
 
 @router.put("/garcons/{garcon_id}", response_model=schemas.GarconOut, tags=["Garçons"])
-async def modificar_garcon(garcon_id: int, garcon_update: schemas.GarconUpdate, db: Session = Depends(get_db)):
+async def modificar_garcon(garcon_id: int, garcon_update: schemas.GarconUpdate, db: Session = Depends(get_async_db)):
     garcon_atualizado = await crud.atualizar_garcon(db, garcon_id=garcon_id, dados_atualizacao=garcon_update)
     if not garcon_atualizado:
         raise HTTPException(status_code=404, detail="Garçom não encontrado")
     return garcon_atualizado
 
 @router.delete("/garcons/{garcon_id}", response_model=schemas.GarconOut, tags=["Garçons"])
-async def remover_garcon(garcon_id: int, db: Session = Depends(get_db)):
+async def remover_garcon(garcon_id: int, db: Session = Depends(get_async_db)):
     garcon_deletado = await crud.deletar_garcon(db, garcon_id=garcon_id)
     if not garcon_deletado:
         raise HTTPException(status_code=404, detail="Garçom não encontrado")
@@ -190,48 +248,32 @@ async def remover_garcon(garcon_id: int, db: Session = Depends(get_db)):
 
 
 
-from telegram_sender import enviar_mensagem_privada, enviar_mensagem_para_grupo # Adicione o novo import
-
 @router.post("/garcons/{garcon_id}/enviar-mensagem", response_model=schemas.MensagemOut, tags=["Garçons"])
-async def enviar_mensagem_para_garcon(garcon_id: int, mensagem: schemas.MensagemEnvio, db: Session = Depends(get_db)):
+async def enviar_mensagem_para_garcon(garcon_id: int, mensagem: schemas.MensagemEnvio, db: Session = Depends(get_async_db)):
     """
     Endpoint para o admin enviar uma mensagem para um garçom.
-    Guarda a mensagem no banco, a envia via Telegram em privado E notifica o grupo.
+    Guarda a mensagem no banco e regista no outbox o envio privado E a cópia para o grupo.
     """
-    garcon = crud.buscar_garcon_por_id(db, garcon_id=garcon_id)
+    garcon = await executar_no_banco(db, crud.buscar_garcon_por_id, garcon_id=garcon_id)
     if not garcon:
         raise HTTPException(status_code=404, detail="Garçom não encontrado.")
     
     if not garcon.telegram_id:
         raise HTTPException(status_code=400, detail="Este garçom não tem um ID do Telegram cadastrado.")
 
-    # 1. Envia a mensagem privada para o garçom
-    sucesso_envio_privado = await enviar_mensagem_privada(user_id=garcon.telegram_id, mensagem=mensagem.texto)
-    
-    if not sucesso_envio_privado:
-        raise HTTPException(status_code=500, detail="Falha ao enviar a mensagem privada para o Telegram.")
-
-    # 2. Guarda a mensagem no nosso banco de dados
-    mensagem_db = schemas.MensagemCreate(
-        texto=mensagem.texto,
-        direcao="enviada", # Mensagem enviada pelo admin
-        garcon_id=garcon_id
-    )
-    mensagem_criada = await crud.criar_mensagem(db=db, mensagem=mensagem_db)
+    if not telegram_configurado():
+        raise HTTPException(status_code=500, detail="Telegram não configurado: a mensagem privada não pode ser enviada.")
 
-    # 3. (NOVO) Envia uma cópia da mensagem para o grupo
-    mensagem_para_grupo = f"*(Admin para {garcon.nome})*: {mensagem.texto}"
-    await enviar_mensagem_para_grupo(mensagem_para_grupo)
-    
-    return mensagem_criada
+    # A entrega no Telegram é feita em segundo plano pelo entregador do outbox
+    return await crud.enviar_mensagem_a_garcon(db, garcon=garcon, texto=mensagem.texto)
 
 
 # rota conversas
 
 @router.get("/garcons/by-telegram-id/{telegram_id}", response_model=schemas.GarconOut, tags=["Garçons"])
-def obter_garcon_por_telegram_id(telegram_id: str, db: Session = Depends(get_db)):
-    """Endpoint para encontrar um garçom pelo seu ID do Telegram."""
-    garcon = crud.buscar_garcon_por_telegram_id(db, telegram_id=telegram_id)
+def obter_garcon_por_telegram_id(telegram_id: str, db: Session = Depends(get_db_sob_demanda)):
+    """Endpoint para encontrar um garçom pelo seu ID do Telegram (servido de cache quando possível)."""
+    garcon = crud.buscar_garcon_por_telegram_id_em_cache(db, telegram_id=telegram_id)
     if not garcon:
         raise HTTPException(status_code=404, detail="Garçom com este ID do Telegram não foi encontrado.")
     return garcon
@@ -240,22 +282,22 @@ def obter_garcon_por_telegram_id(telegram_id: str, db: Session = Depends(get_db)
 
 # --- Rotas da API de Promoções ---
 @router.post("/promocoes/", response_model=schemas.PromocaoOut, tags=["Promoções"], status_code=201)
-async def criar_nova_promocao(promocao: schemas.PromocaoCreate, db: Session = Depends(get_db)):
+async def criar_nova_promocao(promocao: schemas.PromocaoCreate, db: Session = Depends(get_async_db)):
     return await crud.criar_promocao(db=db, promocao=promocao)
 
 @router.get("/promocoes/", response_model=List[schemas.PromocaoOut], tags=["Promoções"])
-def obter_promocoes(db: Session = Depends(get_db)):
-    return crud.listar_promocoes(db)
+def obter_promocoes(request: Request, db: Session = Depends(get_db_sob_demanda)):
+    return _resposta_lista(request, db, "promocoes", (), crud.listar_promocoes, _LISTA_PROMOCOES)
 
 @router.put("/promocoes/{promocao_id}", response_model=schemas.PromocaoOut, tags=["Promoções"])
-async def modificar_promocao(promocao_id: int, promocao_update: schemas.PromocaoUpdate, db: Session = Depends(get_db)):
+async def modificar_promocao(promocao_id: int, promocao_update: schemas.PromocaoUpdate, db: Session = Depends(get_async_db)):
     promocao_atualizada = await crud.atualizar_promocao(db, promocao_id=promocao_id, dados_atualizacao=promocao_update)
     if not promocao_atualizada:
         raise HTTPException(status_code=404, detail="Promoção não encontrada")
     return promocao_atualizada
 
 @router.delete("/promocoes/{promocao_id}", response_model=schemas.PromocaoOut, tags=["Promoções"])
-async def remover_promocao(promocao_id: int, db: Session = Depends(get_db)):
+async def remover_promocao(promocao_id: int, db: Session = Depends(get_async_db)):
     promocao_deletada = await crud.deletar_promocao(db, promocao_id=promocao_id)
     if not promocao_deletada:
         raise HTTPException(status_code=404, detail="Promoção não encontrada")
@@ -263,45 +305,239 @@ async def remover_promocao(promocao_id: int, db: Session = Depends(get_db)):
 
 # --- Rotas da API de Mensagens ---
 @router.post("/mensagens/", response_model=schemas.MensagemOut, tags=["Mensagens"])
-async def enviar_nova_mensagem(mensagem: schemas.MensagemCreate, db: Session = Depends(get_db)):
-    garcon = crud.buscar_garcon_por_id(db, garcon_id=mensagem.garcon_id)
+async def enviar_nova_mensagem(mensagem: schemas.MensagemCreate, db: Session = Depends(get_async_db)):
+    garcon = await executar_no_banco(db, crud.buscar_garcon_por_id, garcon_id=mensagem.garcon_id)
     if not garcon:
         raise HTTPException(status_code=404, detail="Garçom não encontrado para associar a mensagem.")
     return await crud.criar_mensagem(db=db, mensagem=mensagem)
 
+LIMITE_MAXIMO_MENSAGENS = 500
+ESPERA_MAXIMA_MENSAGENS_SEGUNDOS = 30
+
 @router.get("/mensagens/{garcon_id}", response_model=List[schemas.MensagemOut], tags=["Mensagens"])
-def obter_conversa_garcon(garcon_id: int, db: Session = Depends(get_db)):
-    return crud.listar_mensagens_por_garcon(db, garcon_id=garcon_id)
+async def obter_conversa_garcon(garcon_id: int, after_id: Optional[int] = None, before_id: Optional[int] = None,
+                                limit: int = 200, esperar: float = 0, db: Session = Depends(get_db_sob_demanda)):
+    """
+    Conversa com um garçom: as mais recentes, as seguintes a `after_id` ou as anteriores a `before_id`.
+    Com `after_id` e `esperar` (segundos, long-poll), se ainda não houver mensagens novas o pedido
+    fica à espera de uma, sem ocupar uma ligação ao banco, e devolve [] se o tempo acabar.
+    """
+    limit = max(1, min(limit, LIMITE_MAXIMO_MENSAGENS))
+    esperar = min(max(esperar, 0), ESPERA_MAXIMA_MENSAGENS_SEGUNDOS) if after_id is not None else 0
+    # Assina os eventos antes de consultar, para não perder uma mensagem gravada entre as duas coisas
+    fila_eventos = assinar() if esperar else None
+    try:
+        mensagens = await executar_no_banco(db, crud.listar_mensagens_por_garcon, garcon_id=garcon_id,
+                                            after_id=after_id, before_id=before_id, limit=limit)
+        if mensagens or not esperar:
+            return mensagens
+        await libertar_sessao(db)
+
+        limite = asyncio.get_running_loop().time() + esperar
+        while (restante := limite - asyncio.get_running_loop().time()) > 0:
+            try:
+                evento = await asyncio.wait_for(fila_eventos.get(), timeout=restante)
+            except asyncio.TimeoutError:
+                break
+            if evento["tipo"] == "mensagem" and evento["dados"].get("garcon_id") == garcon_id:
+                return await executar_no_banco(db, crud.listar_mensagens_por_garcon, garcon_id=garcon_id,
+                                               after_id=after_id, limit=limit)
+        return []
+    finally:
+        if fila_eventos is not None:
+            cancelar_assinatura(fila_eventos)
 
 # --- Rotas da API de Notificações ---
 @router.get("/notificacoes/", response_model=List[str], tags=["Notificações"])
 def ler_notificacoes():
     return get_notifications()
+
+@router.get("/eventos/historico", response_model=List[schemas.EventoOut], tags=["Notificações"])
+def ler_eventos_desde(desde: int = 0, limite: int = 100):
+    """Devolve, por ordem, os eventos com sequência maior do que `desde`."""
+    return eventos_desde(desde, limite)
+
+# Intervalo dos comentários de keep-alive, para proxies não fecharem a ligação ociosa
+INTERVALO_KEEP_ALIVE_EVENTOS = 15
+
+@router.get("/eventos", tags=["Notificações"])
+async def stream_eventos(request: Request):
+    """
+    Fluxo Server-Sent Events com notificações e alterações de fila, mesas, mensagens e promoções.
+    As páginas atualizam-se ao receber eventos, em vez de consultarem a API periodicamente.
+    Ao reconectar, o navegador envia o Last-Event-ID e recebe os eventos que perdeu.
+    """
+    ultimo_id = request.headers.get("last-event-id")
+
+    async def gerar_eventos():
+        fila_eventos = assinar()
+        try:
+            # Em caso de queda, o navegador tenta reconectar após 3 segundos
+            yield "retry: 3000\n\n"
+            ultimo_seq = 0
+            if ultimo_id and ultimo_id.isdigit():
+                for evento in await asyncio.to_thread(eventos_desde, int(ultimo_id), 500):
+                    ultimo_seq = evento["seq"]
+                    yield formatar_evento_sse(evento)
+            while not await request.is_disconnected():
+                try:
+                    evento = await asyncio.wait_for(fila_eventos.get(), timeout=INTERVALO_KEEP_ALIVE_EVENTOS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                # Eventos já enviados na recuperação acima
+                if evento["seq"] <= ultimo_seq:
+                    continue
+                yield formatar_evento_sse(evento)
+        finally:
+            cancelar_assinatura(fila_eventos)
+
+    return StreamingResponse(
+        gerar_eventos(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    
+# --- Rotas de Diagnóstico do Sistema ---
+@router.get("/sistema/pool", tags=["Sistema"])
+def obter_estatisticas_pool():
+    """Configuração e utilização do pool de ligações ao banco (checkouts, esperas e timeouts)."""
+    return estatisticas_pool.resumo(engine)
+
+@router.get("/sistema/telegram", tags=["Sistema"])
+def obter_estado_telegram(db: Session = Depends(get_db)):
+    """Estado do outbox do Telegram (mensagens por status) e contadores do entregador deste processo."""
+    return entregador_telegram.estado(db)
+
+@router.post("/sistema/telegram/reenviar", tags=["Sistema"])
+def reenviar_mensagens_telegram(desde: Optional[datetime] = None, db: Session = Depends(get_db)):
+    """Volta a pôr na fila as mensagens do outbox que falharam (opcionalmente só as criadas desde uma data)."""
+    return {"reenfileiradas": reenviar_falhadas(db, desde=desde)}
     
 # --- Rotas da API de Relatórios ---
+TAMANHO_BLOCO_PDF = 64 * 1024
+
+def _resposta_pdf(conteudo: bytes, nome_ficheiro: str, cabecalhos: dict = None) -> StreamingResponse:
+    """Envia o PDF gerado em memória em blocos, sem passar pelo disco."""
+    def blocos():
+        for inicio in range(0, len(conteudo), TAMANHO_BLOCO_PDF):
+            yield conteudo[inicio:inicio + TAMANHO_BLOCO_PDF]
+    return StreamingResponse(
+        blocos(),
+        media_type='application/pdf',
+        headers={
+            "Content-Disposition": f'attachment; filename="{nome_ficheiro}"',
+            "Content-Length": str(len(conteudo)),
+            **(cabecalhos or {}),
+        },
+    )
+
+async def _gerar_relatorio(request: Request, db: Session, tipo: str, data_inicio: date, data_fim: date) -> Response:
+    """
+    Serve o relatório a partir do cache se os dados do período não mudaram (ou 304, se o
+    navegador já o tem). Senão busca os dados, devolve a ligação ao pool e só depois
+    monta o PDF, fora do event loop.
+    """
+    etag = await executar_no_banco(db, reports.calcular_etag, tipo, data_inicio, data_fim)
+    cabecalhos = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in request.headers.get("if-none-match", ""):
+        await libertar_sessao(db)
+        return Response(status_code=304, headers=cabecalhos)
+
+    em_cache = reports.cache_relatorios.obter(tipo, data_inicio, data_fim, etag)
+    if not em_cache:
+        # Gerado por um trabalho (ex.: a pré-geração, talvez noutro worker) com os mesmos dados
+        em_cache = await run_in_threadpool(gestor_relatorios.pdf_pronto, tipo, data_inicio, data_fim, etag)
+        if em_cache:
+            reports.cache_relatorios.guardar(tipo, data_inicio, data_fim, etag, *em_cache)
+    if em_cache:
+        await libertar_sessao(db)
+        nome_ficheiro, conteudo = em_cache
+        return _resposta_pdf(conteudo, nome_ficheiro, cabecalhos)
+
+    dados = await executar_no_banco(db, reports.buscar_dados_relatorio, tipo, data_inicio, data_fim)
+    await libertar_sessao(db)
+    conteudo = await run_in_threadpool(reports.renderizar_relatorio_pdf, dados)
+    reports.cache_relatorios.guardar(tipo, data_inicio, data_fim, etag, dados.nome_ficheiro, conteudo)
+    return _resposta_pdf(conteudo, dados.nome_ficheiro, cabecalhos)
+
 @router.get("/relatorios/diario", tags=["Relatórios"])
-def gerar_relatorio_diario(db: Session = Depends(get_db)):
+async def gerar_relatorio_diario(request: Request, ate: Optional[date] = None, db: Session = Depends(get_async_db)):
+    """Relatório de hoje, ou do dia indicado em 'ate' (ex.: o de ontem, já pré-gerado)."""
     try:
-        caminho_pdf = reports.gerar_relatorio_diario_pdf(db)
-        return FileResponse(path=caminho_pdf, media_type='application/pdf', filename=caminho_pdf.split('/')[-1])
+        return await _gerar_relatorio(request, db, "diario", *reports.periodo_relatorio("diario", hoje=ate))
     except Exception as e:
         print(f"Erro ao gerar relatório: {e}")
         raise HTTPException(status_code=500, detail="Ocorreu um erro ao gerar o relatório PDF.")
 
 @router.get("/relatorios/semanal", tags=["Relatórios"])
-def gerar_relatorio_semanal(db: Session = Depends(get_db)):
+async def gerar_relatorio_semanal(request: Request, ate: Optional[date] = None, db: Session = Depends(get_async_db)):
+    """Relatório dos 7 dias até hoje, ou até ao dia indicado em 'ate'."""
     try:
-        caminho_pdf = reports.gerar_relatorio_semanal_pdf(db)
-        return FileResponse(path=caminho_pdf, media_type='application/pdf', filename=caminho_pdf.split('/')[-1])
+        return await _gerar_relatorio(request, db, "semanal", *reports.periodo_relatorio("semanal", hoje=ate))
     except Exception as e:
         print(f"Erro ao gerar relatório semanal: {e}")
         raise HTTPException(status_code=500, detail="Ocorreu um erro ao gerar o relatório PDF.")
 
 @router.get("/relatorios/personalizado", tags=["Relatórios"])
-def gerar_relatorio_personalizado(data_inicio: date, data_fim: date, db: Session = Depends(get_db)):
+async def gerar_relatorio_personalizado(request: Request, data_inicio: date, data_fim: date, db: Session = Depends(get_async_db)):
     try:
-        caminho_pdf = reports.gerar_relatorio_personalizado_pdf(db, data_inicio=data_inicio, data_fim=data_fim)
-        return FileResponse(path=caminho_pdf, media_type='application/pdf', filename=caminho_pdf.split('/')[-1])
+        return await _gerar_relatorio(request, db, "personalizado", data_inicio, data_fim)
     except Exception as e:
         print(f"Erro ao gerar relatório personalizado: {e}")
-        raise HTTPException(status_code=500, detail="Ocorreu um erro ao gerar o relatório PDF.")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Ocorreu um erro ao gerar o relatório PDF.")
+
+
+# --- Exportação do histórico (CSV / Parquet) ---
+
+@router.get("/relatorios/exportar/{recurso}", tags=["Relatórios"])
+def exportar_historico(recurso: str, data_inicio: date, data_fim: date, formato: str = "csv"):
+    """
+    Exporta 'fila', 'mensagens' ou 'atendimentos' do período. A resposta começa a ser
+    enviada logo e o banco é lido em blocos, por isso o período pode ser longo.
+    """
+    if recurso not in exportacoes.EXPORTACOES:
+        raise HTTPException(status_code=404, detail=f"Exportação desconhecida. Opções: {', '.join(exportacoes.EXPORTACOES)}.")
+    nome_ficheiro = f"{recurso}_{data_inicio.strftime('%Y%m%d')}_a_{data_fim.strftime('%Y%m%d')}.{formato}"
+    if formato == "csv":
+        conteudo, media_type = exportacoes.exportador.gerar_csv(recurso, data_inicio, data_fim), "text/csv; charset=utf-8"
+    elif formato == "parquet":
+        if not exportacoes.parquet_disponivel():
+            raise HTTPException(status_code=501, detail="Formato parquet indisponível: instale o pacote pyarrow no servidor.")
+        conteudo, media_type = exportacoes.exportador.gerar_parquet(recurso, data_inicio, data_fim), "application/vnd.apache.parquet"
+    else:
+        raise HTTPException(status_code=422, detail="Formato inválido. Use 'csv' ou 'parquet'.")
+    return StreamingResponse(conteudo, media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{nome_ficheiro}"'})
+
+
+# --- Trabalhos de relatório em segundo plano ---
+
+@router.post("/relatorios/jobs", response_model=schemas.RelatorioJobOut, status_code=202, tags=["Relatórios"])
+def criar_trabalho_relatorio(pedido: schemas.RelatorioJobCreate):
+    """Começa a gerar um relatório em segundo plano; o mesmo relatório já em curso não é gerado duas vezes."""
+    if pedido.tipo in ("diario", "semanal"):
+        data_inicio, data_fim = reports.periodo_relatorio(pedido.tipo)
+    elif pedido.tipo == "personalizado":
+        if pedido.data_inicio is None or pedido.data_fim is None:
+            raise HTTPException(status_code=422, detail="O relatório personalizado precisa de data_inicio e data_fim.")
+        data_inicio, data_fim = pedido.data_inicio, pedido.data_fim
+    else:
+        raise HTTPException(status_code=422, detail="Tipo de relatório inválido.")
+    return gestor_relatorios.submeter(pedido.tipo, data_inicio, data_fim).para_dict()
+
+@router.get("/relatorios/jobs/{trabalho_id}", response_model=schemas.RelatorioJobOut, tags=["Relatórios"])
+def obter_trabalho_relatorio(trabalho_id: str):
+    trabalho = gestor_relatorios.obter(trabalho_id, com_conteudo=False)
+    if trabalho is None:
+        raise HTTPException(status_code=404, detail="Trabalho de relatório não encontrado ou expirado")
+    return trabalho.para_dict()
+
+@router.get("/relatorios/jobs/{trabalho_id}/download", tags=["Relatórios"])
+def descarregar_trabalho_relatorio(trabalho_id: str):
+    trabalho = gestor_relatorios.obter(trabalho_id)
+    if trabalho is None:
+        raise HTTPException(status_code=404, detail="Trabalho de relatório não encontrado ou expirado")
+    if trabalho.conteudo is None:
+        raise HTTPException(status_code=409, detail=f"O relatório ainda não está pronto (estado: {trabalho.estado}).")
+    return _resposta_pdf(trabalho.conteudo, trabalho.nome_ficheiro)
@@ -1,7 +1,7 @@
 #schemas do Pydantic que definem a estrutura dos dados que a API recebe e envia
 
 from pydantic import BaseModel, ConfigDict
-from typing import Optional
+from typing import List, Optional
 
 
 class MesaBase(BaseModel):
@@ -26,7 +26,7 @@ class MesaUpdate(BaseModel):
     status: Optional[str] = None
     
 
-from datetime import datetime
+from datetime import date, datetime
 
 # --- Schemas para a Fila ---
 
@@ -51,6 +51,18 @@ class FilaUpdate(BaseModel):
     nome_cliente: Optional[str] = None
     tamanho_grupo: Optional[int] = None
     status: Optional[str] = None
+
+
+class AtribuicaoLote(BaseModel):
+    fila_id: int
+    nome_cliente: str
+    tamanho_grupo: int
+    mesas: List[int]
+
+class AtendimentoLoteOut(BaseModel):
+    politica: str
+    total_atendidos: int
+    atribuicoes: List[AtribuicaoLote]
     
     
     
@@ -126,4 +138,34 @@ class MensagemOut(MensagemBase):
 
 
 class MensagemEnvio(BaseModel):
-    texto: str
\ No newline at end of file
+    texto: str
+
+
+# --- Schemas para Eventos ---
+
+class EventoOut(BaseModel):
+    seq: int
+    tipo: str
+    dados: dict
+    criado_em: datetime
+
+
+# --- Schemas para os Trabalhos de Relatório ---
+
+class RelatorioJobCreate(BaseModel):
+    tipo: str  # 'diario', 'semanal' ou 'personalizado'
+    data_inicio: Optional[date] = None  # obrigatórias no personalizado
+    data_fim: Optional[date] = None
+
+class RelatorioJobOut(BaseModel):
+    id: str
+    tipo: str
+    data_inicio: date
+    data_fim: date
+    estado: str  # na_fila, a_buscar_dados, a_renderizar, concluido ou falhou
+    progresso: int
+    criado_em: datetime
+    concluido_em: Optional[datetime] = None
+    erro: Optional[str] = None
+    nome_ficheiro: Optional[str] = None
+    download: Optional[str] = None
@@ -1,50 +1,394 @@
-
-
 import os
+import asyncio
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+
 import telegram
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.helpers import escape_markdown
+from sqlalchemy import func
+from sqlalchemy.orm import Session
 from dotenv import load_dotenv
 
+import models
+
 load_dotenv()
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 TELEGRAM_GROUP_CHAT_ID = os.getenv("TELEGRAM_GROUP_CHAT_ID")
 
-async def enviar_mensagem_para_grupo(mensagem: str):
+# Limites do Telegram: ~30 mensagens/s no total, 20/min por grupo e ~1/s por conversa privada
+LIMITE_MENSAGENS_POR_SEGUNDO = 30
+INTERVALO_MINIMO_GRUPO_SEGUNDOS = 3.0
+INTERVALO_MINIMO_PRIVADA_SEGUNDOS = 1.0
+
+# Mensagens para o grupo que chegam dentro desta janela são juntadas numa só
+JANELA_COALESCENCIA_SEGUNDOS = float(os.getenv("TELEGRAM_JANELA_COALESCENCIA", "0.5"))
+TAMANHO_MAXIMO_MENSAGEM = 4096
+
+# De quanto em quanto tempo o entregador procura no outbox mensagens de outros processos e reenvios
+INTERVALO_SONDAGEM_OUTBOX_SEGUNDOS = float(os.getenv("TELEGRAM_OUTBOX_INTERVALO", "5"))
+TAMANHO_LOTE_OUTBOX = 50
+# Uma mensagem reservada por um processo que morreu volta a ficar disponível após este tempo
+ARRENDAMENTO_SEGUNDOS = 60
+
+MAXIMO_TENTATIVAS = 8
+ESPERA_INICIAL_SEGUNDOS = 2.0
+ESPERA_MAXIMA_SEGUNDOS = 600.0
+
+# Quanto tempo o encerramento espera pela entrega que estiver em curso
+TEMPO_MAXIMO_ENCERRAMENTO_SEGUNDOS = 10.0
+
+
+def escapar(texto) -> str:
     """
-    Envia uma mensagem de texto para o grupo de garçons no Telegram.
+    Escapa um texto para MarkdownV2 (todos os caracteres reservados). Use-o nos valores
+    interpolados das mensagens registadas com formatada=True.
     """
-    if not TELEGRAM_BOT_TOKEN or not TELEGRAM_GROUP_CHAT_ID:
-        print("AVISO: Token do Telegram ou ID do Chat não configurado. Mensagem não enviada.")
-        return
+    return escape_markdown(str(texto), version=2)
 
-    try:
-        bot = telegram.Bot(token=TELEGRAM_BOT_TOKEN)
-        mensagem_escapada = mensagem.replace('.', '\\.').replace('-', '\\-').replace('!', '\\!').replace('(', '\\(').replace(')', '\\)')
-        
-        await bot.send_message(
-            chat_id=TELEGRAM_GROUP_CHAT_ID, 
-            text=mensagem_escapada, 
-            parse_mode='MarkdownV2'
-        )
-        print(f"Mensagem enviada para o grupo do Telegram.")
-    except Exception as e:
-        print(f"ERRO ao enviar mensagem para o Telegram: {e}")
 
+# --- Registo no outbox (dentro da transação de quem chama) ---
 
-async def enviar_mensagem_privada(user_id: str, mensagem: str):
+def _registar(db: Session, chat_id: str, texto: str, grupo: bool, chave: str = None, formatada: bool = False) -> bool:
+    chave = chave or uuid.uuid4().hex
+    # O outbox guarda o texto já em MarkdownV2
+    texto = texto if formatada else escapar(texto)
+    # Idempotência: a mesma mensagem lógica (ex.: o atendimento de um cliente) só é registada uma vez
+    if db.query(models.MensagemOutbox.id).filter(models.MensagemOutbox.chave_idempotencia == chave).first():
+        return False
+    db.add(models.MensagemOutbox(chave_idempotencia=chave, chat_id=str(chat_id), texto=texto, grupo=grupo))
+    return True
+
+def registar_mensagem_grupo(db: Session, mensagem: str, chave: str = None, formatada: bool = False) -> bool:
     """
-    Envia uma mensagem de texto privada para um utilizador específico do Telegram.
+    Regista no outbox uma mensagem para o grupo de garçons, sem fazer commit:
+    ela só chega ao entregador se a transação de quem chama for confirmada.
+    O texto é escapado, a não ser que já venha em MarkdownV2 (formatada=True).
     """
+    if not TELEGRAM_BOT_TOKEN or not TELEGRAM_GROUP_CHAT_ID:
+        print("AVISO: Token do Telegram ou ID do Chat não configurado. Mensagem não enviada.")
+        return False
+    return _registar(db, TELEGRAM_GROUP_CHAT_ID, mensagem, grupo=True, chave=chave, formatada=formatada)
+
+def registar_mensagem_privada(db: Session, user_id: str, mensagem: str, chave: str = None, formatada: bool = False) -> bool:
+    """Regista no outbox uma mensagem privada para um utilizador do Telegram, sem fazer commit."""
     if not TELEGRAM_BOT_TOKEN:
         print("AVISO: Token do Telegram não configurado. Mensagem não enviada.")
         return False
-    try:
-        bot = telegram.Bot(token=TELEGRAM_BOT_TOKEN)
-        mensagem_escapada = mensagem.replace('.', '\\.').replace('-', '\\-').replace('!', '\\!')
-        
-        await bot.send_message(chat_id=user_id, text=mensagem_escapada, parse_mode='MarkdownV2')
-        print(f"Mensagem enviada para o utilizador {user_id}.")
+    return _registar(db, user_id, mensagem, grupo=False, chave=chave, formatada=formatada)
+
+def telegram_configurado() -> bool:
+    return bool(TELEGRAM_BOT_TOKEN)
+
+
+@dataclass
+class Envio:
+    chat_id: str
+    texto: str
+    grupo: bool
+    ids: list = field(default_factory=list)
+    tentativas: int = 0
+    textos: list = field(default_factory=list)  # o texto de cada mensagem juntada, pela ordem dos ids
+
+
+class EntregadorTelegram:
+    """
+    Entrega as mensagens do outbox com um único Bot (e pool HTTP) reutilizado.
+    Reserva lotes de mensagens pendentes, respeita os limites do Telegram, junta
+    rajadas de mensagens para o grupo e reagenda as falhas com espera exponencial.
+    Uma mensagem só é marcada como enviada depois de o Telegram a aceitar, por isso
+    a entrega é "pelo menos uma vez".
+    """
+
+    def __init__(self, token: str = None, bot=None, session_factory=None,
+                 intervalo_grupo: float = INTERVALO_MINIMO_GRUPO_SEGUNDOS,
+                 intervalo_privada: float = INTERVALO_MINIMO_PRIVADA_SEGUNDOS,
+                 janela_coalescencia: float = JANELA_COALESCENCIA_SEGUNDOS,
+                 intervalo_sondagem: float = INTERVALO_SONDAGEM_OUTBOX_SEGUNDOS,
+                 espera_inicial: float = ESPERA_INICIAL_SEGUNDOS):
+        self._token = token
+        self._bot = bot
+        self._session_factory = session_factory
+        self.intervalo_grupo = intervalo_grupo
+        self.intervalo_privada = intervalo_privada
+        self.janela_coalescencia = janela_coalescencia
+        self.intervalo_sondagem = intervalo_sondagem
+        self.espera_inicial = espera_inicial
+
+        self._loop = None
+        self._acordar = None
+        self._tarefa = None
+        self._ocupado = False
+
+        self._ultimo_envio_por_chat = {}
+        self._envios_ultimo_segundo = deque()
+
+        self.enviadas = 0
+        self.coalescidas = 0
+        self.falhas = 0
+
+    def _sessao(self):
+        if self._session_factory is None:
+            from database_config import SessionLocal
+            self._session_factory = SessionLocal
+        return self._session_factory()
+
+    # --- Ciclo de vida ---
+
+    async def iniciar(self):
+        """Arranca a tarefa de entrega no loop atual (chamado no arranque da aplicação)."""
+        if self._bot is None:
+            if not self._token:
+                print("AVISO: Token do Telegram não configurado. Entregador do outbox não iniciado.")
+                return
+            self._bot = telegram.Bot(token=self._token)
+        self._loop = asyncio.get_running_loop()
+        self._acordar = asyncio.Event()
+        # Logo no arranque entrega o que ficou pendente (ex.: durante uma indisponibilidade)
+        self._acordar.set()
+        self._tarefa = asyncio.create_task(self._executar())
+
+    async def parar(self):
+        """Espera pela entrega em curso (até alguns segundos) e encerra a tarefa e o cliente HTTP."""
+        if self._tarefa is None:
+            return
+        limite = time.monotonic() + TEMPO_MAXIMO_ENCERRAMENTO_SEGUNDOS
+        while self._ocupado and time.monotonic() < limite and not self._tarefa.done():
+            await asyncio.sleep(0.1)
+        self._tarefa.cancel()
+        try:
+            await self._tarefa
+        except asyncio.CancelledError:
+            pass
+        self._tarefa = None
+        if self._token:
+            try:
+                await self._bot.shutdown()
+            except Exception:
+                pass
+            self._bot = None
+
+    def acordar(self):
+        """Avisa o entregador de que há mensagens novas no outbox (pode ser chamado de qualquer thread)."""
+        if self._loop is None or self._acordar is None or self._loop.is_closed():
+            return
+        try:
+            if asyncio.get_running_loop() is self._loop:
+                self._acordar.set()
+                return
+        except RuntimeError:
+            pass
+        self._loop.call_soon_threadsafe(self._acordar.set)
+
+    def estado(self, db: Session) -> dict:
+        por_status = dict(db.query(
+            models.MensagemOutbox.status, func.count(models.MensagemOutbox.id)
+        ).group_by(models.MensagemOutbox.status).all())
+        return {
+            "ativo": self._tarefa is not None and not self._tarefa.done(),
+            "outbox": por_status,
+            "enviadas": self.enviadas,
+            "coalescidas": self.coalescidas,
+            "falhas": self.falhas,
+        }
+
+    # --- Tarefa de entrega ---
+
+    async def _executar(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._acordar.wait(), timeout=self.intervalo_sondagem)
+            except asyncio.TimeoutError:
+                pass
+            self._acordar.clear()
+            self._ocupado = True
+            try:
+                # Dá tempo a que uma rajada de mensagens chegue para ser juntada
+                await asyncio.sleep(self.janela_coalescencia)
+                await self.entregar_pendentes()
+            except Exception as e:
+                print(f"ERRO no entregador do Telegram: {e}")
+            finally:
+                self._ocupado = False
+
+    async def entregar_pendentes(self):
+        """Reserva e entrega lotes do outbox até não haver mais nada pronto a enviar."""
+        while True:
+            lote = await asyncio.to_thread(self.reservar_lote)
+            if not lote:
+                return
+            for envio in self.agrupar(lote):
+                await self._entregar(envio)
+
+    def reservar_lote(self) -> list:
+        """
+        Reserva mensagens prontas a enviar. A reserva é um UPDATE condicional ao estado
+        lido, por isso dois processos nunca ficam com a mesma mensagem.
+        """
+        agora = datetime.utcnow()
+        with self._sessao() as db:
+            candidatos = db.query(
+                models.MensagemOutbox.id, models.MensagemOutbox.status, models.MensagemOutbox.proxima_tentativa
+            ).filter(
+                models.MensagemOutbox.status.in_(("pendente", "enviando")),
+                models.MensagemOutbox.proxima_tentativa <= agora
+            ).order_by(models.MensagemOutbox.id).limit(TAMANHO_LOTE_OUTBOX).all()
+
+            reservados = []
+            for id_, status, proxima_tentativa in candidatos:
+                atualizadas = db.query(models.MensagemOutbox).filter(
+                    models.MensagemOutbox.id == id_,
+                    models.MensagemOutbox.status == status,
+                    models.MensagemOutbox.proxima_tentativa == proxima_tentativa
+                ).update({
+                    "status": "enviando",
+                    "proxima_tentativa": agora + timedelta(seconds=ARRENDAMENTO_SEGUNDOS),
+                }, synchronize_session=False)
+                if atualizadas:
+                    reservados.append(id_)
+            db.commit()
+            if not reservados:
+                return []
+
+            registos = db.query(models.MensagemOutbox).filter(
+                models.MensagemOutbox.id.in_(reservados)
+            ).order_by(models.MensagemOutbox.id).all()
+            return [
+                {"id": r.id, "chat_id": r.chat_id, "texto": r.texto, "grupo": r.grupo, "tentativas": r.tentativas}
+                for r in registos
+            ]
+
+    def agrupar(self, lote: list) -> list:
+        """Converte o lote em envios, juntando mensagens seguidas para o mesmo grupo enquanto couberem."""
+        envios = []
+        for registo in lote:
+            texto = registo["texto"]
+            anterior = envios[-1] if envios else None
+            if (anterior is not None and registo["grupo"] and anterior.grupo
+                    and anterior.chat_id == registo["chat_id"]
+                    and len(anterior.texto) + 2 + len(texto) <= TAMANHO_MAXIMO_MENSAGEM):
+                anterior.texto += "\n\n" + texto
+                anterior.ids.append(registo["id"])
+                anterior.textos.append(texto)
+                anterior.tentativas = max(anterior.tentativas, registo["tentativas"])
+                self.coalescidas += 1
+                continue
+            envios.append(Envio(chat_id=registo["chat_id"], texto=texto, grupo=registo["grupo"],
+                                ids=[registo["id"]], tentativas=registo["tentativas"], textos=[texto]))
+        return envios
+
+    async def _entregar(self, envio: Envio):
+        await self._respeitar_limites(envio)
+        try:
+            await self._bot.send_message(chat_id=envio.chat_id, text=envio.texto, parse_mode='MarkdownV2')
+        except RetryAfter as e:
+            # O próprio Telegram diz quanto esperar; não conta como tentativa falhada
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+            await asyncio.to_thread(self._reagendar, envio.ids, retry_after, str(e), False)
+            return False
+        except BadRequest as e:
+            if len(envio.ids) > 1:
+                # Numa rajada juntada, uma só mensagem inválida rejeita o texto todo: cada uma vai sozinha
+                print(f"AVISO: rajada rejeitada pelo Telegram ({envio.chat_id}), a enviar uma a uma: {e}")
+                entregues = False
+                for mensagem_id, texto in zip(envio.ids, envio.textos):
+                    sozinha = Envio(chat_id=envio.chat_id, texto=texto, grupo=envio.grupo,
+                                    ids=[mensagem_id], tentativas=envio.tentativas, textos=[texto])
+                    entregues = await self._entregar(sozinha) or entregues
+                return entregues
+            # Texto inválido: repetir não adianta
+            print(f"ERRO ao enviar mensagem para o Telegram ({envio.chat_id}): {e}")
+            await asyncio.to_thread(self._marcar_falha, envio.ids, str(e), False)
+            self.falhas += len(envio.ids)
+            return False
+        except Forbidden as e:
+            # Bot bloqueado ou fora do chat: repetir não adianta
+            print(f"ERRO ao enviar mensagem para o Telegram ({envio.chat_id}): {e}")
+            await asyncio.to_thread(self._marcar_falha, envio.ids, str(e), False)
+            self.falhas += len(envio.ids)
+            return False
+        except Exception as e:
+            if envio.tentativas + 1 >= MAXIMO_TENTATIVAS:
+                print(f"ERRO ao enviar mensagem para o Telegram ({envio.chat_id}), desistindo: {e}")
+                await asyncio.to_thread(self._marcar_falha, envio.ids, str(e), True)
+                self.falhas += len(envio.ids)
+                return False
+            print(f"AVISO: falha ao enviar para o Telegram (tentativa {envio.tentativas + 1}): {e}")
+            espera = min(self.espera_inicial * (2 ** envio.tentativas), ESPERA_MAXIMA_SEGUNDOS)
+            await asyncio.to_thread(self._reagendar, envio.ids, espera, str(e), True)
+            return False
+
+        await asyncio.to_thread(self._marcar_enviadas, envio.ids)
+        self.enviadas += len(envio.ids)
+        print(f"Mensagem enviada para o chat {envio.chat_id} do Telegram.")
         return True
-    except Exception as e:
-        print(f"ERRO ao enviar mensagem privada para {user_id}: {e}")
-        return False
\ No newline at end of file
+
+    def _atualizar(self, ids: list, valores: dict):
+        with self._sessao() as db:
+            db.query(models.MensagemOutbox).filter(
+                models.MensagemOutbox.id.in_(ids)
+            ).update(valores, synchronize_session=False)
+            db.commit()
+
+    def _marcar_enviadas(self, ids: list):
+        self._atualizar(ids, {"status": "enviada", "enviada_em": datetime.utcnow(), "ultimo_erro": None})
+
+    def _reagendar(self, ids: list, segundos: float, erro: str, conta_tentativa: bool):
+        valores = {
+            "status": "pendente",
+            "proxima_tentativa": datetime.utcnow() + timedelta(seconds=segundos),
+            "ultimo_erro": erro[:500],
+        }
+        if conta_tentativa:
+            valores["tentativas"] = models.MensagemOutbox.tentativas + 1
+        self._atualizar(ids, valores)
+
+    def _marcar_falha(self, ids: list, erro: str, conta_tentativa: bool):
+        valores = {"status": "falhou", "ultimo_erro": erro[:500]}
+        if conta_tentativa:
+            valores["tentativas"] = models.MensagemOutbox.tentativas + 1
+        self._atualizar(ids, valores)
+
+    async def _respeitar_limites(self, envio: Envio):
+        intervalo = self.intervalo_grupo if envio.grupo else self.intervalo_privada
+        ultimo = self._ultimo_envio_por_chat.get(envio.chat_id)
+        if ultimo is not None:
+            falta = ultimo + intervalo - time.monotonic()
+            if falta > 0:
+                await asyncio.sleep(falta)
+
+        agora = time.monotonic()
+        while self._envios_ultimo_segundo and agora - self._envios_ultimo_segundo[0] >= 1:
+            self._envios_ultimo_segundo.popleft()
+        if len(self._envios_ultimo_segundo) >= LIMITE_MENSAGENS_POR_SEGUNDO:
+            await asyncio.sleep(1 - (agora - self._envios_ultimo_segundo[0]))
+
+        agora = time.monotonic()
+        self._ultimo_envio_por_chat[envio.chat_id] = agora
+        self._envios_ultimo_segundo.append(agora)
+
+
+# Instância única: um só Bot e um só pool de ligações por processo
+entregador_telegram = EntregadorTelegram(token=TELEGRAM_BOT_TOKEN)
+
+
+def reenviar_falhadas(db: Session, desde: datetime = None) -> int:
+    """
+    Volta a pôr na fila as mensagens que falharam (ex.: depois de uma indisponibilidade
+    do Telegram), opcionalmente só as criadas a partir de `desde`. Devolve quantas foram.
+    """
+    consulta = db.query(models.MensagemOutbox).filter(models.MensagemOutbox.status == "falhou")
+    if desde is not None:
+        consulta = consulta.filter(models.MensagemOutbox.criado_em >= desde)
+    total = consulta.update({
+        "status": "pendente",
+        "tentativas": 0,
+        "proxima_tentativa": datetime.utcnow(),
+    }, synchronize_session=False)
+    db.commit()
+    entregador_telegram.acordar()
+    return total
@@ -12,7 +12,15 @@ import sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from main_app import app
-from database_config import Base, get_db
+from database_config import Base, get_db, get_db_sob_demanda, get_async_db
+import crud
+import reports
+from relatorios_jobs import gestor_relatorios
+from metricas import painel_metricas
+from versoes_recursos import versoes_recursos, cache_listas
+from alocacao_mesas import motor_alocacao
+from fila_espera import indice_fila
+import notification_manager
 
 # Configura um banco de dados SQLite em memória para os testes
 SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
@@ -29,6 +37,16 @@ TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engin
 def db_session():
     """Cria e destrói as tabelas para cada teste"""
     Base.metadata.create_all(bind=engine)
+    # Os índices em memória não podem sobreviver ao banco do teste anterior
+    motor_alocacao.invalidar()
+    indice_fila.invalidar()
+    notification_manager.configurar_backend(notification_manager.BackendNotificacoesMemoria())
+    crud.cache_garcons_por_telegram_id.limpar()
+    reports.cache_relatorios.limpar()
+    gestor_relatorios.limpar()
+    painel_metricas.invalidar()
+    versoes_recursos.limpar()
+    cache_listas.limpar()
     db = TestingSessionLocal()
     try:
         yield db
@@ -43,5 +61,9 @@ def client(db_session):
         yield db_session
 
     app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_db_sob_demanda] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_db
     yield TestClient(app)
-    del app.dependency_overrides[get_db]
\ No newline at end of file
+    del app.dependency_overrides[get_db]
+    del app.dependency_overrides[get_db_sob_demanda]
+    del app.dependency_overrides[get_async_db]
\ No newline at end of file
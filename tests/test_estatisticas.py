@@ -0,0 +1,63 @@
+# back/tests/test_estatisticas.py
+from datetime import date
+
+from fastapi.testclient import TestClient
+
+import estatisticas
+import models
+
+
+def _linhas(db_session):
+    db_session.expire_all()
+    return {
+        (e.dia, e.hora): {c: getattr(e, c) for c in estatisticas.CONTADORES}
+        for e in db_session.query(models.EstatisticaDiaria).all()
+    }
+
+
+def test_estatisticas_acompanham_a_fila_e_batem_com_a_reconstrucao(client: TestClient, db_session):
+    """Testa a manutenção incremental nas entradas e mudanças de status, comparando com o backfill."""
+    client.post("/mesas/", json={"numero": 1, "capacidade": 4})
+    client.post("/fila/", json={"nome_cliente": "Ana", "tamanho_grupo": 2})
+    desistente = client.post("/fila/", json={"nome_cliente": "Rui", "tamanho_grupo": 7}).json()
+    client.post("/fila/atender-proximo")
+    client.put(f"/fila/{desistente['id']}", json={"status": "cancelado"})
+
+    resumo = estatisticas.resumo_periodo(db_session, date.min, date.max)
+    assert resumo["chegadas"] == 2
+    assert resumo["atendidos"] == 1
+    assert resumo["cancelados"] == 1
+    assert resumo["grupos_1_2"] == 1 and resumo["grupos_7_mais"] == 1
+    assert resumo["espera_ate_10"] == 1
+
+    incrementais = _linhas(db_session)
+    estatisticas.reconstruir(db_session)
+    assert _linhas(db_session) == incrementais
+
+
+def test_percentil_estimado_pelo_histograma():
+    """Testa a interpolação do percentil dentro dos baldes do histograma de espera."""
+    totais = dict.fromkeys(estatisticas.CONTADORES, 0)
+    totais.update({"espera_ate_10": 5, "espera_10_20": 5})
+    assert estatisticas.estimar_percentil_espera(totais, 0.5) == 10
+    assert estatisticas.estimar_percentil_espera(totais, 0.9) == 18
+
+
+def test_edicoes_na_fila_batem_com_a_reconstrucao(client: TestClient, db_session):
+    """Testa que mudar o tamanho do grupo (com e sem mudança de status) move o cliente de balde de grupo."""
+    ana = client.post("/fila/", json={"nome_cliente": "Ana", "tamanho_grupo": 2}).json()
+    rui = client.post("/fila/", json={"nome_cliente": "Rui", "tamanho_grupo": 3}).json()
+    client.put(f"/fila/{ana['id']}", json={"tamanho_grupo": 8})
+    client.put(f"/fila/{ana['id']}", json={"nome_cliente": "Ana Maria"})
+    client.put(f"/fila/{rui['id']}", json={"tamanho_grupo": 5, "status": "cancelado"})
+    client.put(f"/fila/{rui['id']}", json={"status": "aguardando"})
+
+    resumo = estatisticas.resumo_periodo(db_session, date.min, date.max)
+    assert resumo["chegadas"] == 2
+    assert resumo["grupos_1_2"] == 0 and resumo["grupos_3_4"] == 0
+    assert resumo["grupos_5_6"] == 1 and resumo["grupos_7_mais"] == 1
+    assert resumo["cancelados"] == 0
+
+    incrementais = _linhas(db_session)
+    estatisticas.reconstruir(db_session)
+    assert _linhas(db_session) == incrementais
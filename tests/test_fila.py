@@ -1,5 +1,23 @@
 # back/tests/test_fila.py
+import asyncio
+import os
+import threading
+from datetime import datetime
+
+import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+import alocacao_mesas
+import crud
+import models
+import notification_manager
+import routes
+from alocacao_mesas import motor_alocacao
+from database_config import Base
+from fila_espera import indice_fila
 
 
 def test_adicionar_cliente_a_fila(client: TestClient):
@@ -74,6 +92,28 @@ def test_atender_proximo_sem_mesas_disponiveis(client: TestClient):
     print(" Teste de Atendimento Sem Mesas: OK")
 
 
+def test_mesa_libertada_fora_do_processo_volta_ao_indice(client: TestClient, db_session, monkeypatch):
+    """Testa se uma mesa libertada por outro processo é usada: pelo evento e, sem ele, recarregando ao não achar mesas."""
+    mesa = client.post("/mesas/", json={"numero": 41, "capacidade": 4}).json()
+    client.post("/fila/", json={"nome_cliente": "Primeiro", "tamanho_grupo": 2})
+    assert client.post("/fila/atender-proximo").status_code == 200
+
+    # Outro processo liberta a mesa e publica o evento
+    db_session.query(models.Mesa).filter(models.Mesa.id == mesa["id"]).update({"status": "disponivel"})
+    db_session.commit()
+    notification_manager._notificar_observadores(
+        {"tipo": "mesa", "dados": {"acao": "status", "ids": [mesa["id"]], "status": "disponivel"}})
+    client.post("/fila/", json={"nome_cliente": "Segundo", "tamanho_grupo": 2})
+    assert client.post("/fila/atender-proximo").status_code == 200
+
+    # Edição direta no banco, sem evento: o pedido sem mesas recarrega o índice
+    db_session.query(models.Mesa).filter(models.Mesa.id == mesa["id"]).update({"status": "disponivel"})
+    db_session.commit()
+    client.post("/fila/", json={"nome_cliente": "Terceiro", "tamanho_grupo": 2})
+    monkeypatch.setattr(alocacao_mesas, "INTERVALO_MINIMO_RECARGA_SEGUNDOS", 0)
+    assert client.post("/fila/atender-proximo").status_code == 200
+
+
 def test_atender_grupo_grande_combinando_mesas(client: TestClient):
     """Testa a lógica inteligente de juntar mesas para um grupo grande."""
     # 1. Cria duas mesas pequenas
@@ -102,4 +142,280 @@ def test_atender_grupo_grande_combinando_mesas(client: TestClient):
     # 5. Verifica se a fila ficou vazia
     response_fila = client.get("/fila/")
     assert len(response_fila.json()) == 0
-    print(" Teste de Atendimento com Mesas Combinadas: OK")
\ No newline at end of file
+    print(" Teste de Atendimento com Mesas Combinadas: OK")
+
+def test_atender_escolhe_a_menor_mesa_que_comporta(client: TestClient):
+    """Testa se o grupo é alocado na mesa com menos lugares sobrando."""
+    client.post("/mesas/", json={"numero": 401, "capacidade": 8})
+    client.post("/mesas/", json={"numero": 402, "capacidade": 4})
+    client.post("/mesas/", json={"numero": 403, "capacidade": 2})
+    client.post("/fila/", json={"nome_cliente": "Casal Mais Um", "tamanho_grupo": 3})
+
+    response = client.post("/fila/atender-proximo")
+    assert response.status_code == 200
+    assert "Mesa(s) 402." in response.json()["detail"]
+
+
+def test_atender_grupo_juntando_tres_mesas(client: TestClient):
+    """Testa se o motor encontra a combinação de três mesas com menor desperdício."""
+    client.post("/mesas/", json={"numero": 501, "capacidade": 2})
+    client.post("/mesas/", json={"numero": 502, "capacidade": 2})
+    client.post("/mesas/", json={"numero": 503, "capacidade": 2})
+    client.post("/mesas/", json={"numero": 504, "capacidade": 4})
+    mesa_suja = client.post("/mesas/", json={"numero": 505, "capacidade": 6}).json()
+    client.put(f"/mesas/{mesa_suja['id']}", json={"status": "suja"})
+    client.post("/fila/", json={"nome_cliente": "Aniversario", "tamanho_grupo": 8})
+
+    response = client.post("/fila/atender-proximo")
+    assert response.status_code == 200
+    assert "Mesa(s) 501, 502, 504" in response.json()["detail"]
+
+
+def test_atender_lote_fifo_para_no_primeiro_que_nao_cabe(client: TestClient):
+    """Testa se a política FIFO estrita não deixa grupos menores passarem à frente."""
+    client.post("/mesas/", json={"numero": 601, "capacidade": 4})
+    client.post("/mesas/", json={"numero": 602, "capacidade": 2})
+    client.post("/fila/", json={"nome_cliente": "Primeiro", "tamanho_grupo": 4})
+    client.post("/fila/", json={"nome_cliente": "Grande Demais", "tamanho_grupo": 8})
+    client.post("/fila/", json={"nome_cliente": "Casal", "tamanho_grupo": 2})
+
+    response = client.post("/fila/atender-lote?politica=fifo")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["total_atendidos"] == 1
+    assert data["atribuicoes"][0]["nome_cliente"] == "Primeiro"
+    assert data["atribuicoes"][0]["mesas"] == [601]
+    assert len(client.get("/fila/").json()) == 2
+
+
+def test_atender_lote_com_avanco(client: TestClient):
+    """Testa se a política com avanço atende os grupos que cabem, mantendo o grande na fila."""
+    client.post("/mesas/", json={"numero": 701, "capacidade": 4})
+    client.post("/mesas/", json={"numero": 702, "capacidade": 2})
+    client.post("/fila/", json={"nome_cliente": "Primeiro", "tamanho_grupo": 4})
+    client.post("/fila/", json={"nome_cliente": "Grande Demais", "tamanho_grupo": 8})
+    client.post("/fila/", json={"nome_cliente": "Casal", "tamanho_grupo": 2})
+
+    response = client.post("/fila/atender-lote?politica=fifo_com_avanco")
+    assert response.status_code == 200
+    atribuicoes = response.json()["atribuicoes"]
+    assert [(a["nome_cliente"], a["mesas"]) for a in atribuicoes] == [("Primeiro", [701]), ("Casal", [702])]
+
+    fila = client.get("/fila/").json()
+    assert [c["nome_cliente"] for c in fila] == ["Grande Demais"]
+    mesas = client.get("/mesas/").json()
+    assert all(m["status"] == "ocupada" for m in mesas)
+
+
+def test_atender_lote_politica_invalida(client: TestClient):
+    """Testa se uma política desconhecida é rejeitada."""
+    response = client.post("/fila/atender-lote?politica=aleatoria")
+    assert response.status_code == 422
+
+
+def test_paginacao_por_cursor_do_historico_e_das_mesas(client: TestClient, db_session, monkeypatch):
+    """Testa se os cursores percorrem histórico, fila e mesas sem repetir nem saltar linhas, mesmo com chegadas no mesmo instante."""
+    mesmo_instante = datetime(2025, 5, 1, 20, 0)
+    db_session.add_all([models.Fila(nome_cliente=f"Cliente {i}", tamanho_grupo=2, horario_chegada=mesmo_instante) for i in range(5)])
+    db_session.commit()
+
+    vistos, cursor = [], None
+    while True:
+        response = client.get("/historico-completo", params={"limit": 2, **({"cursor": cursor} if cursor else {})})
+        assert response.status_code == 200
+        vistos += [c["id"] for c in response.json()]
+        cursor = response.headers.get("X-Proximo-Cursor")
+        if not cursor:
+            break
+    assert vistos == sorted(vistos, reverse=True) and len(set(vistos)) == 5
+
+    # O limite do histórico é limitado, como o das mensagens; o resto fica para a página seguinte
+    monkeypatch.setattr(routes, "LIMITE_MAXIMO_HISTORICO", 3)
+    limitada = client.get("/historico-completo", params={"limit": 1000})
+    assert len(limitada.json()) == 3 and "X-Proximo-Cursor" in limitada.headers
+    assert len(client.get("/historico-completo", params={"limit": 0}).json()) == 1
+
+    # Fila de espera: os mesmos clientes, por ordem de chegada e depois de id
+    vistos, cursor = [], None
+    while True:
+        response = client.get("/fila/", params={"limit": 2, **({"cursor": cursor} if cursor else {})})
+        assert response.status_code == 200
+        vistos += [c["id"] for c in response.json()]
+        cursor = response.headers.get("X-Proximo-Cursor")
+        if not cursor:
+            break
+    assert vistos == sorted(vistos) and len(set(vistos)) == 5
+
+    for numero in (30, 10, 20):
+        client.post("/mesas/", json={"numero": numero, "capacidade": 4})
+    primeira = client.get("/mesas/", params={"limit": 2})
+    assert [m["numero"] for m in primeira.json()] == [10, 20]
+    segunda = client.get("/mesas/", params={"limit": 2, "cursor": primeira.headers["X-Proximo-Cursor"]})
+    assert [m["numero"] for m in segunda.json()] == [30]
+    assert "X-Proximo-Cursor" not in segunda.headers
+
+    assert client.get("/fila/", params={"cursor": "invalido"}).status_code == 400
+
+
+def test_historico_so_com_os_clientes_novos(client: TestClient):
+    """Testa se after_id devolve só os clientes que entraram depois do mais recente mostrado, sem cursor seguinte."""
+    ana = client.post("/fila/", json={"nome_cliente": "Ana", "tamanho_grupo": 2}).json()
+    client.post("/fila/", json={"nome_cliente": "Rui", "tamanho_grupo": 2})
+    client.post("/fila/", json={"nome_cliente": "Eva", "tamanho_grupo": 2})
+
+    novos = client.get("/historico-completo", params={"after_id": ana["id"], "limit": 1})
+    assert [c["nome_cliente"] for c in novos.json()] == ["Eva"]
+    assert "X-Proximo-Cursor" not in novos.headers
+    novos = client.get("/historico-completo", params={"after_id": ana["id"]})
+    assert [c["nome_cliente"] for c in novos.json()] == ["Eva", "Rui"]
+    assert client.get("/historico-completo", params={"after_id": novos.json()[0]["id"]}).json() == []
+
+
+# Banco PostgreSQL descartável para a variante do teste de concorrência (as tabelas são criadas e apagadas)
+TESTE_POSTGRES_URL = os.getenv("TESTE_POSTGRES_URL")
+
+@pytest.mark.parametrize("banco", ["sqlite", pytest.param("postgresql", marks=pytest.mark.skipif(
+    not TESTE_POSTGRES_URL, reason="defina TESTE_POSTGRES_URL para correr contra o PostgreSQL"))])
+def test_atendimentos_simultaneos_nao_sentam_duas_vezes(db_session, tmp_path, banco):
+    """
+    Testa, num SQLite em ficheiro com várias ligações (ou num PostgreSQL, com bloqueios de linha e
+    deadlocks reais), que pedidos simultâneos pelos três caminhos (próximo da fila, próximo para
+    uma mesa e lote) nunca repetem cliente nem mesa.
+    """
+    if banco == "postgresql":
+        engine = create_engine(TESTE_POSTGRES_URL, pool_size=30)
+        Base.metadata.drop_all(bind=engine)
+    else:
+        engine = create_engine(f"sqlite:///{tmp_path / 'concorrencia.db'}", connect_args={"check_same_thread": False, "timeout": 30})
+    Base.metadata.create_all(bind=engine)
+    Fabrica = sessionmaker(bind=engine)
+    with Fabrica() as db:
+        db.add_all([models.Mesa(numero=n, capacidade=4) for n in range(1, 7)])
+        db.add_all([models.Fila(nome_cliente=f"Cliente {i}", tamanho_grupo=2 + i % 3) for i in range(16)])
+        db.commit()
+        ids_mesas = [m.id for m in db.query(models.Mesa).order_by(models.Mesa.numero)]
+
+    # Cada pedido devolve os (cliente, números das mesas) que sentou
+    def proximo_da_fila(db):
+        resultado = asyncio.run(crud.atender_proximo_da_fila(db))
+        return [(resultado["nome_cliente"], resultado["numeros_mesas"].split(", "))] if resultado["sucesso"] else []
+
+    def proximo_para_mesa(mesa_id):
+        def atender(db):
+            mesa = asyncio.run(crud.atribuir_proximo_cliente(db, mesa_id))
+            return [(mesa.cliente_atual, [str(mesa.numero)])] if mesa else []
+        return atender
+
+    def lote(db):
+        return [(a["nome_cliente"], [str(n) for n in a["mesas"]])
+                for a in asyncio.run(crud.atender_fila_em_lote(db, "fifo_com_avanco"))]
+
+    pedidos = [proximo_da_fila] * 8 + [proximo_para_mesa(i) for i in ids_mesas] * 2 + [lote] * 4
+    barreira = threading.Barrier(len(pedidos))
+    sentados, erros = [], []
+
+    def executar(pedido):
+        try:
+            with Fabrica() as db:
+                barreira.wait()
+                sentados.extend(pedido(db))
+        except Exception as e:
+            erros.append(e)
+
+    threads = [threading.Thread(target=executar, args=(pedido,)) for pedido in pedidos]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    try:
+        assert erros == []
+        clientes = [nome for nome, _ in sentados]
+        mesas_atribuidas = [numero for _, numeros in sentados for numero in numeros]
+        assert len(clientes) == len(set(clientes))
+        assert sorted(mesas_atribuidas, key=int) == [str(n) for n in range(1, 7)]
+        with Fabrica() as db:
+            atendidos = {c.nome_cliente for c in db.query(models.Fila).filter(models.Fila.status == "atendido")}
+            mesas = db.query(models.Mesa).all()
+            # Seis mesas de 4 lugares e grupos de 2 a 4 pessoas: um cliente diferente em cada mesa
+            assert atendidos == set(clientes) and len(atendidos) == 6
+            assert all(m.status == "ocupada" for m in mesas)
+            assert {m.cliente_atual for m in mesas} == atendidos
+    finally:
+        motor_alocacao.invalidar()
+        indice_fila.invalidar()
+        if banco == "postgresql":
+            Base.metadata.drop_all(bind=engine)
+        engine.dispose()
+
+
+def test_deadlock_na_reserva_e_repetido(client: TestClient, monkeypatch):
+    """Testa se um OperationalError (ex.: deadlock no PostgreSQL) ao reservar é desfeito e repetido, nos três caminhos."""
+    reservar = crud._reservar
+    falhas = []
+    def reservar_com_deadlock(db, cliente_fila, mesas):
+        # A primeira tentativa de cada cliente dá deadlock
+        if cliente_fila.nome_cliente not in falhas:
+            falhas.append(cliente_fila.nome_cliente)
+            raise OperationalError("UPDATE mesas", {}, Exception("deadlock detected"))
+        return reservar(db, cliente_fila, mesas)
+    monkeypatch.setattr(crud, "_reservar", reservar_com_deadlock)
+
+    mesas = [client.post("/mesas/", json={"numero": n, "capacidade": 4}).json() for n in (1, 2, 3)]
+    for nome in ("Ana", "Rui", "Eva"):
+        client.post("/fila/", json={"nome_cliente": nome, "tamanho_grupo": 2})
+
+    assert client.post("/fila/atender-proximo").status_code == 200
+    assert client.post(f"/mesas/{mesas[1]['id']}/atribuir-proximo").json()["cliente_atual"] == "Rui"
+    assert [a["nome_cliente"] for a in client.post("/fila/atender-lote").json()["atribuicoes"]] == ["Eva"]
+    assert falhas == ["Ana", "Rui", "Eva"]
+    assert {m["status"] for m in client.get("/mesas/").json()} == {"ocupada"}
+
+
+def test_fila_servida_do_indice_em_memoria(client: TestClient, db_session, monkeypatch):
+    """Testa se a fila é lida da memória, mantida pelo crud, reconciliada com o banco e se a mesa recebe o primeiro grupo que cabe."""
+    grande = client.post("/fila/", json={"nome_cliente": "Grupo Grande", "tamanho_grupo": 6}).json()
+    pequeno = client.post("/fila/", json={"nome_cliente": "Casal", "tamanho_grupo": 2}).json()
+    client.post("/fila/", json={"nome_cliente": "Trio", "tamanho_grupo": 3})
+    assert [c["nome_cliente"] for c in client.get("/fila/").json()] == ["Grupo Grande", "Casal", "Trio"]
+
+    comandos = []
+    def contar(*args):
+        comandos.append(args[2])
+    event.listen(db_session.get_bind(), "before_cursor_execute", contar)
+    try:
+        # Parâmetros novos, para não vir do cache de respostas: a lista sai do índice, sem SQL
+        assert [c["id"] for c in client.get("/fila/", params={"limit": 2}).json()] == [grande["id"], pequeno["id"]]
+    finally:
+        event.remove(db_session.get_bind(), "before_cursor_execute", contar)
+    assert comandos == []
+
+    # Uma mesa de 4 lugares recebe o primeiro grupo que cabe nela, não a cabeça da fila
+    mesa = client.post("/mesas/", json={"numero": 7, "capacidade": 4}).json()
+    assert client.post(f"/mesas/{mesa['id']}/atribuir-proximo").json()["cliente_atual"] == "Casal"
+    assert [c["nome_cliente"] for c in client.get("/fila/").json()] == ["Grupo Grande", "Trio"]
+
+    # Escrita feita por fora do crud: só aparece depois da reconciliação com o banco
+    db_session.add(models.Fila(nome_cliente="Por Fora", tamanho_grupo=2, status="aguardando"))
+    db_session.commit()
+    assert len(client.get("/fila/", params={"limit": 10}).json()) == 2
+    monkeypatch.setattr(indice_fila, "reconciliacao_segundos", 0)
+    assert len(client.get("/fila/", params={"limit": 20}).json()) == 3
+
+
+def test_atualizacao_do_proprio_processo_nao_desatualiza_o_indice(client: TestClient):
+    """Testa se os eventos 'atualizado' já aplicados no commit não mandam reler o cliente, e os de outro processo sim."""
+    ana = client.post("/fila/", json={"nome_cliente": "Ana", "tamanho_grupo": 2}).json()
+    rui = client.post("/fila/", json={"nome_cliente": "Rui", "tamanho_grupo": 3}).json()
+    client.get("/fila/")
+
+    client.put(f"/fila/{ana['id']}", json={"tamanho_grupo": 4})
+    client.put(f"/fila/{rui['id']}", json={"status": "cancelado"})
+    assert indice_fila._desatualizados == set()
+
+    # Evento de outro processo com valores diferentes dos que estão no índice
+    indice_fila.observar({"tipo": "fila", "dados": {
+        "acao": "atualizado", "id": ana["id"], "status": "aguardando", "tamanho_grupo": 5, "nome_cliente": "Ana",
+    }})
+    indice_fila.observar({"tipo": "fila", "dados": {"acao": "atualizado", "id": rui["id"], "status": "aguardando"}})
+    assert indice_fila._desatualizados == {ana["id"], rui["id"]}
@@ -0,0 +1,78 @@
+# back/tests/test_garcons.py
+import threading
+import time
+
+from fastapi.testclient import TestClient
+
+import models
+import notification_manager
+from cache_ttl import CacheTTL, AUSENTE
+
+
+def test_cache_ttl_expira_e_descarta_o_menos_usado():
+    """Testa o prazo das entradas (incluindo as negativas) e o descarte LRU."""
+    cache = CacheTTL(capacidade=2, ttl_segundos=60, ttl_negativo_segundos=0.01)
+    cache.guardar("a", {"id": 1})
+    cache.guardar("cliente", None)
+    assert cache.obter("cliente") is None
+    time.sleep(0.02)
+    assert cache.obter("cliente") is AUSENTE
+
+    cache.guardar("b", {"id": 2})
+    cache.obter("a")
+    cache.guardar("c", {"id": 3})
+    assert cache.obter("b") is AUSENTE
+    assert cache.obter("a") == {"id": 1}
+
+
+def test_busca_por_telegram_id_acompanha_escritas_de_garcons(client: TestClient):
+    """Testa se o cache (positivo e negativo) é invalidado ao criar, atualizar e remover garçons."""
+    assert client.get("/garcons/by-telegram-id/555").status_code == 404
+
+    garcon = client.post("/garcons/", json={"nome": "Rui", "telegram_id": "555"}).json()
+    response = client.get("/garcons/by-telegram-id/555")
+    assert response.status_code == 200
+    assert response.json()["nome"] == "Rui"
+
+    client.put(f"/garcons/{garcon['id']}", json={"nome": "Rui Costa"})
+    assert client.get("/garcons/by-telegram-id/555").json()["nome"] == "Rui Costa"
+
+    client.delete(f"/garcons/{garcon['id']}")
+    assert client.get("/garcons/by-telegram-id/555").status_code == 404
+
+
+def test_cache_de_garcons_segue_escritas_de_outro_processo(client: TestClient, db_session):
+    """Testa se um garçom registado por outro worker deixa de ser 'não é garçom' assim que chega o evento."""
+    assert client.get("/garcons/by-telegram-id/777").status_code == 404
+
+    # Outro worker grava o garçom e publica o evento 'garcon'
+    db_session.add(models.Garcon(nome="Eva", telegram_id="777"))
+    db_session.commit()
+    assert client.get("/garcons/by-telegram-id/777").status_code == 404
+    notification_manager._notificar_observadores(
+        {"tipo": "garcon", "dados": {"acao": "criado", "id": 1, "telegram_ids": ["777"]}})
+    assert client.get("/garcons/by-telegram-id/777").json()["nome"] == "Eva"
+
+
+def test_conversa_com_cursores_e_long_poll(client: TestClient):
+    """Testa after_id/before_id/limit e a espera por uma mensagem nova (long-poll)."""
+    garcon = client.post("/garcons/", json={"nome": "Rui"}).json()
+    ids = [
+        client.post("/mensagens/", json={"texto": f"msg {i}", "direcao": "recebida", "garcon_id": garcon["id"]}).json()["id"]
+        for i in range(5)
+    ]
+
+    assert [m["id"] for m in client.get(f"/mensagens/{garcon['id']}?limit=2").json()] == ids[-2:]
+    assert [m["id"] for m in client.get(f"/mensagens/{garcon['id']}?after_id={ids[2]}").json()] == ids[3:]
+    assert [m["id"] for m in client.get(f"/mensagens/{garcon['id']}?before_id={ids[3]}&limit=2").json()] == ids[1:3]
+
+    inicio = time.monotonic()
+    assert client.get(f"/mensagens/{garcon['id']}?after_id={ids[-1]}&esperar=0.2").json() == []
+    assert time.monotonic() - inicio >= 0.2
+
+    nova = threading.Timer(0.2, lambda: client.post(
+        "/mensagens/", json={"texto": "nova", "direcao": "recebida", "garcon_id": garcon["id"]}))
+    nova.start()
+    response = client.get(f"/mensagens/{garcon['id']}?after_id={ids[-1]}&esperar=5")
+    nova.join()
+    assert [m["texto"] for m in response.json()] == ["nova"]
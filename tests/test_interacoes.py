@@ -0,0 +1,45 @@
+# back/tests/test_interacoes.py
+from datetime import datetime, timedelta
+
+from fastapi.testclient import TestClient
+
+import models
+from metricas import painel_metricas
+
+
+def test_metricas_contam_desistencias_apenas_de_hoje(client: TestClient, db_session):
+    """Testa se as desistências de dias anteriores não entram na métrica do dia."""
+    ontem = datetime.utcnow() - timedelta(days=1)
+    db_session.add(models.Fila(nome_cliente="Desistiu Ontem", tamanho_grupo=2, status="cancelado", horario_chegada=ontem))
+    db_session.commit()
+
+    cliente = client.post("/fila/", json={"nome_cliente": "Desistiu Hoje", "tamanho_grupo": 2}).json()
+    client.put(f"/fila/{cliente['id']}", json={"status": "cancelado"})
+    client.post("/fila/", json={"nome_cliente": "Esperando", "tamanho_grupo": 3})
+
+    response = client.get("/metricas")
+    assert response.status_code == 200
+    metricas = response.json()
+    assert metricas["desistencias_hoje"] == 1
+    assert metricas["clientes_na_fila"] == 1
+
+
+def test_metricas_servidas_da_memoria_e_atualizadas_pelo_crud(client: TestClient, db_session, monkeypatch):
+    """Testa se o painel acompanha as escritas do crud sem voltar ao banco, e se a reconciliação corrige o resto."""
+    assert client.get("/metricas").json() == {"clientes_na_fila": 0, "desistencias_hoje": 0, "numero_promocoes": 0}
+
+    # Escrita feita por fora do crud (ex.: outro processo): só aparece na reconciliação
+    db_session.add(models.Fila(nome_cliente="Por Fora", tamanho_grupo=2, status="aguardando"))
+    db_session.commit()
+
+    cliente = client.post("/fila/", json={"nome_cliente": "Ana", "tamanho_grupo": 2}).json()
+    client.post("/fila/", json={"nome_cliente": "Rui", "tamanho_grupo": 2})
+    client.put(f"/fila/{cliente['id']}", json={"status": "cancelado"})
+    promocao = client.post("/promocoes/", json={"nome": "Happy hour", "descricao": "2 por 1"}).json()
+    client.post("/promocoes/", json={"nome": "Sobremesa", "descricao": "Grátis"})
+    client.delete(f"/promocoes/{promocao['id']}")
+
+    assert client.get("/metricas").json() == {"clientes_na_fila": 1, "desistencias_hoje": 1, "numero_promocoes": 1}
+
+    monkeypatch.setattr(painel_metricas, "reconciliacao_segundos", 0)
+    assert client.get("/metricas").json()["clientes_na_fila"] == 2
@@ -67,4 +67,27 @@ def test_buscar_mesa_inexistente(client: TestClient):
     """Testa se a API retorna 404 ao buscar uma mesa que não existe."""
     response = client.get("/mesas/99999") # coloca Um ID q não existe
     assert response.status_code == 404
-    print(" Teste de Erro 404 (Buscar): OK")
\ No newline at end of file
+    print(" Teste de Erro 404 (Buscar): OK")
+
+def test_listar_mesas_com_etag(client: TestClient, monkeypatch):
+    """Testa se a lista responde 304 com o mesmo ETag sem ir ao banco, e muda depois de uma escrita."""
+    import crud
+
+    client.post("/mesas/", json={"numero": 201, "capacidade": 4})
+    response = client.get("/mesas/")
+    etag = response.headers["etag"]
+    assert response.json()[0]["numero"] == 201
+
+    def sem_banco(*args, **kwargs):
+        raise AssertionError("a lista devia vir da memória")
+    with monkeypatch.context() as m:
+        m.setattr(crud, "listar_mesas", sem_banco)
+        response = client.get("/mesas/", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert client.get("/mesas/").json()[0]["numero"] == 201
+
+    client.post("/mesas/", json={"numero": 202, "capacidade": 2})
+    response = client.get("/mesas/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert len(response.json()) == 2
@@ -0,0 +1,95 @@
+# back/tests/test_notificacoes.py
+import asyncio
+import threading
+
+from fastapi.testclient import TestClient
+
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+from notification_manager import BackendNotificacoesBanco, assinar, cancelar_assinatura, formatar_evento_sse
+
+
+async def _receber_eventos(acao, quantidade):
+    """Assina o fluxo, executa a ação numa thread e devolve os primeiros eventos recebidos."""
+    fila = assinar()
+    try:
+        await asyncio.to_thread(acao)
+        return [await asyncio.wait_for(fila.get(), timeout=2) for _ in range(quantidade)]
+    finally:
+        cancelar_assinatura(fila)
+
+
+def test_criar_mesa_publica_notificacao_e_evento_de_mesa(client: TestClient):
+    """Testa se uma alteração feita pela API chega aos assinantes como eventos tipados."""
+    eventos = asyncio.run(_receber_eventos(
+        lambda: client.post("/mesas/", json={"numero": 801, "capacidade": 4}), 2
+    ))
+
+    assert [e["tipo"] for e in eventos] == ["notificacao", "mesa"]
+    assert "Mesa 801" in eventos[0]["dados"]["mensagem"]
+    assert eventos[1]["dados"]["acao"] == "criada"
+
+
+def test_eventos_de_mesa_trazem_sempre_os_ids(client: TestClient):
+    """Testa se todos os caminhos que mudam mesas publicam 'ids' (e os números como campo extra)."""
+    mesas = [client.post("/mesas/", json={"numero": n, "capacidade": 4}).json() for n in (901, 902, 903)]
+    for nome in ("Ana", "Rui", "Eva"):
+        client.post("/fila/", json={"nome_cliente": nome, "tamanho_grupo": 2})
+    client.post("/fila/atender-proximo")
+    client.post("/fila/atender-lote")
+    client.put(f"/mesas/{mesas[0]['id']}", json={"status": "suja"})
+
+    eventos = client.get("/eventos/historico", params={"desde": 0, "limite": 100}).json()
+    de_mesa = [e["dados"] for e in eventos if e["tipo"] == "mesa"]
+    assert [d["acao"] for d in de_mesa] == ["criada"] * 3 + ["status"] * 3
+    assert all("ids" in d and "id" not in d for d in de_mesa)
+    ocupadas = [i for d in de_mesa if d.get("status") == "ocupada" for i in d["ids"]]
+    assert sorted(ocupadas) == sorted(m["id"] for m in mesas)
+
+
+def test_formatar_evento_sse():
+    """Testa a serialização de um evento no formato text/event-stream."""
+    texto = formatar_evento_sse({"seq": 3, "tipo": "fila", "dados": {"id": 7}})
+    assert texto == 'id: 3\nevent: fila\ndata: {"id": 7}\n\n'
+
+
+def test_historico_de_eventos_desde_uma_sequencia(client: TestClient):
+    """Testa se um cliente consegue pedir apenas os eventos depois de uma sequência."""
+    client.post("/fila/", json={"nome_cliente": "Primeiro", "tamanho_grupo": 2})
+    eventos = client.get("/eventos/historico").json()
+    ultimo_seq = eventos[-1]["seq"]
+
+    client.post("/fila/", json={"nome_cliente": "Segundo", "tamanho_grupo": 2})
+    novos = client.get(f"/eventos/historico?desde={ultimo_seq}").json()
+    assert [e["tipo"] for e in novos] == ["notificacao", "fila"]
+    assert all(e["seq"] > ultimo_seq for e in novos)
+    assert "Segundo" in client.get("/notificacoes/").json()[0]
+
+
+def test_backend_banco_partilha_sequencia_entre_instancias(db_session):
+    """Testa se duas instâncias do backend em banco (como dois workers) veem o mesmo anel."""
+    engine = db_session.get_bind()
+    sessoes = sessionmaker(bind=engine)
+    worker_a = BackendNotificacoesBanco(sessoes)
+    worker_b = BackendNotificacoesBanco(sessoes)
+    antes = worker_a.ultimo_seq()
+
+    # Quem publica não toca no banco: a gravação é feita pela thread de fundo
+    threads_com_sql = []
+    def registar_thread(*args):
+        threads_com_sql.append(threading.current_thread())
+    event.listen(engine, "before_cursor_execute", registar_thread)
+    try:
+        worker_a.publicar("notificacao", {"mensagem": "do worker A"})
+        worker_a.descarregar()
+        worker_b.publicar("mesa", {"ids": [1]})
+        worker_b.descarregar()
+    finally:
+        event.remove(engine, "before_cursor_execute", registar_thread)
+    assert threads_com_sql and threading.current_thread() not in threads_com_sql
+
+    eventos = worker_b.desde(antes)
+    assert [e["tipo"] for e in eventos] == ["notificacao", "mesa"]
+    assert worker_a.recentes("notificacao", 5)[0]["dados"]["mensagem"] == "do worker A"
+    assert worker_a.ultimo_seq() == worker_b.ultimo_seq() == eventos[-1]["seq"]
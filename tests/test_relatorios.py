@@ -0,0 +1,262 @@
+# back/tests/test_relatorios.py
+import csv
+import io
+import os
+import threading
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, datetime, time, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import consultas_relatorios
+import exportacoes
+import estatisticas
+import models
+import relatorios_jobs
+import reports
+from agendador_relatorios import AgendadorRelatorios, segundos_ate
+from database_config import Base
+from relatorios_jobs import GestorTrabalhosRelatorios, gestor_relatorios
+
+
+def test_relatorio_personalizado_e_enviado_em_memoria(client: TestClient):
+    """Testa se o relatório chega como PDF, com o nome do ficheiro, sem depender de ficheiros no disco."""
+    client.post("/fila/", json={"nome_cliente": "Ana", "tamanho_grupo": 2})
+    hoje = estatisticas.hoje().isoformat()
+
+    response = client.get(f"/relatorios/personalizado?data_inicio={hoje}&data_fim={hoje}")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/pdf"
+    assert "relatorio_personalizado_" in response.headers["content-disposition"]
+    assert response.content.startswith(b"%PDF")
+    assert int(response.headers["content-length"]) == len(response.content)
+
+
+def test_renderizar_relatorio_sem_banco():
+    """Testa se a fase de renderização trabalha só com os dados já buscados."""
+    dados = reports.DadosRelatorio(
+        tipo="semanal",
+        data_inicio=date(2025, 9, 1),
+        data_fim=date(2025, 9, 7),
+        clientes=[("Ana", 2, datetime(2025, 9, 2, 20, 15), "atendido")],
+        total_clientes=1,
+        total_atendidos=1,
+    )
+    assert reports.renderizar_relatorio_pdf(dados).startswith(b"%PDF")
+    assert dados.nome_ficheiro == "relatorio_semanal_2025_09_07.pdf"
+
+
+def test_relatorio_usa_etag_e_muda_quando_os_dados_mudam(client: TestClient):
+    """Testa o 304 com If-None-Match e a invalidação quando uma linha do período muda."""
+    cliente = client.post("/fila/", json={"nome_cliente": "Ana", "tamanho_grupo": 2}).json()
+
+    primeira = client.get("/relatorios/diario")
+    etag = primeira.headers["etag"]
+    assert primeira.status_code == 200
+
+    repetida = client.get("/relatorios/diario", headers={"If-None-Match": etag})
+    assert repetida.status_code == 304
+
+    client.put(f"/fila/{cliente['id']}", json={"status": "cancelado"})
+    depois = client.get("/relatorios/diario", headers={"If-None-Match": etag})
+    assert depois.status_code == 200
+    assert depois.headers["etag"] != etag
+
+
+def test_etag_muda_quando_o_resumo_e_reconstruido(client: TestClient, db_session):
+    """Testa que uma reconstrução das estatísticas (sem mudanças na fila) invalida o relatório em cache."""
+    client.post("/fila/", json={"nome_cliente": "Ana", "tamanho_grupo": 2})
+    etag = client.get("/relatorios/diario").headers["etag"]
+
+    estatisticas.reconstruir(db_session)
+    depois = client.get("/relatorios/diario", headers={"If-None-Match": etag})
+    assert depois.status_code == 200
+    assert depois.headers["etag"] != etag
+
+
+def test_resumo_em_sql_bate_com_as_estatisticas(client: TestClient, db_session):
+    """Testa se o GROUP BY sobre a fila dá os mesmos totais que a tabela de estatísticas, e o detalhe em tuplos."""
+    client.post("/mesas/", json={"numero": 1, "capacidade": 4})
+    client.post("/fila/", json={"nome_cliente": "Ana", "tamanho_grupo": 2})
+    desistente = client.post("/fila/", json={"nome_cliente": "Rui", "tamanho_grupo": 3}).json()
+    client.post("/fila/", json={"nome_cliente": "Eva", "tamanho_grupo": 5})
+    client.post("/fila/atender-proximo")
+    client.put(f"/fila/{desistente['id']}", json={"status": "cancelado"})
+
+    hoje = estatisticas.hoje()
+    por_sql = consultas_relatorios.resumo_por_sql(db_session, hoje, hoje)
+    por_estatisticas = estatisticas.resumo_periodo(db_session, hoje, hoje)
+    for chave in ("chegadas", "atendidos", "cancelados", "tempo_medio_espera"):
+        assert por_sql[chave] == por_estatisticas[chave]
+
+    detalhe = list(consultas_relatorios.iterar_clientes(db_session, hoje, hoje, tamanho_bloco=2))
+    assert [linha[0] for linha in detalhe] == ["Ana", "Rui", "Eva"]
+    assert detalhe[1][3] == "cancelado"
+
+
+def test_periodo_acima_do_limite_usa_totais_agregados(client: TestClient, db_session, monkeypatch):
+    """Testa a troca do registo linha a linha por totais por dia/hora quando o limite de linhas é excedido."""
+    monkeypatch.setattr(reports, "RELATORIOS_MAX_LINHAS_DETALHE", 2)
+    for nome in ("Ana", "Rui", "Eva"):
+        client.post("/fila/", json={"nome_cliente": nome, "tamanho_grupo": 2})
+
+    hoje = estatisticas.hoje()
+    dados = reports.buscar_dados_relatorio_personalizado(db_session, hoje, hoje)
+    assert dados.detalhe_omitido and dados.clientes == []
+    assert [linha[:2] for linha in dados.por_dia] == [(hoje, 3)]
+    assert sum(linha[1] for linha in dados.por_hora) == 3
+    assert reports.renderizar_relatorio_pdf(dados).startswith(b"%PDF")
+
+
+def test_trabalho_de_relatorio_em_segundo_plano(client: TestClient, db_session, monkeypatch):
+    """Testa o ciclo do trabalho: pedido, deduplicação do mesmo relatório, progresso e download."""
+    monkeypatch.setattr(gestor_relatorios, "session_factory", sessionmaker(bind=db_session.get_bind()))
+    # Segura o trabalho na busca dos dados até o segundo pedido ter sido feito
+    liberar = threading.Event()
+    buscar_dados = reports.buscar_dados_relatorio
+    monkeypatch.setattr(reports, "buscar_dados_relatorio", lambda *args: liberar.wait(5) and buscar_dados(*args))
+    client.post("/fila/", json={"nome_cliente": "Ana", "tamanho_grupo": 2})
+    hoje = estatisticas.hoje().isoformat()
+    pedido = {"tipo": "personalizado", "data_inicio": hoje, "data_fim": hoje}
+
+    primeiro = client.post("/relatorios/jobs", json=pedido)
+    assert primeiro.status_code == 202
+    trabalho_id = primeiro.json()["id"]
+    assert client.post("/relatorios/jobs", json=pedido).json()["id"] == trabalho_id
+    liberar.set()
+
+    gestor_relatorios.esperar(trabalho_id)
+    estado = client.get(f"/relatorios/jobs/{trabalho_id}").json()
+    assert estado["estado"] == "concluido" and estado["progresso"] == 100
+    download = client.get(estado["download"])
+    assert download.status_code == 200
+    assert download.content.startswith(b"%PDF")
+
+    assert client.get("/relatorios/jobs/inexistente").status_code == 404
+    assert client.post("/relatorios/jobs", json={"tipo": "personalizado"}).status_code == 422
+
+
+def test_trabalhos_no_banco_sao_vistos_por_outro_worker(db_session, tmp_path, monkeypatch):
+    """Testa, com dois gestores sobre o mesmo banco (dois workers), o estado, o download e a deduplicação partilhados."""
+    # SQLite em ficheiro: o trabalho grava numa thread enquanto o teste lê noutra ligação
+    engine = create_engine(f"sqlite:///{tmp_path / 'trabalhos.db'}", connect_args={"check_same_thread": False, "timeout": 30})
+    Base.metadata.create_all(bind=engine)
+    fabrica = sessionmaker(bind=engine)
+    worker_a = GestorTrabalhosRelatorios(session_factory=fabrica, processos=0, backend="banco")
+    worker_b = GestorTrabalhosRelatorios(session_factory=fabrica, processos=0, backend="banco")
+    with fabrica() as db:
+        db.add(models.Fila(nome_cliente="Ana", tamanho_grupo=2))
+        db.commit()
+    hoje = estatisticas.hoje()
+    # Segura o trabalho na busca dos dados até o outro worker o ter pedido também
+    liberar = threading.Event()
+    buscar_dados = reports.buscar_dados_relatorio
+    monkeypatch.setattr(reports, "buscar_dados_relatorio", lambda *args: liberar.wait(5) and buscar_dados(*args))
+    try:
+        trabalho = worker_a.submeter("personalizado", hoje, hoje)
+        assert worker_b.submeter("personalizado", hoje, hoje).id == trabalho.id
+        liberar.set()
+        visto_por_b = worker_b.esperar(trabalho.id)
+        assert visto_por_b.estado == "concluido" and visto_por_b.conteudo.startswith(b"%PDF")
+        assert worker_b.obter(trabalho.id, com_conteudo=False).conteudo is None
+        # Terminado, o mesmo relatório pode ser pedido de novo
+        assert worker_b.submeter("personalizado", hoje, hoje).id != trabalho.id
+
+        # Um trabalho ativo cujo worker morreu não bloqueia o relatório para sempre
+        ontem = hoje - timedelta(days=1)
+        perdido = worker_a.armazem.criar_ou_obter_ativo(
+            relatorios_jobs.TrabalhoRelatorio(id="perdido", tipo="personalizado", data_inicio=ontem, data_fim=ontem,
+                                              criado_em=datetime.utcnow() - timedelta(hours=1)))[0]
+        assert worker_b.obter(perdido.id).estado == "falhou"
+        assert worker_b.submeter("personalizado", ontem, ontem).id != perdido.id
+    finally:
+        worker_a.parar()
+        worker_b.parar()
+        engine.dispose()
+
+
+def test_processo_de_renderizacao_que_morre_e_substituido():
+    """Testa que um executor de processos partido é trocado por um novo em vez de falhar todos os trabalhos."""
+    gestor = GestorTrabalhosRelatorios(processos=1)
+    try:
+        _, processos = gestor._executores()
+        with pytest.raises(BrokenProcessPool):
+            processos.submit(os._exit, 1).result()
+        dados = reports.DadosRelatorio(tipo="diario", data_inicio=date(2025, 9, 1), data_fim=date(2025, 9, 1))
+        assert gestor._renderizar(dados).startswith(b"%PDF")
+        assert gestor._processos is not processos
+    finally:
+        gestor.parar()
+
+
+def test_exportacao_csv_em_blocos(client: TestClient, db_session, monkeypatch):
+    """Testa a exportação CSV da fila e dos atendimentos lida em blocos pequenos."""
+    monkeypatch.setattr(exportacoes.exportador, "session_factory", sessionmaker(bind=db_session.get_bind()))
+    monkeypatch.setattr(exportacoes.exportador, "tamanho_bloco", 2)
+    client.post("/mesas/", json={"numero": 1, "capacidade": 4})
+    for nome in ("Ana", "Rui", "Eva"):
+        client.post("/fila/", json={"nome_cliente": nome, "tamanho_grupo": 2})
+    client.post("/fila/atender-proximo")
+    hoje = estatisticas.hoje().isoformat()
+
+    response = client.get(f"/relatorios/exportar/fila?data_inicio={hoje}&data_fim={hoje}")
+    assert response.status_code == 200
+    assert "fila_" in response.headers["content-disposition"]
+    linhas = list(csv.reader(io.StringIO(response.content.decode("utf-8-sig"))))
+    assert linhas[0] == exportacoes.cabecalho("fila")
+    assert [linha[1] for linha in linhas[1:]] == ["Ana", "Rui", "Eva"]
+
+    atendimentos = client.get(f"/relatorios/exportar/atendimentos?data_inicio={hoje}&data_fim={hoje}")
+    linhas = list(csv.reader(io.StringIO(atendimentos.content.decode("utf-8-sig"))))
+    assert len(linhas) == 2 and linhas[1][1] == "Ana"
+
+    assert client.get(f"/relatorios/exportar/mesas?data_inicio={hoje}&data_fim={hoje}").status_code == 404
+
+
+def test_exportacao_csv_neutraliza_formulas(client: TestClient, db_session, monkeypatch):
+    """Testa que nomes que começam por =, +, - ou @ saem como texto e não como fórmula."""
+    monkeypatch.setattr(exportacoes.exportador, "session_factory", sessionmaker(bind=db_session.get_bind()))
+    nomes = ["=HYPERLINK(\"http://x\")", "+1", "-2+3", "@SUM(A1)", "Ana"]
+    for nome in nomes:
+        client.post("/fila/", json={"nome_cliente": nome, "tamanho_grupo": 2})
+    hoje = estatisticas.hoje().isoformat()
+
+    response = client.get(f"/relatorios/exportar/fila?data_inicio={hoje}&data_fim={hoje}")
+    linhas = list(csv.reader(io.StringIO(response.content.decode("utf-8-sig"))))
+    assert [linha[1] for linha in linhas[1:]] == ["'" + nome for nome in nomes[:-1]] + ["Ana"]
+    assert linhas[1][2] == "2"
+
+
+def test_pregeracao_deixa_os_relatorios_de_ontem_em_cache(client: TestClient, db_session, monkeypatch):
+    """Testa se o agendador gera o diário e o semanal até ontem e se o pedido seguinte sai do cache."""
+    fabrica = sessionmaker(bind=db_session.get_bind())
+    monkeypatch.setattr(gestor_relatorios, "session_factory", fabrica)
+    agendador = AgendadorRelatorios(hora="04:00", session_factory=fabrica)
+    hoje = estatisticas.hoje()
+    ontem = hoje - timedelta(days=1)
+
+    trabalhos = agendador.pregerar(hoje=hoje)
+    assert [t.estado for t in trabalhos] == ["concluido", "concluido"]
+    assert (trabalhos[1].data_inicio, trabalhos[1].data_fim) == (ontem - timedelta(days=6), ontem)
+    assert reports.cache_relatorios.estado()["relatorios"] == 2
+
+    response = client.get(f"/relatorios/diario?ate={ontem.isoformat()}")
+    assert response.status_code == 200
+    assert response.content == trabalhos[0].conteudo
+
+    # Os pré-gerados ficam até à pré-geração seguinte e, noutro worker (sem o cache em memória), vêm dos trabalhos
+    assert all(t.expira_em > datetime.utcnow() + timedelta(hours=24) for t in trabalhos)
+    reports.cache_relatorios.limpar()
+    monkeypatch.setattr(reports, "renderizar_relatorio_pdf", lambda dados: pytest.fail("não devia renderizar"))
+    semanal = client.get(f"/relatorios/semanal?ate={ontem.isoformat()}")
+    assert semanal.status_code == 200
+    assert semanal.content == trabalhos[1].conteudo
+
+
+def test_segundos_ate_a_proxima_execucao():
+    """Testa o cálculo da espera até à hora agendada, hoje ou amanhã."""
+    assert segundos_ate(time(4, 0), datetime(2025, 9, 1, 3, 0)) == 3600
+    assert segundos_ate(time(4, 0), datetime(2025, 9, 1, 5, 0)) == 23 * 3600
@@ -0,0 +1,35 @@
+# back/tests/test_sistema.py
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import QueuePool
+
+from database_config import EstatisticasPool
+
+
+def test_estatisticas_pool_contam_checkouts_e_uso():
+    """Testa se os contadores acompanham as ligações retiradas e devolvidas ao pool."""
+    engine = create_engine("sqlite://", poolclass=QueuePool, pool_size=2, max_overflow=1)
+    estatisticas = EstatisticasPool()
+    estatisticas.observar(engine)
+
+    with engine.connect() as primeira, engine.connect() as segunda:
+        primeira.execute(text("SELECT 1"))
+        segunda.execute(text("SELECT 1"))
+        assert estatisticas.resumo(engine)["em_uso"] == 2
+
+    resumo = estatisticas.resumo(engine)
+    assert resumo["checkouts"] == 2
+    assert resumo["checkins"] == 2
+    assert resumo["em_uso"] == 0
+    assert resumo["maximo_em_uso"] == 2
+    assert resumo["tamanho"] == 2
+    assert resumo["livres"] == 2
+
+
+def test_endpoint_estatisticas_pool(client: TestClient):
+    """Testa se o endpoint de diagnóstico do pool responde com a configuração."""
+    response = client.get("/sistema/pool")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["pool"] == "QueuePool"
+    assert "espera_media_ms" in data and "timeouts" in data
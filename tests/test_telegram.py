@@ -0,0 +1,138 @@
+# back/tests/test_telegram.py
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import sessionmaker
+from telegram.error import BadRequest, NetworkError
+
+import models
+from bot_listener import ProcessadorPorChat
+import telegram_sender
+from telegram_sender import EntregadorTelegram, registar_mensagem_grupo, registar_mensagem_privada
+
+
+class BotFalso:
+    """Regista as mensagens em vez de as enviar; pode falhar as primeiras tentativas ou rejeitar um texto."""
+
+    def __init__(self, falhas_iniciais: int = 0, rejeitar: str = None):
+        self.enviadas = []
+        self.falhas_iniciais = falhas_iniciais
+        self.rejeitar = rejeitar
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        if self.rejeitar and self.rejeitar in text:
+            raise BadRequest("Can't parse entities")
+        if self.falhas_iniciais:
+            self.falhas_iniciais -= 1
+            raise NetworkError("sem ligação")
+        self.enviadas.append((chat_id, text))
+
+
+@pytest.fixture
+def telegram_configurado(monkeypatch):
+    monkeypatch.setattr(telegram_sender, "TELEGRAM_BOT_TOKEN", "token-de-teste")
+    monkeypatch.setattr(telegram_sender, "TELEGRAM_GROUP_CHAT_ID", "grupo")
+
+
+def _novo_entregador(db_session, bot):
+    return EntregadorTelegram(bot=bot, session_factory=sessionmaker(bind=db_session.get_bind()),
+                              intervalo_grupo=0, intervalo_privada=0, janela_coalescencia=0)
+
+
+def test_rajada_para_o_grupo_e_juntada_numa_mensagem(db_session, telegram_configurado):
+    """Testa se várias mensagens seguidas para o grupo saem numa só, e as privadas à parte."""
+    registar_mensagem_grupo(db_session, "Mesa 1 ocupada")
+    registar_mensagem_grupo(db_session, "Mesa 2 ocupada")
+    registar_mensagem_privada(db_session, "42", "Olá")
+    db_session.commit()
+
+    bot = BotFalso()
+    entregador = _novo_entregador(db_session, bot)
+    asyncio.run(entregador.entregar_pendentes())
+
+    assert bot.enviadas == [("grupo", "Mesa 1 ocupada\n\nMesa 2 ocupada"), ("42", "Olá")]
+    assert entregador.coalescidas == 1
+    db_session.expire_all()
+    assert {m.status for m in db_session.query(models.MensagemOutbox).all()} == {"enviada"}
+
+
+def test_mensagem_invalida_numa_rajada_nao_derruba_as_outras(db_session, telegram_configurado):
+    """Testa se, quando o Telegram rejeita uma rajada juntada, só a mensagem inválida fica 'falhou'."""
+    registar_mensagem_grupo(db_session, "Cliente 'Ana' foi atendido na Mesa 1.")
+    registar_mensagem_grupo(db_session, "Cliente 'Rui_*[x]' foi atendido na Mesa 2.")
+    registar_mensagem_grupo(db_session, "Cliente 'Eva' foi atendido na Mesa 3.")
+    db_session.commit()
+    # Os caracteres reservados do MarkdownV2 ficam todos escapados no outbox
+    textos = [m.texto for m in db_session.query(models.MensagemOutbox).order_by(models.MensagemOutbox.id)]
+    assert textos[1] == "Cliente 'Rui\\_\\*\\[x\\]' foi atendido na Mesa 2\\."
+
+    bot = BotFalso(rejeitar="Rui")
+    entregador = _novo_entregador(db_session, bot)
+    asyncio.run(entregador.entregar_pendentes())
+
+    assert bot.enviadas == [("grupo", textos[0]), ("grupo", textos[2])]
+    db_session.expire_all()
+    estados = {m.texto: m.status for m in db_session.query(models.MensagemOutbox).all()}
+    assert estados == {textos[0]: "enviada", textos[1]: "falhou", textos[2]: "enviada"}
+
+
+def test_falha_de_rede_fica_reagendada(db_session, telegram_configurado):
+    """Testa se uma falha de rede deixa a mensagem pendente, com a tentativa contada e para mais tarde."""
+    registar_mensagem_privada(db_session, "42", "Olá")
+    db_session.commit()
+
+    bot = BotFalso(falhas_iniciais=1)
+    entregador = _novo_entregador(db_session, bot)
+    asyncio.run(entregador.entregar_pendentes())
+
+    db_session.expire_all()
+    mensagem = db_session.query(models.MensagemOutbox).one()
+    assert bot.enviadas == []
+    assert mensagem.status == "pendente"
+    assert mensagem.tentativas == 1
+    assert mensagem.proxima_tentativa > datetime.utcnow()
+
+
+def test_atendimento_regista_mensagem_idempotente_no_outbox(client: TestClient, db_session, telegram_configurado):
+    """Testa se o atendimento grava a mensagem para o grupo na mesma transação, uma só vez por cliente."""
+    client.post("/mesas/", json={"numero": 1, "capacidade": 4})
+    cliente = client.post("/fila/", json={"nome_cliente": "Ana", "tamanho_grupo": 2}).json()
+    assert client.post("/fila/atender-proximo").status_code == 200
+
+    mensagens = db_session.query(models.MensagemOutbox).all()
+    assert len(mensagens) == 1
+    assert mensagens[0].chave_idempotencia == f"atendimento:fila:{cliente['id']}"
+    assert mensagens[0].status == "pendente"
+
+    # Registar de novo a mesma mensagem lógica não a duplica
+    assert not registar_mensagem_grupo(db_session, "repetida", chave=f"atendimento:fila:{cliente['id']}")
+
+
+def test_bot_trata_em_serie_as_mensagens_do_mesmo_chat():
+    """Testa se duas mensagens do mesmo chat nunca são tratadas ao mesmo tempo, e as de chats diferentes são."""
+    async def cenario():
+        processador = ProcessadorPorChat(8)
+        em_curso, maximo_por_chat, maximo_total, ordem = {}, {}, [0], []
+
+        async def tratar(chat_id, n):
+            em_curso[chat_id] = em_curso.get(chat_id, 0) + 1
+            maximo_por_chat[chat_id] = max(maximo_por_chat.get(chat_id, 0), em_curso[chat_id])
+            maximo_total[0] = max(maximo_total[0], sum(em_curso.values()))
+            await asyncio.sleep(0.01)
+            ordem.append((chat_id, n))
+            em_curso[chat_id] -= 1
+
+        atualizacoes = [(chat_id, n) for n in range(3) for chat_id in (1, 2)]
+        await asyncio.gather(*(
+            processador.process_update(SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id)), tratar(chat_id, n))
+            for chat_id, n in atualizacoes
+        ))
+        return maximo_por_chat, maximo_total[0], ordem
+
+    maximo_por_chat, maximo_total, ordem = asyncio.run(cenario())
+    assert maximo_por_chat == {1: 1, 2: 1}
+    assert maximo_total == 2
+    assert [n for chat_id, n in ordem if chat_id == 1] == [0, 1, 2]
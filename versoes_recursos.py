@@ -0,0 +1,68 @@
+# back/versoes_recursos.py
+
+import hashlib
+import os
+import threading
+
+from cache_ttl import CacheTTL, AUSENTE
+from notification_manager import observar_eventos
+
+# Que lista muda com cada tipo de evento publicado pelo crud
+RECURSOS_POR_EVENTO = {"mesa": "mesas", "fila": "fila", "garcon": "garcons", "promocao": "promocoes"}
+
+# Prazo máximo de uma lista em cache, para apanhar alterações feitas fora da aplicação
+LISTAS_CACHE_SEGUNDOS = float(os.getenv("LISTAS_CACHE_SEGUNDOS", "60"))
+
+
+class VersoesRecursos:
+    """
+    Um contador por lista (mesas, fila, garçons, promoções), incrementado a cada evento
+    que o crud publica depois de um commit, deste ou de outros processos. Uma resposta
+    guardada para a versão N deixa de ser usada assim que a versão muda.
+    """
+
+    def __init__(self):
+        self._versoes = {}
+        self._lock = threading.Lock()
+
+    def versao(self, recurso: str) -> int:
+        with self._lock:
+            return self._versoes.get(recurso, 0)
+
+    def incrementar(self, recurso: str):
+        with self._lock:
+            self._versoes[recurso] = self._versoes.get(recurso, 0) + 1
+
+    def observar(self, evento: dict):
+        recurso = RECURSOS_POR_EVENTO.get(evento["tipo"])
+        if recurso:
+            self.incrementar(recurso)
+
+    def limpar(self):
+        with self._lock:
+            self._versoes.clear()
+
+versoes_recursos = VersoesRecursos()
+observar_eventos(versoes_recursos.observar)
+
+# (recurso, versão, parâmetros) -> (etag, corpo JSON já serializado, cursor da página seguinte)
+cache_listas = CacheTTL(capacidade=256, ttl_segundos=LISTAS_CACHE_SEGUNDOS)
+
+
+def lista_serializada(db, recurso: str, parametros: tuple, consultar, adaptador, proximo=None):
+    """
+    Devolve (etag, corpo, cursor seguinte) da lista na versão atual: do cache, ou consultando
+    o banco (consultar(db)) e serializando com o TypeAdapter do schema de saída. O cursor vem
+    de proximo(linhas), se indicado. O ETag é o hash do corpo, por isso continua válido entre
+    reinícios e entre processos.
+    """
+    # A versão é lida antes da consulta: uma escrita a meio faz a próxima leitura ir ao banco
+    chave = (recurso, versoes_recursos.versao(recurso), parametros)
+    em_cache = cache_listas.obter(chave)
+    if em_cache is not AUSENTE:
+        return em_cache
+    linhas = consultar(db)
+    corpo = adaptador.dump_json(adaptador.validate_python(linhas, from_attributes=True))
+    resultado = ('"' + hashlib.sha1(corpo).hexdigest() + '"', corpo, proximo(linhas) if proximo else None)
+    cache_listas.guardar(chave, resultado)
+    return resultado